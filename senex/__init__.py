@@ -1,46 +1,36 @@
-import json
 from pyramid.config import Configurator
 from pyramid.authentication import AuthTktAuthenticationPolicy
-from pyramid.security import unauthenticated_userid
 from pyramid.authorization import ACLAuthorizationPolicy
 
-from sqlalchemy import engine_from_config
-
 from .models import (
     DBSession,
+    JobSession,
     Base,
-    User,
+    upgrade_schema,
     )
 
+from .cache import RequestCache
+from .events import configure_event_bus
+from .probes import configure_probe_cache
+from .security import get_user, groupfinder
+from .storage import create_senex_engine
+from .state import configure_snapshot_retention, start_state_refresher
 from worker import start_worker
 
 
-def get_user(request):
-    userid = unauthenticated_userid(request)
-    if userid is None:
-        return None
-    else:
-        user = DBSession.query(User).filter_by(username=userid).first()
-        if user:
-            return user
-        else:
-            return None
-
-
-def groupfinder(userid, request):
-    user = request.user
-    if user is not None:
-        return json.loads(user.groups)
-    return None
-
-
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = create_senex_engine(settings)
     DBSession.configure(bind=engine)
+    JobSession.configure(bind=engine)
     Base.metadata.bind = engine
+    upgrade_schema(engine)
+    configure_probe_cache(settings.get('senex.probe_cache_path'))
+    configure_snapshot_retention(settings)
+    configure_event_bus(settings, global_config.get('__file__'))
     start_worker()
+    start_state_refresher()
     authn_policy = AuthTktAuthenticationPolicy(
         'blargon5', callback=groupfinder, hashalg='sha512', timeout=900)
     authz_policy = ACLAuthorizationPolicy()
@@ -49,11 +39,16 @@ def main(global_config, **settings):
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(authz_policy)
     config.add_request_method(get_user, 'user', reify=True)
+    config.add_request_method(RequestCache, 'cache', reify=True)
     config.include('pyramid_chameleon')
     config.add_static_view('static', 'static', cache_max_age=3600)
 
     config.add_route('view_main_page', '/')
-    config.add_route('return_status', '/senexstatus')
+    config.add_route('events', '/events')
+    config.add_route('soft_dependencies', '/softdependencies')
+    config.add_route('probe_stats', '/probestats')
+    config.add_route('submit_install', '/jobs/install')
+    config.add_route('view_job', '/jobs/{job_id}')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
 
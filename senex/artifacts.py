@@ -0,0 +1,569 @@
+"""This module contains the download cache for the source archives (e.g., of
+m4, bison and MITLM) that the installer builds from.
+
+Archives are stored under the SHA-256 digest of their contents, so a cached
+archive is found by its digest and can be verified by re-hashing it. An
+archive's expected digest is pinned in its `Artifact`, in a checksums file in
+the format of `sha256sum` (see `read_checksums`) or, if it is not pinned, the
+digest of its first complete download, which is recorded in the cache's index
+(trust on first use). A mirror directory's SHA256SUMS file, if it has one,
+pins the archives in it. An archive is looked for in the cache first, then in
+the local mirror directory (if there is one) and only then downloaded.
+Interrupted downloads are resumed where they left off if the server supports
+ranges.
+Example usage::
+
+    from artifacts import Artifact, ArtifactCache
+    cache = ArtifactCache('~/.senex/artifacts', mirror_dir='/srv/mirror')
+    path = cache.fetch(Artifact('m4-1.4.10.tar.gz',
+                                'ftp://ftp.gnu.org/gnu/m4/m4-1.4.10.tar.gz'))
+
+With `offline=True`, nothing is downloaded: archives that are neither cached
+nor mirrored cannot be fetched.
+
+Archives (gzipped tarballs) can also be extracted with `extract`, which
+unpacks an archive while it is being read from the cache, the mirror or the
+network, hashing it and copying it into the cache on the way, so that no
+archive is written and then read back in a separate pass::
+
+    cache.extract(artifact, 'tmp')  # e.g., creates tmp/m4-1.4.10/
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib2
+import zlib
+
+# The default location of the cache. The cache and the mirror directory can
+# also be set with the SENEX_ARTIFACT_CACHE and SENEX_MIRROR_DIR environment
+# variables.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.senex',
+                                 'artifacts')
+
+# How many bytes are read from a file or the network at a time.
+CHUNK_SIZE = 64 * 1024
+
+# How long (in seconds) a download may stall before it is given up on.
+DOWNLOAD_TIMEOUT = 60
+
+
+class DownloadError(IOError):
+    """Raised when an archive can be neither found nor downloaded, or when its
+    contents do not match its digest.
+
+    """
+
+
+class IncompleteDownload(DownloadError):
+    """Raised when a download ends before the whole archive has been received.
+    What was received is kept, so that the download can resume.
+
+    """
+
+
+class Artifact(object):
+    """A downloadable archive: its file name, the URL to download it from and,
+    optionally, the SHA-256 digest that its contents must have.
+
+    """
+
+    def __init__(self, filename, url, sha256=None):
+        self.filename = filename
+        self.url = url
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return '<Artifact %s>' % self.filename
+
+
+def read_checksums(path):
+    """Return the digests in the checksums file at `path`, i.e., the output of
+    `sha256sum`, as a dict from file names to digests.
+
+    """
+
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                digest, filename = parts
+                checksums[os.path.basename(filename.strip().lstrip('*'))] = \
+                    digest.lower()
+    return checksums
+
+
+class HashingReader(object):
+    """A file-like object that reads from each of `sources`, a list of
+    `(fileobj, tee)` pairs, in turn, hashing everything that it reads and
+    writing what it reads from a source to that source's `tee` file (if it has
+    one).
+
+    """
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.digest = hashlib.sha256()
+
+    def read(self, size=CHUNK_SIZE):
+        while self.sources:
+            fileobj, tee = self.sources[0]
+            chunk = fileobj.read(size)
+            if chunk:
+                self.digest.update(chunk)
+                if tee:
+                    tee.write(chunk)
+                return chunk
+            self.sources.pop(0)
+        return ''
+
+    def drain(self):
+        """Read whatever is left, e.g., the padding after the end of a tar
+        archive, so that the digest is that of the whole stream.
+
+        """
+
+        while self.read():
+            pass
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """A content-addressed cache of archives in `cache_dir`, backed by the
+    optional local `mirror_dir`.
+
+    """
+
+    def __init__(self, cache_dir=None, mirror_dir=None, offline=False,
+                 checksums=None):
+        self.cache_dir = os.path.expanduser(
+            cache_dir or os.environ.get('SENEX_ARTIFACT_CACHE') or
+            DEFAULT_CACHE_DIR)
+        mirror_dir = mirror_dir or os.environ.get('SENEX_MIRROR_DIR')
+        self.mirror_dir = mirror_dir and os.path.expanduser(mirror_dir)
+        self.offline = offline
+        self.checksums = {}
+        if self.mirror_dir:
+            sums_path = os.path.join(self.mirror_dir, 'SHA256SUMS')
+            if os.path.isfile(sums_path):
+                self.checksums.update(read_checksums(sums_path))
+        self.checksums.update(checksums or {})
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+
+    def get_path(self, digest):
+        return os.path.join(self.cache_dir, 'sha256', digest[:2], digest)
+
+    def get_partial_path(self, artifact):
+        return os.path.join(self.cache_dir, 'partial',
+                            artifact.filename + '.part')
+
+    def read_index(self):
+        """Return the index, a dict from file names to the digests of the
+        archives that were first cached under those names.
+
+        """
+
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def record(self, artifact, digest):
+        """Record `digest` as the digest of `artifact` in the index. The index
+        is replaced atomically.
+
+        """
+
+        with self.lock:
+            index = self.read_index()
+            index[artifact.filename] = digest
+            tmp_path = '%s.%s.tmp' % (self.index_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.index_path)
+
+    def expected_digest(self, artifact):
+        return (artifact.sha256 or self.checksums.get(artifact.filename) or
+                self.read_index().get(artifact.filename))
+
+    def lookup(self, artifact):
+        """Return the path to the cached copy of `artifact`, or `None` if there
+        is no intact one.
+
+        """
+
+        digest = self.expected_digest(artifact)
+        if not digest:
+            return None
+        path = self.get_path(digest)
+        if not os.path.isfile(path):
+            return None
+        if file_digest(path) != digest:
+            # The cached copy is corrupt.
+            os.remove(path)
+            return None
+        return path
+
+    def store(self, artifact, path, digest, move=False, trusted=True):
+        """Add the file at `path`, whose contents have `digest`, to the cache
+        as `artifact` and return its path in the cache. Raise `DownloadError`
+        if `digest` is not the expected one. If `artifact` has no expected
+        digest yet, `digest` becomes its expected digest, unless the file is
+        not `trusted` to be complete (e.g., a download of unknown length), in
+        which case it is not recorded in the index.
+
+        """
+
+        expected = self.expected_digest(artifact)
+        if expected and digest != expected:
+            raise DownloadError('%s has SHA-256 digest %s instead of %s.' % (
+                artifact.filename, digest, expected))
+        cached_path = self.get_path(digest)
+        create_directory(os.path.dirname(cached_path))
+        tmp_path = '%s.%s.tmp' % (cached_path, os.getpid())
+        if move:
+            shutil.move(path, tmp_path)
+        else:
+            shutil.copyfile(path, tmp_path)
+        os.rename(tmp_path, cached_path)
+        if expected or trusted:
+            self.record(artifact, digest)
+        return cached_path
+
+    def fetch(self, artifact):
+        """Return the path to a verified copy of `artifact` in the cache,
+        copying it from the mirror directory or downloading it first if it is
+        not cached. Raise `DownloadError` if that is not possible.
+
+        """
+
+        create_directory(self.cache_dir)
+        path = self.lookup(artifact)
+        if path:
+            return path
+        if self.mirror_dir:
+            mirrored = os.path.join(self.mirror_dir, artifact.filename)
+            if os.path.isfile(mirrored):
+                return self.store(artifact, mirrored, file_digest(mirrored))
+        if self.offline:
+            raise DownloadError('%s is neither cached nor mirrored and'
+                                ' downloads are disabled.' % artifact.filename)
+        partial, length = self.download(artifact)
+        self.check_length(artifact, partial, length)
+        try:
+            return self.store(artifact, partial, file_digest(partial),
+                              move=True, trusted=length is not None)
+        except DownloadError:
+            os.remove(partial)
+            raise
+
+    def download(self, artifact):
+        """Download `artifact` to its partial file and return a 2-tuple of the
+        file's path and the archive's length (`None` if the server did not
+        say). If the partial file holds the beginning of an earlier,
+        interrupted download, only the rest is requested, provided the server
+        supports ranges (HTTP servers that answer 206 Partial Content).
+
+        """
+
+        partial, response, resumed, length = self.open_download(artifact)
+        if response is None:
+            return partial, length
+        try:
+            with open(partial, 'ab' if resumed else 'wb') as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                    f.write(chunk)
+        except IOError, e:
+            # What was downloaded is kept, so that the download can resume.
+            raise IncompleteDownload('Unable to download %s: %s' % (
+                artifact.url, e))
+        finally:
+            response.close()
+        return partial, length
+
+    def open_download(self, artifact):
+        """Start downloading `artifact`, resuming an interrupted download if
+        possible, and return a 4-tuple of the path to its partial file, the
+        response to read the (rest of the) archive from, whether the response
+        continues the partial file rather than replacing it and the length of
+        the whole archive (`None` if the server did not say). The response is
+        `None` if the partial file is already complete.
+
+        """
+
+        partial = self.get_partial_path(artifact)
+        create_directory(os.path.dirname(partial))
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+        request = urllib2.Request(artifact.url)
+        if offset and artifact.url.startswith(('http:', 'https:')):
+            request.add_header('Range', 'bytes=%s-' % offset)
+        try:
+            response = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except urllib2.HTTPError, e:
+            if e.code != 416:
+                raise DownloadError('Unable to download %s: %s' % (
+                    artifact.url, e))
+            # The range is past the end, which only means that the partial
+            # file is complete if the server says that it is as long as the
+            # archive. Otherwise, the download starts over.
+            start, length = parse_content_range(e.headers.get('Content-Range'))
+            if length is None or length != offset:
+                os.remove(partial)
+                return self.open_download(artifact)
+            return partial, None, True, length
+        except (urllib2.URLError, IOError), e:
+            raise DownloadError('Unable to download %s: %s' % (
+                artifact.url, e))
+        try:
+            content_length = int(response.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            content_length = None
+        if getattr(response, 'code', None) != 206:
+            return partial, response, False, content_length
+        start, length = parse_content_range(
+            response.headers.get('Content-Range'))
+        if start is None:
+            # Without a Content-Range, the response is taken to start at the
+            # requested offset.
+            start = offset
+            if length is None and content_length is not None:
+                length = offset + content_length
+        if start != offset:
+            response.close()
+            os.remove(partial)
+            return self.open_download(artifact)
+        return partial, response, True, length
+
+    def check_length(self, artifact, partial, length):
+        """Raise `DownloadError` if the partial file of `artifact` is not
+        `length` bytes long: `IncompleteDownload`, keeping the file, if it is
+        shorter, otherwise removing the file.
+
+        """
+
+        if length is None:
+            return
+        size = os.path.getsize(partial)
+        if size < length:
+            raise IncompleteDownload(
+                'Only %s of the %s bytes of %s were downloaded.' % (
+                    size, length, artifact.url))
+        if size > length:
+            os.remove(partial)
+            raise DownloadError('%s bytes of %s were downloaded instead of'
+                                ' %s.' % (size, artifact.url, length))
+
+    def extract(self, artifact, dest_dir):
+        """Extract `artifact`, a gzipped tarball, into `dest_dir` while reading
+        it from the cache, the mirror directory or the network, in that order,
+        and return the path to its cached copy. The archive is hashed as it is
+        read and a mirrored or downloaded archive is copied into the cache at
+        the same time, so the archive is only read once. Raise `DownloadError`
+        if the archive cannot be fetched or does not match its digest.
+
+        The archive is extracted into a staging directory whose contents are
+        only moved into `dest_dir` once the archive's digest has been
+        verified, so nothing from a corrupt or tampered archive is left in
+        `dest_dir`.
+
+        """
+
+        create_directory(self.cache_dir)
+        expected = self.expected_digest(artifact)
+        if expected and os.path.isfile(self.get_path(expected)):
+            path = self.get_path(expected)
+            try:
+                with open(path, 'rb') as f:
+                    self.extract_stream(artifact, [(f, None)], dest_dir,
+                                        self.check_cached)
+                return path
+            except DownloadError:
+                # The cached copy is corrupt.
+                os.remove(path)
+        if self.mirror_dir:
+            mirrored = os.path.join(self.mirror_dir, artifact.filename)
+            if os.path.isfile(mirrored):
+                tmp_path = '%s.%s.tmp' % (self.get_partial_path(artifact),
+                                          os.getpid())
+                create_directory(os.path.dirname(tmp_path))
+                try:
+                    with open(mirrored, 'rb') as f:
+                        with open(tmp_path, 'wb') as tee:
+                            return self.extract_stream(
+                                artifact, [(f, tee)], dest_dir,
+                                lambda artifact, digest: self.store(
+                                    artifact, tmp_path, digest, move=True))
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        if self.offline:
+            raise DownloadError('%s is neither cached nor mirrored and'
+                                ' downloads are disabled.' % artifact.filename)
+        partial, response, resumed, length = self.open_download(artifact)
+        def verify(artifact, digest):
+            self.check_length(artifact, partial, length)
+            return self.store(artifact, partial, digest, move=True,
+                              trusted=length is not None)
+        sources = []
+        try:
+            with open(partial, 'ab' if resumed else 'wb') as tee:
+                if resumed:
+                    # Extract what an earlier download left first.
+                    sources.append((open(partial, 'rb'), None))
+                if response is not None:
+                    sources.append((response, tee))
+                return self.extract_stream(artifact, sources, dest_dir,
+                                           verify)
+        except IncompleteDownload:
+            raise
+        except DownloadError:
+            if length is not None and os.path.isfile(partial) and \
+                    os.path.getsize(partial) < length:
+                # The archive could not be extracted because it is truncated.
+                raise IncompleteDownload(
+                    'Only part of %s was downloaded.' % artifact.url)
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        except IOError, e:
+            # What was downloaded is kept, so that the download can resume.
+            raise IncompleteDownload('Unable to download %s: %s' % (
+                artifact.url, e))
+        finally:
+            for fileobj, tee in sources:
+                fileobj.close()
+
+    def check_cached(self, artifact, digest):
+        expected = self.expected_digest(artifact)
+        if digest != expected:
+            raise DownloadError('%s has SHA-256 digest %s instead of %s.' % (
+                artifact.filename, digest, expected))
+        return self.get_path(digest)
+
+    def extract_stream(self, artifact, sources, dest_dir, verify):
+        """Extract the archive read from `sources` (see `HashingReader`) into a
+        staging directory, pass its digest to `verify`, which raises
+        `DownloadError` if the digest is wrong and otherwise returns the path
+        to the cached archive, move the extracted files into `dest_dir` and
+        return what `verify` returned. Each member is checked with
+        `check_member` before it is extracted, so that nothing is written
+        outside of the staging directory before the digest is verified.
+
+        """
+
+        create_directory(dest_dir)
+        staging_dir = tempfile.mkdtemp(prefix='.extract-', dir=dest_dir)
+        try:
+            reader = HashingReader(sources)
+            try:
+                tar = tarfile.open(fileobj=reader, mode='r|gz')
+                for member in tar:
+                    check_member(member, staging_dir)
+                    tar.extract(member, path=staging_dir)
+                tar.close()
+                reader.drain()
+            except (tarfile.TarError, zlib.error, EOFError), e:
+                # Read the rest, so that a download is complete.
+                reader.drain()
+                raise DownloadError('Unable to extract %s: %s' % (
+                    artifact.filename, e))
+            for fileobj, tee in sources:
+                if tee:
+                    tee.flush()
+            path = verify(artifact, reader.hexdigest())
+            for name in os.listdir(staging_dir):
+                target = os.path.join(dest_dir, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target):
+                    os.remove(target)
+                os.rename(os.path.join(staging_dir, name), target)
+            return path
+        finally:
+            shutil.rmtree(staging_dir)
+
+
+def is_within(path, directory):
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def check_member(member, staging_dir):
+    """Raise `DownloadError` unless the tar archive member `member` can be
+    extracted into `staging_dir` without writing outside of it, i.e., unless
+    it is a file, directory or link whose path (and, for a link, whose target)
+    is within `staging_dir`, even if the links extracted before it are
+    followed.
+
+    """
+
+    path = os.path.join(staging_dir, member.name)
+    if os.path.isabs(member.name) or not is_within(path, staging_dir):
+        raise DownloadError('The archive member %s is outside of the archive.'
+                            % member.name)
+    if member.issym():
+        target = os.path.join(os.path.dirname(path), member.linkname)
+    elif member.islnk():
+        target = os.path.join(staging_dir, member.linkname)
+    elif member.isfile() or member.isdir():
+        return
+    else:
+        raise DownloadError('The archive member %s is a special file.'
+                            % member.name)
+    if os.path.isabs(member.linkname) or not is_within(target, staging_dir):
+        raise DownloadError('The archive member %s links to %s, outside of'
+                            ' the archive.' % (member.name, member.linkname))
+
+
+def parse_content_range(header):
+    """Return the start of the range and the length of the whole file from the
+    value of a Content-Range header, e.g., (1000, 5000) from
+    'bytes 1000-4999/5000' or (None, 5000) from 'bytes */5000'. Either is
+    `None` if it is not given.
+
+    """
+
+    start = length = None
+    try:
+        unit, value = header.split(' ', 1)
+        range_, total = value.strip().split('/', 1)
+        if range_ != '*':
+            start = int(range_.split('-', 1)[0])
+        if total != '*':
+            length = int(total)
+    except (AttributeError, ValueError):
+        pass
+    return start, length
+
+
+def create_directory(path):
+    """Create the directory at `path` unless it exists, tolerating another
+    thread or process creating it at the same time.
+
+    """
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
@@ -82,6 +82,8 @@ import json
 import datetime
 from subprocess import Popen, PIPE, STDOUT
 
+from sysindex import which
+
 # Try to import python-crontab (https://pypi.python.org/pypi/python-crontab)
 try:
     import crontab
@@ -1308,30 +1310,6 @@ def fix_tag_name_col(params):
 
 
 
-def which(program):
-    """Return the path to `program` if it is an executable; otherwise return
-    `None`. From
-    http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python.
-
-    """
-
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
-
-    return None
-
-
 def abort(params):
     """This is called when the script aborts mid-build. It should undo what has
     been done, in reverse order.
@@ -0,0 +1,144 @@
+"""This module contains the caches that Senex uses to avoid fetching the same
+rows from the database over and over.
+
+`RequestCache` memoizes values, e.g., the current Senex state model or the list
+of OLDs, for the duration of a single request. It is available to views as
+`request.cache` (see :func:`senex.main`). Cached values are live ORM objects,
+so changes made to them are seen by every caller; a cached value only has to
+be invalidated when rows are added or deleted. Example usage::
+
+    olds = request.cache.get('olds', lambda: DBSession.query(OLD).all())
+    DBSession.add(new_old)
+    request.cache.invalidate('olds')
+
+`SettingsCache` holds Senex's current settings for the life of the process. The
+settings are stamped with a version, the id of their settings model, which
+increases every time they change; whoever reads them passes the current version
+(which is cheap to read from the db) and the cache reloads them if it holds an
+older version. This way, a change made by another process that shares the db
+is picked up on the next read.
+
+`LRUCache` is a bounded, thread-safe cache whose entries expire after a time to
+live. It is used for the principals of authenticated users; see
+:mod:`senex.security`.
+
+"""
+
+import collections
+import threading
+import time
+
+
+class RequestCache(object):
+    """A request-scoped memo from keys to the values returned by the loaders
+    that were first passed with them.
+
+    """
+
+    def __init__(self, request=None):
+        self.values = {}
+
+    def get(self, key, loader, *args):
+        """Return the value cached under `key`, calling `loader` with `args`
+        to load it if it is not cached yet.
+
+        """
+
+        if key not in self.values:
+            self.values[key] = loader(*args)
+        return self.values[key]
+
+    def invalidate(self, *keys):
+        """Forget the values cached under `keys`, or all of them if no keys are
+        given.
+
+        """
+
+        if not keys:
+            self.values = {}
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class SettingsCache(object):
+    """A process-wide cache of the current settings, as a dict, stamped with
+    their version.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.settings = None
+
+    def get(self, version, loader):
+        """Return a copy of the settings at `version`, calling `loader` with
+        `version` to load them if the cache holds a different version.
+
+        """
+
+        with self.lock:
+            if version is not None and version == self.version:
+                return dict(self.settings)
+        settings = loader(version)
+        self.set(version, settings)
+        return dict(settings)
+
+    def set(self, version, settings):
+        """Cache `settings` as the settings at `version`, unless the cache
+        already holds a more recent version.
+
+        """
+
+        with self.lock:
+            if self.version is None or version >= self.version:
+                self.version = version
+                self.settings = dict(settings)
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+            self.settings = None
+
+
+class LRUCache(object):
+    """A thread-safe cache of at most `maxsize` entries, each of which expires
+    `ttl` seconds after it was set. When the cache is full, the least recently
+    used entry is evicted.
+
+    """
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.time():
+                return default
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Forget the entries with `keys`, or all of them if no keys are given.
+
+        """
+
+        with self.lock:
+            if not keys:
+                self.entries.clear()
+            for key in keys:
+                self.entries.pop(key, None)
@@ -0,0 +1,195 @@
+"""This module contains the in-process event bus that pushes changes to Senex's
+state (job state changes, the current step of an installation and OLDs being
+started or stopped) to the browser.
+
+Every published event gets the next version number and is kept in a bounded
+buffer. Clients long-poll the `events` route with a cursor, i.e., the version
+of the last event that they have seen, and get every event after it as soon as
+there is one, or an empty list when the poll times out. A cursor also names the
+bus's epoch, which is different in every process, so a client whose cursor is
+from before a restart, or so old that the events after it have been dropped
+from the buffer, is told to reset, i.e., to reload the whole state. Example
+usage::
+
+    from events import event_bus
+    cursor = event_bus.cursor()
+    event_bus.publish('old', name=u'bla', running=True)
+    event_bus.wait(cursor, timeout=25)['events']  # [{'type': 'old', ...}]
+
+Each waiting poll holds one of the server's threads, so only as many polls wait
+at a time as leave `RESERVED_THREADS` threads for other requests; see
+`configure_event_bus`.
+
+The bus lives in the memory of one process, so it assumes that Senex is served
+by a single (multi-threaded) process, as the shipped waitress configurations
+do. Behind several processes, clients would miss the events of the processes
+that they do not happen to poll; the db-backed job states are always correct,
+though, and are what a client reloads on a reset.
+
+"""
+
+import collections
+import ConfigParser
+import threading
+import time
+from uuid import uuid4
+
+import transaction
+
+# The number of most recent events that are kept for clients to catch up on.
+EVENT_BUFFER = 500
+
+# The longest (in seconds) that a long poll waits for an event.
+LONG_POLL_TIMEOUT = 25
+
+# Waitress's default number of threads.
+DEFAULT_SERVER_THREADS = 4
+
+# The number of the server's threads that are kept free of long polls for the
+# other requests (pages, logins, job submissions, static files).
+RESERVED_THREADS = 2
+
+# Each waiting long poll holds a server thread, so at most this many polls
+# wait at a time; the others return right away and are told to back off. Set
+# from the server's thread count by `configure_event_bus`.
+MAX_WAITERS = DEFAULT_SERVER_THREADS - RESERVED_THREADS
+
+# How long (in milliseconds) a client that was not allowed to wait should wait
+# before polling again.
+BACKOFF = 5000
+
+
+class EventBus(object):
+    """A versioned buffer of events that threads can wait on.
+
+    """
+
+    def __init__(self, size=EVENT_BUFFER, max_waiters=MAX_WAITERS):
+        self.condition = threading.Condition()
+        self.epoch = uuid4().hex[:8]
+        self.version = 0
+        self.events = collections.deque(maxlen=size)
+        self.max_waiters = max_waiters
+        self.waiters = 0
+
+    def cursor(self):
+        return '%s-%s' % (self.epoch, self.version)
+
+    def parse_cursor(self, cursor):
+        """Return the version that `cursor` points to, or `None` if the events
+        after it cannot be replayed.
+
+        """
+
+        try:
+            epoch, version = cursor.split('-')
+            version = int(version)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or version > self.version:
+            return None
+        oldest = self.events[0]['version'] if self.events else self.version + 1
+        if version < oldest - 1:
+            return None
+        return version
+
+    def publish(self, type, **data):
+        """Add an event of `type` with `data` and wake up the waiting polls.
+
+        """
+
+        with self.condition:
+            self.version += 1
+            event = {'version': self.version, 'type': type, 'data': data,
+                     'time': time.time()}
+            self.events.append(event)
+            self.condition.notify_all()
+        return event
+
+    def since(self, version):
+        return [event for event in self.events if event['version'] > version]
+
+    def wait(self, cursor, timeout=LONG_POLL_TIMEOUT):
+        """Wait for up to `timeout` seconds for events after `cursor` and return
+        a dict with the new `cursor`, the `events` (possibly none), whether the
+        client must `reset` and how long (in milliseconds) it should wait
+        before polling again (`retry`). Return without waiting if there are
+        events already, if the client must reset or if `max_waiters` polls are
+        waiting; in the last case, the client is told to back off.
+
+        """
+
+        with self.condition:
+            version = self.parse_cursor(cursor)
+            if version is not None and version == self.version:
+                if self.waiters >= self.max_waiters:
+                    return {'cursor': cursor, 'events': [], 'reset': False,
+                            'retry': BACKOFF}
+                self.waiters += 1
+                try:
+                    deadline = time.time() + timeout
+                    while version == self.version:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiters -= 1
+                version = self.parse_cursor(cursor)
+            if version is None:
+                return {'cursor': self.cursor(), 'events': [], 'reset': True,
+                        'retry': 0}
+            return {'cursor': self.cursor(), 'events': self.since(version),
+                    'reset': False, 'retry': 0}
+
+
+# The process-wide event bus.
+event_bus = EventBus()
+
+
+def publish(type, **data):
+    return event_bus.publish(type, **data)
+
+
+def publish_on_commit(type, **data):
+    """Publish an event of `type` with `data` as soon as the current request's
+    transaction is committed, so that clients never hear of changes that are
+    rolled back.
+
+    """
+
+    def publish_event(committed):
+        if committed:
+            event_bus.publish(type, **data)
+    transaction.get().addAfterCommitHook(publish_event)
+
+
+def get_server_threads(config_file):
+    """Return the number of threads that the waitress server configured in the
+    [server:main] section of the PasteDeploy `config_file` runs, or
+    waitress's default if it is not configured.
+
+    """
+
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read(config_file)
+        return int(parser.get('server:main', 'threads'))
+    except (ConfigParser.Error, TypeError, ValueError):
+        return DEFAULT_SERVER_THREADS
+
+
+def configure_event_bus(settings, config_file=None):
+    """Set how many long polls may wait at a time: the app setting
+    `senex.events.max_waiters`, if present, or else the number of the server's
+    threads (read from `config_file`) less `RESERVED_THREADS`, but at least
+    one. Called in :func:`senex.main`.
+
+    """
+
+    if settings.get('senex.events.max_waiters'):
+        max_waiters = int(settings['senex.events.max_waiters'])
+    else:
+        max_waiters = get_server_threads(config_file) - RESERVED_THREADS
+    event_bus.max_waiters = max(max_waiters, 1)
+    return event_bus.max_waiters
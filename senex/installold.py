@@ -25,8 +25,10 @@ To install the OLD on your Ubuntu (or Debian?) server, run::
 
     $ ./installold.py
 
-All downloaded source will be saved to ./tmp/. All stdout and stderr will be
-saved to .log files in ./log/.
+Downloaded source archives are cached in ~/.senex/artifacts/ (see
+--artifact-cache-dir) and unpacked in ./tmp/ while they are downloaded; with
+--mirror-dir, archives are taken from a local directory instead of being
+downloaded. All stdout and stderr will be saved to .log files in ./log/.
 
 
 Summary
@@ -36,6 +38,19 @@ This tool installs the OLD in a Python virtual environment in ~/env/. It also
 attempts to install PIL, FFmpeg, foma, and MITLM. Outputs to stdout and stderr
 are combined and saved to descriptively named .log files in ./log/.
 
+The installation steps form a dependency graph (see `get_install_steps`) and
+steps that do not depend on one another (e.g., building MITLM and building m4,
+bison and foma) run concurrently. Calls to apt-get are serialized, and how many
+steps compile at once is capped by the number of CPUs and the available
+memory. The time taken, and the total time of the steps (an estimate of how
+long they would have taken one after the other), is saved to
+./log/install-timings.log.
+
+The apt packages that the steps need are installed up front, in a single
+apt-get transaction. The packages of steps whose product is already installed,
+the ones that dpkg's status file says are already installed and the ones that
+apt has no install candidate for are left out; see `install_apt_packages`.
+
 Listed below is a series of shell commands that you could execute manually and,
 if all works, you should have the same result as running this script.::
 
@@ -97,17 +112,20 @@ import re
 import os
 import sys
 import shutil
-import urllib
 import optparse
 import getpass
 import pprint
 import json
 import datetime
-import tarfile
 import platform
+import threading
+import time
+import multiprocessing
 from subprocess import Popen, PIPE, STDOUT
 
+from artifacts import Artifact, ArtifactCache, DownloadError, read_checksums
 from buildold import create_directory_safely
+from sysindex import which, package_installed
 
 # ANSI escape sequences for formatting command-line output.
 ANSI_HEADER = '\033[95m'
@@ -119,37 +137,151 @@ ANSI_ENDC = '\033[0m'
 ANSI_BOLD = '\033[1m'
 ANSI_UNDERLINE = '\033[4m'
 
+# apt and dpkg hold a lock on the package database, so only one apt-get may run
+# at a time. Every apt-get is run while holding this lock, which lets
+# installation steps that install packages run concurrently.
+APT_LOCK = threading.Lock()
+
+# The most installation steps that are run at the same time; how many of those
+# may be compiling at the same time is capped further by
+# `get_compile_concurrency`.
+MAX_PARALLEL_STEPS = 8
+
+# The memory (in bytes) that one compiling step is assumed to need.
+RAM_PER_COMPILE = 512 * 1024 * 1024
+
+# The source archives that the installer builds from. An archive is pinned by
+# giving its `Artifact` a `sha256` or by listing it in a SHA256SUMS file in the
+# mirror directory or passed with --checksums; an archive that is not pinned
+# is verified against the digest of its first complete download. See
+# :mod:`artifacts`.
+ARTIFACTS = {
+    'PIL': Artifact('Imaging-1.1.7.tar.gz',
+                    'http://effbot.org/downloads/Imaging-1.1.7.tar.gz'),
+    'm4': Artifact('m4-1.4.10.tar.gz',
+                   'ftp://ftp.gnu.org/gnu/m4/m4-1.4.10.tar.gz'),
+    'bison': Artifact('bison-2.3.tar.gz',
+                      'http://ftp.gnu.org/gnu/bison/bison-2.3.tar.gz'),
+    'MITLM': Artifact('mitlm-0.4.1.tar.gz',
+                      'https://mitlm.googlecode.com/files/mitlm-0.4.1.tar.gz')
+}
+
+# The cache that the source archives are fetched through. It is replaced by
+# `configure_artifact_cache`.
+artifact_cache = ArtifactCache()
+
 
 # Utils
 ################################################################################
 
-def shell(cmd_list, cwd=None):
+class ShellTimeout(Exception):
+    """Raised by `shell` when a command is killed because it timed out. What
+    the command wrote before being killed is in `output`.
+
+    """
+
+    def __init__(self, cmd_list, timeout, output):
+        Exception.__init__(self, '`%s` timed out after %s seconds.' % (
+            ' '.join(cmd_list), timeout))
+        self.output = output
+
+
+def shell(cmd_list, cwd=None, timeout=None, env=None):
     """Execute `cmd_list` as a shell command, pipe stderr to stdout and return
-    stdout. Specify the dir where the command should be run in `cwd`.
+    stdout. Specify the dir where the command should be run in `cwd` and the
+    environment that it should be run in in `env` (by default, ours). If
+    `timeout` (in seconds) is given, the process is killed if it has not
+    finished by then and `ShellTimeout` is raised.
 
     """
 
-    sp = Popen(cmd_list, cwd=cwd, stdout=PIPE, stderr=STDOUT)
-    stdout, nothing = sp.communicate()
+    sp = Popen(cmd_list, cwd=cwd, stdout=PIPE, stderr=STDOUT, env=env)
+    timer = None
+    killed = []
+    if timeout:
+        def kill():
+            killed.append(True)
+            kill_process(sp)
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        stdout, nothing = sp.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if killed:
+        raise ShellTimeout(cmd_list, timeout, stdout)
     return stdout
 
 
+def extend_path(*dirs):
+    """Return a copy of our environment whose PATH also includes `dirs`. This
+    is passed to `shell` rather than changing our own environment, which the
+    concurrently running installation steps share.
+
+    """
+
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([env.get('PATH', '')] + list(dirs))
+    return env
+
+
+def read_meminfo(path='/proc/meminfo'):
+    """Return the fields of /proc/meminfo as a dict from field names (e.g.,
+    'MemTotal') to byte counts.
+
+    """
+
+    meminfo = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                key, value = line.split(':', 1)
+                parts = value.split()
+                num = int(parts[0])
+            except (ValueError, IndexError):
+                continue
+            if len(parts) > 1 and parts[1] == 'kB':
+                num *= 1024
+            meminfo[key.strip()] = num
+    return meminfo
+
+
+def kill_process(sp):
+    """Kill the subprocess `sp`, ignoring the error raised if it has already
+    exited.
+
+    """
+
+    try:
+        sp.kill()
+    except OSError:
+        pass
+
+
 def aptgetupdate():
     """Run `sudo apt-get update`
 
     """
 
     if get_linux_id() == 'Ubuntu':
-        shell(['sudo', 'apt-get', '-y', 'update'])
+        with APT_LOCK:
+            shell(['sudo', 'apt-get', '-y', 'update'])
 
 
 def aptget(lib_list):
-    """Run `sudo apt-get -y install` on the libraries in `lib_list`. The -y
-    option answers 'y' to interactive prompts.
+    """Run `sudo apt-get -y install` on the libraries in `lib_list` that are
+    not installed yet. The -y option answers 'y' to interactive prompts. Which
+    packages are installed is looked up in the dpkg status index, so if they
+    all are, nothing is run and an empty string is returned.
 
     """
 
-    return shell(['sudo', 'apt-get', '-y', 'install'] + lib_list)
+    missing = [lib for lib in lib_list if not package_installed(lib)]
+    if not missing:
+        return ''
+    with APT_LOCK:
+        return shell(['sudo', 'apt-get', '-y', 'install'] + missing)
 
 
 def flush(string):
@@ -194,47 +326,61 @@ def clear_tmp():
                 os.remove(path)
 
 
-def which(program):
-    """Return the path to `program` if it is an executable; otherwise return
-    `None`. From
-    http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python.
+def read_os_release():
+    """Return a dict describing the Linux distribution, with `NAME`, `ID` and
+    `VERSION_ID` keys, read from /etc/os-release. Older distributions (e.g.,
+    Ubuntu 10.04) do not have that file, so we fall back to the equivalent
+    values in /etc/lsb-release. Nothing is forked.
 
     """
 
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+    os_release = parse_key_value_file('/etc/os-release')
+    if os_release:
+        return os_release
+    lsb_release = parse_key_value_file('/etc/lsb-release')
+    return {
+        'NAME': lsb_release.get('DISTRIB_ID', ''),
+        'ID': lsb_release.get('DISTRIB_ID', '').lower(),
+        'VERSION_ID': lsb_release.get('DISTRIB_RELEASE', '')
+    }
 
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
 
-    return None
+def parse_key_value_file(path):
+    """Return the KEY=value lines of the shell-style file at `path` as a dict,
+    or an empty dict if there is no such file.
+
+    """
+
+    result = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                result[key.strip()] = value.strip().strip('"\'')
+    except IOError:
+        pass
+    return result
 
 
 def get_linux_id():
-    return shell(['lsb_release', '-is']).strip()
+    """Return the name of the Linux distribution, e.g., 'Ubuntu', as
+    `lsb_release -is` would.
 
+    """
 
-def get_linux_release():
-    return shell(['lsb_release', '-rs']).strip()
+    return read_os_release().get('NAME', '').replace(' GNU/Linux', '')
 
 
-def library_installed(name):
-    """Return `True` if the Linux library identifiable by `name` is installed.
+def get_linux_release():
+    """Return the release of the Linux distribution, e.g., '14.04', as
+    `lsb_release -rs` would.
 
     """
 
-    stdout = shell(['ldconfig', '-p', '|', 'grep', name])
-    if stdout.strip():
-        return True
-    return False
+    return read_os_release().get('VERSION_ID', '')
 
 
 def add_optparser_options(parser):
@@ -247,6 +393,22 @@ def add_optparser_options(parser):
         help="The name of the virtual environment directory that the OLD"
             " is/will be installed in (in your home directory). Defaults"
             " to 'env'.")
+    parser.add_option("--artifact-cache-dir", dest="artifact_cache_dir",
+        metavar="ARTIFACT_CACHE_DIR",
+        help="The directory where downloaded source archives are cached."
+            " Defaults to ~/.senex/artifacts.")
+    parser.add_option("--mirror-dir", dest="mirror_dir",
+        metavar="MIRROR_DIR",
+        help="A local directory of source archives that is looked in before"
+            " anything is downloaded.")
+    parser.add_option("--checksums", dest="checksums_file",
+        metavar="CHECKSUMS_FILE",
+        help="A file of SHA-256 checksums of source archives, in the format"
+            " of sha256sum, that the archives are verified against.")
+    parser.add_option("--offline", dest="offline", action="store_true",
+        default=False,
+        help="Do not download anything: use only cached and mirrored source"
+            " archives.")
 
 
 def get_params():
@@ -260,11 +422,48 @@ def get_params():
     add_optparser_options(parser)
     (options, args) = parser.parse_args()
     params = {
-        'env_dir': options.env_dir or 'env-old'
+        'env_dir': options.env_dir or 'env-old',
+        'artifact_cache_dir': options.artifact_cache_dir,
+        'mirror_dir': options.mirror_dir,
+        'offline': options.offline,
+        'checksums_file': options.checksums_file
     }
     return params
 
 
+def configure_artifact_cache(params):
+    """Replace the cache that source archives are fetched through with one
+    configured by the `artifact_cache_dir`, `mirror_dir`, `offline` and
+    `checksums_file` params, if present.
+
+    """
+
+    global artifact_cache
+    checksums = None
+    if params.get('checksums_file'):
+        checksums = read_checksums(params['checksums_file'])
+    artifact_cache = ArtifactCache(params.get('artifact_cache_dir'),
+                                   params.get('mirror_dir'),
+                                   params.get('offline', False),
+                                   checksums)
+    return artifact_cache
+
+
+def extract_source(name):
+    """Extract the source archive `name` (a key of `ARTIFACTS`) into the tmp
+    directory while it is fetched and verified. Return the path to its cached
+    copy, or print why it could not be extracted and return `None`.
+
+    """
+
+    try:
+        return artifact_cache.extract(ARTIFACTS[name], get_tmp_path())
+    except DownloadError, e:
+        print ('%sUnable to download %s: %s Aborting.%s' % (ANSI_FAIL, name,
+            e, ANSI_ENDC))
+        return None
+
+
 def get_home():
     """Return an absolute path to the user's home directory.
 
@@ -324,18 +523,133 @@ def get_log_path():
 # Installed Checkers
 ################################################################################
 
-def old_installed(params):
-    """Return `True` if OLD is installed in ~/env/.
+# The Python modules in the OLD's virtual environment that we care about, each
+# paired with the module attributes where its version may be found, in order of
+# preference.
+ENV_MODULES = [
+    ('onlinelinguisticdatabase', ['__version__']),
+    ('MySQLdb', ['__version__']),
+    ('importlib', []),
+    ('Image', ['VERSION']),
+    ('PIL', ['VERSION', '__version__']),
+    ('PIL.Image', [])
+]
+
+
+def get_env_probe_script():
+    """Return the source of the script that `inspect_env` runs in the virtual
+    environment's Python. It tries to import each module in `ENV_MODULES` and
+    prints a JSON object mapping module names to objects with `installed` and
+    `version` keys. It must run under any Python that the OLD can use.
 
     """
 
+    return ("""
+import json
+result = {}
+for name, attrs in %s:
+    try:
+        module = __import__(name, fromlist=['__name__'])
+    except Exception:
+        result[name] = {'installed': False, 'version': ''}
+        continue
+    version = ''
+    for attr in attrs:
+        version = getattr(module, attr, '')
+        if version:
+            break
+    result[name] = {'installed': True, 'version': str(version)}
+print(json.dumps(result))
+""" % json.dumps(ENV_MODULES)).strip()
+
+
+def inspect_env(params):
+    """Return a dict mapping each module name in `ENV_MODULES` to a dict with
+    `installed` and `version` keys, describing the Python modules installed in
+    the virtual environment. A single Python interpreter is started in order
+    to introspect all of the modules. Raise `ShellTimeout` if it hangs.
+
+    """
+
+    result = dict((name, {'installed': False, 'version': ''})
+                  for name, attrs in ENV_MODULES)
     python_path = get_python_path(params)
     if not os.path.isfile(python_path):
-        return False
-    stdout = shell([python_path, '-c', 'import onlinelinguisticdatabase'])
-    if stdout.strip():
-        return False
-    return True
+        return result
+    stdout = shell([python_path, '-c', get_env_probe_script()], timeout=60)
+    # Modules may print warnings when imported, so we only parse the last line.
+    lines = [line for line in stdout.splitlines() if line.strip()]
+    try:
+        result.update(json.loads(lines[-1]))
+    except (IndexError, ValueError):
+        pass
+    return result
+
+
+def env_pil_installed(env_modules):
+    """Return `True` if the `inspect_env` result `env_modules` shows PIL (or
+    Pillow) to be installed.
+
+    """
+
+    return (env_modules['Image']['installed'] or
+            env_modules['PIL.Image']['installed'])
+
+
+def env_pil_version(env_modules):
+    """Return the version of PIL (or Pillow) in the `inspect_env` result
+    `env_modules`.
+
+    """
+
+    return (env_modules['Image']['version'] or
+            env_modules['PIL']['version'])
+
+
+# The most recent `inspect_env` result for each virtual environment (keyed by
+# the path of its Python), which the installation steps' checks share until
+# something is installed into the environment. See `get_env_modules`.
+env_modules_cache = {}
+env_modules_lock = threading.Lock()
+
+
+def get_env_modules(params):
+    """Return `inspect_env(params)`, reusing the previous result for the same
+    virtual environment unless `forget_env_modules` has been called since, so
+    that the installer does not start a Python interpreter for every check.
+
+    """
+
+    python_path = get_python_path(params)
+    with env_modules_lock:
+        if python_path not in env_modules_cache:
+            try:
+                env_modules_cache[python_path] = inspect_env(params)
+            except ShellTimeout, e:
+                # Treat the modules as missing, but inspect them again next
+                # time.
+                print '%s%s%s' % (ANSI_WARNING, e, ANSI_ENDC)
+                return dict((name, {'installed': False, 'version': ''})
+                            for name, attrs in ENV_MODULES)
+        return env_modules_cache[python_path]
+
+
+def forget_env_modules(params):
+    """Forget the `inspect_env` result for the virtual environment of `params`.
+    Called whenever something is installed into the environment.
+
+    """
+
+    with env_modules_lock:
+        env_modules_cache.pop(get_python_path(params), None)
+
+
+def old_installed(params):
+    """Return `True` if OLD is installed in ~/env/.
+
+    """
+
+    return get_env_modules(params)['onlinelinguisticdatabase']['installed']
 
 
 def importlib_installed(params):
@@ -343,13 +657,7 @@ def importlib_installed(params):
 
     """
 
-    python_path = get_python_path(params)
-    if not os.path.isfile(python_path):
-        return False
-    stdout = shell([python_path, '-c', 'import importlib'])
-    if stdout.strip():
-        return False
-    return True
+    return get_env_modules(params)['importlib']['installed']
 
 
 def mysql_python_installed(params):
@@ -357,13 +665,7 @@ def mysql_python_installed(params):
 
     """
 
-    python_path = get_python_path(params)
-    if not os.path.isfile(python_path):
-        return False
-    stdout = shell([python_path, '-c', 'import MySQLdb'])
-    if stdout.strip():
-        return False
-    return True
+    return get_env_modules(params)['MySQLdb']['installed']
 
 
 def pil_installed(params):
@@ -371,17 +673,7 @@ def pil_installed(params):
 
     """
 
-    python_path = get_python_path(params)
-    if not os.path.isfile(python_path):
-        return False
-    if (platform.system() == 'Linux' and get_linux_id() == 'Ubuntu' and
-            get_linux_release() == '14.04'):
-        stdout = shell([python_path, '-c', 'from PIL import Image'])
-    else:
-        stdout = shell([python_path, '-c', 'import Image'])
-    if stdout.strip():
-        return False
-    return True
+    return env_pil_installed(get_env_modules(params))
 
 
 # Installers
@@ -457,6 +749,7 @@ def create_env(params):
         return
     flush('Creating a virtual environment in %s ...' % path)
     stdout = shell(['virtualenv', '--no-site-packages', path])
+    forget_env_modules(params)
     log('create-env.log', stdout)
     if os.path.isfile(os.path.join(path, 'bin', 'python')):
         print 'Done.'
@@ -475,6 +768,7 @@ def install_old(params):
         return
     flush('Installing OLD ...')
     stdout = shell([get_easy_install_path(params), 'onlinelinguisticdatabase'])
+    forget_env_modules(params)
     log('install-old.log', stdout)
     if old_installed(params):
         print 'Done.'
@@ -482,6 +776,9 @@ def install_old(params):
         sys.exit('%sFailed to install the OLD.%s' % (ANSI_FAIL, ANSI_ENDC))
 
 
+MYSQL_PYTHON_DEPENDENCIES = ['libmysqlclient-dev', 'python-dev']
+
+
 def install_mysql_python(params):
     """Method::
 
@@ -494,8 +791,9 @@ def install_mysql_python(params):
         print 'MySQL-python is already installed.'
         return
     flush('Installing MySQL-python ...')
-    aptget(['libmysqlclient-dev', 'python-dev'])
+    aptget(MYSQL_PYTHON_DEPENDENCIES)
     stdout = shell([get_easy_install_path(params), 'MySQL-python'])
+    forget_env_modules(params)
     log('install-mysql-python.log', stdout)
     if mysql_python_installed(params):
         print 'Done.'
@@ -514,6 +812,7 @@ def install_importlib(params):
         return
     flush('Installing importlib ...')
     stdout = shell([get_easy_install_path(params), 'importlib'])
+    forget_env_modules(params)
     log('install-importlib.log', stdout)
     if importlib_installed(params):
         print 'Done.'
@@ -522,6 +821,21 @@ def install_importlib(params):
             ANSI_ENDC))
 
 
+def get_PIL_dependencies():
+    """Return the apt packages that PIL (or, on Ubuntu 14.04, Pillow) needs.
+
+    """
+
+    if get_linux_id() == 'Ubuntu' and get_linux_release() == '14.04':
+        return ['python-dev', 'libtiff5-dev', 'libjpeg8-dev', 'zlib1g-dev',
+            'libfreetype6-dev', 'liblcms2-dev', 'libwebp-dev', 'tcl8.6-dev',
+            'tk8.6-dev', 'python-tk']
+    elif get_linux_id() == 'Ubuntu' and get_linux_release() == '12.04':
+        return ['libjpeg-dev', 'libfreetype6', 'libfreetype6-dev',
+            'zlib1g-dev', 'libjpeg8-dev']
+    return ['libjpeg-dev', 'libfreetype6', 'libfreetype6-dev', 'zlib1g-dev']
+
+
 def install_PIL_dependencies():
     """sudo apt-get install libjpeg-dev libfreetype6 libfreetype6-dev zlib1g-dev
 
@@ -533,27 +847,20 @@ def install_PIL_dependencies():
 
     """
 
-    if get_linux_id() == 'Ubuntu' and get_linux_release() == '14.04':
-        stdout = aptget(['python-dev', 'libtiff5-dev', 'libjpeg8-dev',
-            'zlib1g-dev', 'libfreetype6-dev', 'liblcms2-dev', 'libwebp-dev',
-            'tcl8.6-dev', 'tk8.6-dev', 'python-tk'])
-    elif get_linux_id() == 'Ubuntu' and get_linux_release() == '12.04':
-        stdout = aptget(['libjpeg-dev', 'libfreetype6', 'libfreetype6-dev',
-            'zlib1g-dev', 'libjpeg8-dev'])
+    stdout = aptget(get_PIL_dependencies())
+    if get_linux_id() == 'Ubuntu' and get_linux_release() == '12.04':
         shell(['sudo', 'ln', '-s', '/usr/lib/`uname -i`-linux-gnu/libfreetype.so',
             '/usr/lib/'])
         shell(['sudo', 'ln', '-s', '/usr/lib/`uname -i`-linux-gnu/libjpeg.so',
             '/usr/lib/'])
         shell(['sudo', 'ln', '-s', '/usr/lib/`uname -i`-linux-gnu/ligz.so',
             '/usr/lib/'])
-    else:
-        stdout = aptget(['libjpeg-dev', 'libfreetype6', 'libfreetype6-dev',
-            'zlib1g-dev'])
     log('install-PIL-dependencies.log', stdout)
 
 
 def install_Pillow(params):
     stdout = shell([get_easy_install_path(params), 'Pillow'])
+    forget_env_modules(params)
     log('install-Pillow.log', stdout)
 
 
@@ -579,17 +886,9 @@ def install_PIL(params):
     if get_linux_id() == 'Ubuntu' and get_linux_release() == '14.04':
         install_Pillow(params)
     else:
-        pilpath = os.path.join(get_tmp_path(), 'Imaging-1.1.7.tar.gz')
         pildirpath = os.path.join(get_tmp_path(), 'Imaging-1.1.7')
-        fname, headers = urllib.urlretrieve(
-            'http://effbot.org/downloads/Imaging-1.1.7.tar.gz', pilpath)
-        if not os.path.isfile(pilpath):
-            print ('%sUnable to download PIL. Aborting.%s' % (ANSI_FAIL,
-                ANSI_ENDC))
+        if not extract_source('PIL'):
             return
-        tar = tarfile.open(pilpath, mode='r:gz')
-        tar.extractall(path=get_tmp_path())
-        tar.close()
         if not os.path.isdir(pildirpath):
             print ('%sUnable to extract PIL. Aborting.%s' % (ANSI_FAIL,
                 ANSI_ENDC))
@@ -603,6 +902,7 @@ def install_PIL(params):
         logtext.append(stdout)
         stdout = shell([get_python_path(params), 'setup.py', 'install'],
             pildirpath)
+        forget_env_modules(params)
         logtext.append(stdout)
         log('install-PIL.log', '\n'.join(logtext))
     if pil_installed(params):
@@ -674,14 +974,17 @@ def test_PIL(params):
         print 'No tests possible: PIL not installed'
 
 
+FFMPEG_DEPENDENCIES = ['libavcodec-extra-52', 'libavdevice-extra-52',
+    'libavfilter-extra-0', 'libavformat-extra-52', 'libavutil-extra-49',
+    'libpostproc-extra-51', 'libswscale-extra-0']
+
+
 def install_FFmpeg_dependencies():
     """sudo apt-get -y install libavcodec-extra-52 libavdevice-extra-52 libavfilter-extra-0 libavformat-extra-52 libavutil-extra-49 libpostproc-extra-51 libswscale-extra-0
 
     """
 
-    stdout = aptget(['libavcodec-extra-52', 'libavdevice-extra-52',
-        'libavfilter-extra-0', 'libavformat-extra-52', 'libavutil-extra-49',
-        'libpostproc-extra-51', 'libswscale-extra-0'])
+    stdout = aptget(FFMPEG_DEPENDENCIES)
     log('install-ffmpeg-dependencies.log', stdout)
 
 
@@ -695,8 +998,10 @@ def install_FFmpeg():
         return
     flush('Installing FFmpeg ...')
     if get_linux_id() == 'Ubuntu' and get_linux_release() == '14.04':
-        shell(['sudo', 'add-apt-repository', '-y', 'ppa:mc3man/trusty-media'])
-        shell(['sudo', 'apt-get', '-y', 'update'])
+        with APT_LOCK:
+            shell(['sudo', 'add-apt-repository', '-y',
+                   'ppa:mc3man/trusty-media'])
+            shell(['sudo', 'apt-get', '-y', 'update'])
     else:
         install_FFmpeg_dependencies()
     stdout = aptget(['ffmpeg'])
@@ -757,17 +1062,9 @@ def install_m4():
         print 'm4 is already installed.'
         return
     flush('Installing m4 ...')
-    m4path = os.path.join(get_tmp_path(), 'm4-1.4.10.tar.gz')
     m4dirpath = os.path.join(get_tmp_path(), 'm4-1.4.10')
-    fname, headers = urllib.urlretrieve(
-        'ftp://ftp.gnu.org/gnu/m4/m4-1.4.10.tar.gz', m4path)
-    if not os.path.isfile(m4path):
-        print ('%sUnable to download m4. Aborting.%s' % (ANSI_FAIL,
-            ANSI_ENDC))
+    if not extract_source('m4'):
         return
-    tar = tarfile.open(m4path, mode='r:gz')
-    tar.extractall(path=get_tmp_path())
-    tar.close()
     if not os.path.isdir(m4dirpath):
         print ('%sUnable to extract m4. Aborting.%s' % (ANSI_FAIL,
             ANSI_ENDC))
@@ -805,29 +1102,22 @@ def install_bison():
         print 'bison is already installed.'
         return
     flush('Installing bison ...')
-    bisonpath = os.path.join(get_tmp_path(), 'bison-2.3.tar.gz')
     bisondirpath = os.path.join(get_tmp_path(), 'bison-2.3')
-    fname, headers = urllib.urlretrieve(
-        'http://ftp.gnu.org/gnu/bison/bison-2.3.tar.gz', bisonpath)
-    if not os.path.isfile(bisonpath):
-        print ('%sUnable to download bison. Aborting.%s' % (ANSI_FAIL,
-            ANSI_ENDC))
+    if not extract_source('bison'):
         return
-    tar = tarfile.open(bisonpath, mode='r:gz')
-    tar.extractall(path=get_tmp_path())
-    tar.close()
     if not os.path.isdir(bisondirpath):
         print ('%sUnable to extract bison. Aborting.%s' % (ANSI_FAIL,
             ANSI_ENDC))
         return
-    os.environ["PATH"] += os.pathsep + '/usr/local/m4/bin/'
+    env = extend_path('/usr/local/m4/bin/')
     logtext = ['./configure run in bison\n\n']
-    stdout = shell(['./configure', '--prefix=/usr/local/bison'], bisondirpath)
+    stdout = shell(['./configure', '--prefix=/usr/local/bison'], bisondirpath,
+                   env=env)
     logtext.append(stdout)
-    stdout = shell(['make'], bisondirpath)
+    stdout = shell(['make'], bisondirpath, env=env)
     logtext.append('\n\n`make` run in bison\n\n')
     logtext.append(stdout)
-    stdout = shell(['sudo', 'make', 'install'], bisondirpath)
+    stdout = shell(['sudo', 'make', 'install'], bisondirpath, env=env)
     logtext.append('\n\n`sudo make install` run in bison\n\n')
     logtext.append(stdout)
     log('install-bison.log', '\n'.join(logtext))
@@ -871,6 +1161,9 @@ def install_subversion():
         print 'Failed.'
 
 
+FOMA_DEPENDENCIES = ['libreadline6', 'libreadline6-dev']
+
+
 def install_foma():
     """Method::
 
@@ -901,18 +1194,18 @@ def install_foma():
         return
     bisondir = '/usr/local/bison/bin/'
     if os.path.isdir(bisondir):
-        os.environ["PATH"] += os.pathsep + bisondir
+        env = extend_path(bisondir)
     else:
         print ('%sbison is not installed. Aborting.%s' % (ANSI_FAIL,
             ANSI_ENDC))
         return
-    stdout = aptget(['libreadline6', 'libreadline6-dev'])
+    stdout = aptget(FOMA_DEPENDENCIES)
     logtext.append('\n\nInstalling libreadline6 and libreadline6-dev\n\n')
     logtext.append(stdout)
-    stdout = shell(['make'], fomadir)
+    stdout = shell(['make'], fomadir, env=env)
     logtext.append('\n\nRunning `make` in foma\n\n')
     logtext.append(stdout)
-    stdout = shell(['sudo', 'make', 'install'], fomadir)
+    stdout = shell(['sudo', 'make', 'install'], fomadir, env=env)
     logtext.append('\n\nRunning `sudo make install` in foma\n\n')
     logtext.append(stdout)
     if which('foma') and which('flookup'):
@@ -921,6 +1214,9 @@ def install_foma():
         print 'Failed.'
 
 
+MITLM_DEPENDENCIES = ['g++', 'autoconf', 'automake', 'libtool', 'gfortran']
+
+
 def install_mitlm():
     """Method::
 
@@ -939,19 +1235,11 @@ def install_mitlm():
         print 'MITLM is already installed.'
         return
     flush('Installing MITLM ...')
-    stdout = aptget(['g++', 'autoconf', 'automake', 'libtool', 'gfortran'])
+    stdout = aptget(MITLM_DEPENDENCIES)
     log('install-mitlm-libraries.log', stdout)
-    mitlmpath = os.path.join(get_tmp_path(), 'mitlm-0.4.1.tar.gz')
     mitlmdirpath = os.path.join(get_tmp_path(), 'mitlm-0.4.1')
-    fname, headers = urllib.urlretrieve(
-        'https://mitlm.googlecode.com/files/mitlm-0.4.1.tar.gz', mitlmpath)
-    if not os.path.isfile(mitlmpath):
-        print ('%sUnable to download MITLM. Aborting.%s' % (ANSI_FAIL,
-            ANSI_ENDC))
+    if not extract_source('MITLM'):
         return
-    tar = tarfile.open(mitlmpath, mode='r:gz')
-    tar.extractall(path=get_tmp_path())
-    tar.close()
     if not os.path.isdir(mitlmdirpath):
         print ('%sUnable to extract MITLM. Aborting.%s' % (ANSI_FAIL,
             ANSI_ENDC))
@@ -985,8 +1273,334 @@ def install_libmagic():
     print 'Done.'
 
 
-def install(params):
-    """Install the OLD and all of its dependencies.
+# Step scheduling
+################################################################################
+
+class InstallStep(object):
+    """An installation step: a callable with its arguments, the names of the
+    steps that must have finished before it can start and whether it compiles
+    source code.
+
+    """
+
+    def __init__(self, func, args=(), requires=(), compiles=False):
+        self.name = func.__name__
+        self.func = func
+        self.args = args
+        self.requires = requires
+        self.compiles = compiles
+
+    def __call__(self):
+        return self.func(*self.args)
+
+    def __repr__(self):
+        return '<InstallStep %s>' % self.name
+
+
+def get_available_memory():
+    """Return the memory (in bytes) that is available for starting new
+    processes without swapping, as reported by /proc/meminfo, or `None` if it
+    cannot be determined.
+
+    """
+
+    try:
+        meminfo = read_meminfo()
+    except IOError:
+        return None
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    # Kernels before 3.14 do not report MemAvailable.
+    try:
+        return sum(meminfo[key] for key in ('MemFree', 'Buffers', 'Cached'))
+    except KeyError:
+        return None
+
+
+def get_compile_concurrency():
+    """Return how many steps may compile at the same time: one per CPU, as long
+    as each can have `RAM_PER_COMPILE` of the available memory, and at least
+    one.
+
+    """
+
+    try:
+        concurrency = multiprocessing.cpu_count()
+    except NotImplementedError:
+        concurrency = 1
+    memory = get_available_memory()
+    if memory is not None:
+        concurrency = min(concurrency, memory // RAM_PER_COMPILE)
+    return max(int(concurrency), 1)
+
+
+def run_steps(steps, progress=None, max_workers=MAX_PARALLEL_STEPS,
+              compile_concurrency=None):
+    """Run `steps`, a list of `InstallStep`s that form a dependency graph, each
+    in a thread of its own as soon as the steps that it requires have
+    finished. At most `max_workers` steps run at a time, and at most
+    `compile_concurrency` (by default, `get_compile_concurrency()`) of those
+    compile. If `progress` is given, it is called with the name of each step
+    as the step starts.
+
+    If a step raises an error (including `SystemExit`), no further steps are
+    started and the error is re-raised once the running steps have finished.
+    Return a dict from step names to how long (in seconds) they ran for.
+
+    """
+
+    names = set(step.name for step in steps)
+    for step in steps:
+        for required in step.requires:
+            if required not in names:
+                raise ValueError('Step %s requires unknown step %s.' % (
+                    step.name, required))
+    compile_slots = threading.Semaphore(
+        compile_concurrency or get_compile_concurrency())
+    condition = threading.Condition()
+    pending = list(steps)
+    running = set()
+    finished = set()
+    errors = []
+    timings = {}
+
+    def run(step):
+        start = time.time()
+        error = None
+        try:
+            if step.compiles:
+                with compile_slots:
+                    step()
+            else:
+                step()
+        except (Exception, SystemExit):
+            error = sys.exc_info()
+        finally:
+            with condition:
+                timings[step.name] = time.time() - start
+                running.discard(step.name)
+                if error:
+                    errors.append(error)
+                else:
+                    finished.add(step.name)
+                condition.notify_all()
+
+    while True:
+        with condition:
+            ready = []
+            while not ready:
+                if not errors:
+                    ready = [step for step in pending if all(
+                        required in finished for required in step.requires)]
+                    ready = ready[:max(max_workers - len(running), 0)]
+                if ready or not running:
+                    break
+                condition.wait()
+            for step in ready:
+                pending.remove(step)
+                running.add(step.name)
+        if not ready:
+            break
+        # `progress` may be slow (e.g., it may write to the db), so it is
+        # called without holding the lock that the running steps need.
+        for step in ready:
+            if progress:
+                progress(step.name)
+            thread = threading.Thread(target=run, args=(step,),
+                                      name='install-%s' % step.name)
+            thread.setDaemon(True)
+            thread.start()
+    if errors:
+        error_type, error, tb = errors[0]
+        raise error_type, error, tb
+    if pending:
+        raise ValueError('The requirements of steps %s cannot be met.' %
+                         ', '.join(step.name for step in pending))
+    return timings
+
+
+def get_apt_requirements(params):
+    """Return a dict from the names of the installation steps that have yet to
+    install their product (e.g., the MITLM executables) to the apt packages
+    that they install. The packages of a step whose product is installed are
+    not needed.
+
+    """
+
+    if get_linux_id() == 'Ubuntu' and get_linux_release() == '14.04':
+        # On 14.04, FFmpeg comes from a PPA that `install_FFmpeg` adds, so it
+        # cannot be planned for.
+        ffmpeg = []
+    else:
+        ffmpeg = FFMPEG_DEPENDENCIES + ['ffmpeg']
+    # Each step, the check of whether its product is installed (the same
+    # check that the step starts with) and its packages.
+    requirements = [
+        ('install_easy_install', lambda: which('easy_install'),
+         ['python-setuptools']),
+        ('install_mysql_python', lambda: mysql_python_installed(params),
+         MYSQL_PYTHON_DEPENDENCIES),
+        ('install_PIL', lambda: pil_installed(params),
+         get_PIL_dependencies()),
+        ('install_FFmpeg', lambda: which('ffmpeg'), ffmpeg),
+        ('install_flex', lambda: which('flex'), ['flex']),
+        ('install_subversion', lambda: which('svn'), ['subversion']),
+        ('install_foma', lambda: which('foma') and which('flookup'),
+         FOMA_DEPENDENCIES),
+        ('install_mitlm',
+         lambda: which('estimate-ngram') and which('evaluate-ngram'),
+         MITLM_DEPENDENCIES),
+        ('install_libmagic', lambda: False, ['libmagic-dev'])
+    ]
+    return dict((name, packages) for name, installed, packages in requirements
+                if not installed())
+
+
+def plan_apt_packages(params):
+    """Return the sorted list of the apt packages that the installation steps
+    that have yet to install their product need and that are not installed
+    yet, according to the dpkg status index.
+
+    """
+
+    packages = set()
+    for step_packages in get_apt_requirements(params).values():
+        packages.update(step_packages)
+    return sorted(package for package in packages
+                  if not package_installed(package))
+
+
+def parse_apt_policy(text):
+    """Return the set of names of the packages that apt can install according
+    to `text`, the output of `apt-cache policy`: one stanza per package, headed
+    by the package's name and a colon, whose Candidate line gives the version
+    that would be installed, or "(none)". Packages that apt does not know of
+    get no stanza.
+
+    """
+
+    candidates = set()
+    package = None
+    for line in text.splitlines():
+        if line and not line[0].isspace():
+            package = None
+            if line.endswith(':') and ' ' not in line:
+                package = line[:-1].split(':')[0]
+        elif package and line.strip().startswith('Candidate:'):
+            if line.split(':', 1)[1].strip() != '(none)':
+                candidates.add(package)
+    return candidates
+
+
+def get_install_candidates(packages):
+    """Return the subset of `packages` that apt has an install candidate for,
+    according to its package lists, or all of `packages` if apt-cache is not
+    available to ask.
+
+    """
+
+    if not packages or not which('apt-cache'):
+        return set(packages)
+    stdout = shell(['apt-cache', 'policy'] + list(packages))
+    candidates = parse_apt_policy(stdout)
+    return set(package for package in packages
+               if package.split(':')[0] in candidates)
+
+
+def install_apt_packages(params):
+    """Install every apt package that the installation steps need in a single
+    apt-get transaction, so that the dpkg lock, the resolver and the triggers
+    are paid for once instead of once per step. Packages that apt has no
+    install candidate for in this release are left out, so that they cannot
+    make the whole transaction fail; the steps that need them fail on their
+    own. If the transaction fails nevertheless, the steps install their own
+    packages as before; as they skip the packages that are installed, they do
+    nothing if the transaction succeeded.
+
+    """
+
+    missing = plan_apt_packages(params)
+    if not missing:
+        print 'All apt packages are already installed.'
+        return
+    available = get_install_candidates(missing)
+    unavailable = [package for package in missing
+                   if package not in available]
+    if unavailable:
+        print ('%sThere are no install candidates for %s; they are left out.'
+            '%s' % (ANSI_WARNING, ', '.join(unavailable), ANSI_ENDC))
+    missing = [package for package in missing if package in available]
+    if not missing:
+        return
+    flush('Installing %s apt packages ...' % len(missing))
+    stdout = aptget(missing)
+    log('install-apt-packages.log', stdout)
+    still_missing = [package for package in missing
+                     if not package_installed(package)]
+    if still_missing:
+        print ('%sFailed to install %s in one transaction; they will be'
+            ' installed one step at a time.%s' % (ANSI_WARNING,
+            ', '.join(still_missing), ANSI_ENDC))
+    else:
+        print 'Done.'
+
+
+def get_install_steps(params):
+    """Return the steps of installing the OLD and its dependencies as a list of
+    `InstallStep`s. The OLD and the packages in its virtual environment are
+    installed one after the other, since they all write to the environment;
+    the other dependencies are independent branches.
+
+    """
+
+    return [
+        # All of the apt packages are installed up front, in one transaction;
+        # see `install_apt_packages`.
+        InstallStep(aptgetupdate),
+        InstallStep(install_apt_packages, (params,),
+                    requires=('aptgetupdate',)),
+
+        # Core dependencies: these must be installed in order for the OLD to
+        # be minimally functional.
+        InstallStep(install_easy_install, requires=('install_apt_packages',)),
+        InstallStep(install_virtualenv, requires=('install_easy_install',)),
+        InstallStep(create_env, (params,), requires=('install_virtualenv',)),
+        InstallStep(install_old, (params,), requires=('create_env',)),
+        InstallStep(install_mysql_python, (params,),
+                    requires=('install_old',), compiles=True),
+        InstallStep(install_importlib, (params,),
+                    requires=('install_mysql_python',)),
+
+        # Soft dependencies: failing to install these is ok, but the OLD won't
+        # be fully functional unless all of them are installed.
+        InstallStep(install_PIL, (params,), requires=('install_importlib',),
+                    compiles=True),
+        InstallStep(test_PIL, (params,), requires=('install_PIL',)),
+        InstallStep(install_FFmpeg, requires=('install_apt_packages',)),
+        InstallStep(test_FFmpeg, requires=('install_FFmpeg',)),
+        InstallStep(install_m4, requires=('install_apt_packages',),
+                    compiles=True),
+        InstallStep(install_bison, requires=('install_m4',), compiles=True),
+        InstallStep(install_flex, requires=('install_apt_packages',)),
+        InstallStep(install_subversion, requires=('install_apt_packages',)),
+        InstallStep(install_foma, requires=('install_bison', 'install_flex',
+                                            'install_subversion'),
+                    compiles=True),
+        InstallStep(install_mitlm, requires=('install_apt_packages',),
+                    compiles=True),
+        InstallStep(install_libmagic, requires=('install_apt_packages',))
+    ]
+
+
+def install(params, progress=None):
+    """Install the OLD and all of its dependencies. Independent installation
+    steps run concurrently; see `get_install_steps` and `run_steps`. If
+    `progress` is given, it is called with the name of each installation step
+    (e.g., 'install_foma') as the step starts. Return a dict with the
+    `wall_clock` time that the steps took, the `serial_estimate`, i.e., the
+    sum of the steps' times, which estimates how long they would have taken
+    one after the other (steps that run concurrently slow each other down, so
+    this overestimates), and the time of each step (`steps`).
 
     Someday: install latex/xetex: `sudo apt-get install texlive-xetex`
 
@@ -1000,32 +1614,24 @@ def install(params):
     create_directory_safely(get_log_path())
     clear_log()
     clear_tmp()
+    configure_artifact_cache(params)
+    forget_env_modules(params)
 
     #sys.exit('IN INSTALL OF INSTALLOLD SYS EXIT')
 
-    # Core dependencies: these must be installed in order for the OLD to be
-    # minimally functional.
-    aptgetupdate()
-    install_easy_install()
-    install_virtualenv()
-    create_env(params)
-    install_old(params)
-    install_mysql_python(params)
-    install_importlib(params)
-
-    # Soft dependencies: failing to install these is ok, but the OLD won't be
-    # fully functional unless all of them are installed.
-    install_PIL(params)
-    test_PIL(params)
-    install_FFmpeg()
-    test_FFmpeg()
-    install_m4()
-    install_bison()
-    install_flex()
-    install_subversion()
-    install_foma()
-    install_mitlm()
-    install_libmagic()
+    start = time.time()
+    timings = run_steps(get_install_steps(params), progress)
+    report = {'wall_clock': time.time() - start,
+              'serial_estimate': sum(timings.values()),
+              'steps': timings}
+    summary = ('Installed in %.1f seconds; the steps took %.1f seconds in'
+               ' total (an estimate of how long they would have taken one'
+               ' after the other).' % (report['wall_clock'],
+                                       report['serial_estimate']))
+    print summary
+    log('install-timings.log', '%s\n\n%s' % (
+        summary, pprint.pformat(timings)))
+    return report
 
 
 def main():
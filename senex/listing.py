@@ -0,0 +1,142 @@
+"""This module contains the server-side pagination, sorting and search of the
+listings of models (e.g., OLDs and users) on the main page.
+
+A `Listing` reads its page number, sort column, sort order and search string
+from the request parameters that are prefixed with its name (e.g., `olds_page`,
+`olds_sort`, `olds_order` and `olds_q`) and fetches only the rows on the
+requested page. Searching is only allowed on indexed columns and is done with
+a range predicate (`column >= q AND column < q + u'\uffff'`) rather than with
+LIKE, which the db cannot answer from a (case-sensitive) index, so the cost of
+a search does not grow with the number of rows. Each row also gets
+its URL, built by appending the row's quoted key to a URL prefix that is
+generated once per listing instead of once per row. Example usage::
+
+    olds = Listing(request, 'olds', DBSession.query(OLD),
+                   sort_columns={'name': OLD.name,
+                                 'port': cast(OLD.port, Integer)},
+                   search_columns=[OLD.name, OLD.human_name],
+                   url_prefix=request.route_url('view_old', oldname=''),
+                   url_key='name')
+    olds.rows  # e.g., [{'model': <OLD>, 'url': 'http://.../olds/bla'}]
+
+"""
+
+import math
+import re
+import urllib
+
+from pyramid.traversal import quote_path_segment
+from sqlalchemy import and_, or_
+
+# The number of rows on a page.
+PAGE_SIZE = 25
+
+# Matches the names of the request parameters of every listing.
+LISTING_PARAM = re.compile(r'^\w+_(page|sort|order|q)$')
+
+
+class Listing(object):
+    """One page of the rows of `query`, sorted and searched as requested by the
+    parameters of `request` that are prefixed with `name`.
+
+    `sort_columns` maps the names of the columns that may be sorted on to the
+    columns (or column expressions, e.g., casts) themselves and
+    `search_columns` are the indexed columns whose values are matched, case
+    sensitively and by prefix, against the search string. The first sort column in
+    `default_sort` order is used if none is requested.
+
+    """
+
+    def __init__(self, request, name, query, sort_columns, search_columns,
+                 url_prefix, url_key, default_sort=None, page_size=PAGE_SIZE):
+        self.request = request
+        self.name = name
+        self.page_size = page_size
+        params = request.params
+        self.q = params.get('%s_q' % name, u'').strip()
+        self.sort = params.get('%s_sort' % name)
+        if self.sort not in sort_columns:
+            self.sort = default_sort or sorted(sort_columns)[0]
+        self.order = params.get('%s_order' % name)
+        if self.order not in ('asc', 'desc'):
+            self.order = 'asc'
+        if self.q:
+            # Every string that starts with `q` sorts between `q` and `q`
+            # followed by the greatest character.
+            end = self.q + u'\uffff'
+            query = query.filter(or_(*[and_(column >= self.q, column < end)
+                                       for column in search_columns]))
+        self.total = query.count()
+        self.pages = max(int(math.ceil(self.total / float(page_size))), 1)
+        try:
+            self.page = int(params.get('%s_page' % name, 1))
+        except ValueError:
+            self.page = 1
+        self.page = min(max(self.page, 1), self.pages)
+        sort_column = sort_columns[self.sort]
+        if self.order == 'desc':
+            sort_column = sort_column.desc()
+        models = query.order_by(sort_column).\
+            offset((self.page - 1) * page_size).limit(page_size).all()
+        self.rows = [
+            {'model': model,
+             'url': url_prefix + quote_path_segment(getattr(model, url_key))}
+            for model in models]
+
+    def url(self, **changes):
+        """Return the URL of the current page with the listing parameters
+        `changes` (without this listing's name prefix) changed. The parameters
+        of the other listings on the page are kept.
+
+        """
+
+        params = dict((key, value) for key, value in
+                      self.request.GET.items() if LISTING_PARAM.match(key))
+        for key, value in changes.items():
+            params['%s_%s' % (self.name, key)] = value
+        query = urllib.urlencode(sorted(
+            (key, unicode(value).encode('utf-8'))
+            for key, value in params.items() if value not in (None, u'')))
+        return '%s?%s' % (self.request.path_url, query)
+
+    def form_params(self):
+        """Return the listing parameters, as (name, value) pairs, that a search
+        form for this listing must pass on as hidden inputs: those of the other
+        listings and this listing's sort column and order.
+
+        """
+
+        own = ('%s_q' % self.name, '%s_page' % self.name)
+        params = [(key, value) for key, value in
+                  sorted(self.request.GET.items())
+                  if LISTING_PARAM.match(key) and key not in own and
+                  not key.startswith('%s_' % self.name)]
+        params.append(('%s_sort' % self.name, self.sort))
+        params.append(('%s_order' % self.name, self.order))
+        return params
+
+    def page_url(self, page):
+        return self.url(page=page)
+
+    def sort_url(self, column):
+        """Return the URL that sorts the listing by `column`, in reverse order
+        if it is already sorted by `column` in ascending order.
+
+        """
+
+        order = 'asc'
+        if column == self.sort and self.order == 'asc':
+            order = 'desc'
+        return self.url(sort=column, order=order, page=1)
+
+    @property
+    def prev_url(self):
+        if self.page > 1:
+            return self.page_url(self.page - 1)
+        return None
+
+    @property
+    def next_url(self):
+        if self.page < self.pages:
+            return self.page_url(self.page + 1)
+        return None
@@ -1,12 +1,6 @@
-import json
 import datetime
 import os
 
-from .utils import (
-    get_server,
-    get_dependencies
-    )
-
 from pyramid.security import (
     Allow,
     Everyone,
@@ -20,11 +14,16 @@ from sqlalchemy import (
     UnicodeText,
     Unicode,
     DateTime,
+    Float,
+    ForeignKey,
+    inspect,
+    text,
     )
 
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy.orm import (
+    relationship,
     scoped_session,
     sessionmaker,
     )
@@ -34,6 +33,11 @@ from zope.sqlalchemy import ZopeTransactionExtension
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
+# Sessions for background jobs. Unlike `DBSession`, which is scoped to a
+# thread and committed by the request's transaction, each of these is opened,
+# committed and closed by the worker itself; see `senex.worker.job_session`.
+JobSession = sessionmaker()
+
 
 # Default Server Settings Values
 USER_DIR = os.path.expanduser('~')
@@ -44,14 +48,6 @@ DEFAULT_SSL_DIR = u'sslcert'
 DEFAULT_VH_PATH = u'/etc/nginx/sites-available/olds'
 
 
-def get_default_dependency_state():
-    return unicode(json.dumps(
-        get_dependencies({'env_dir': DEFAULT_ENV_DIR})))
-
-def get_default_server_state():
-    return unicode(json.dumps(get_server({'apps_path': DEFAULT_APPS_PATH})))
-
-
 class OLD(Base):
     """The model for holding OLD instances.
 
@@ -69,7 +65,7 @@ class OLD(Base):
     dir_name = Column(Text, unique=True)
 
     # A name for the OLD that is more descriptive. E.g., "Blackfoot".
-    human_name = Column(Text)
+    human_name = Column(Text, index=True)
 
     # The URL where the OLD is being served. This is Senex's `host` value
     # followed by `dir_name`. E.g.,
@@ -105,43 +101,23 @@ class User(Base):
     salt = Column(Unicode(255))
     email = Column(Unicode(255))
     groups = Column(UnicodeText, default=u'[]')
-    first_name = Column(Text)
-    last_name = Column(Text)
+    first_name = Column(Text, index=True)
+    last_name = Column(Text, index=True)
 
 
-class SenexState(Base):
-    """The model for holding Senex's state. These values can be determined on
-    each request but that seems inefficient so we only refresh these values if
-    the user requests a forced refresh or if a threshold time interval has
-    passed.
+class SenexSettings(Base):
+    """The model for holding Senex's settings, i.e., the details about the
+    server that we need to know in order to create new OLDs and manage them.
 
-    Note: to keep track of the history of the state, a new state model should
-    be created upon each change. That is, an existing state should never be
-    modified.
+    Note: to keep track of the history of the settings, a new settings model
+    should be created upon each change. That is, existing settings should never
+    be modified.
 
     """
 
-    __tablename__ = u'senexstate'
+    __tablename__ = u'senexsettings'
     id = Column(Integer, primary_key=True)
-
-    # Set to `True` when the OLD and/or its dependencies are being installed.
-    # We don't want multiple concurrent install requests to be possible.
-    installation_in_progress = Column(Boolean, default=False)
-
-    # Set to `True` when an OLD is being changed, i.e., created, started,
-    # stopped. We don't want multiple concurrent OLD manipulation requests to be
-    # possible.
-    old_change_in_progress = Column(Boolean, default=False)
-
-    # The following two columns hold JSON-serialized data structures that
-    # encode our server's state.
-
-    server_state = Column(UnicodeText, default=get_default_server_state)
-    dependency_state = Column(UnicodeText, default=get_default_dependency_state)
-    last_state_check = Column(DateTime, default=datetime.datetime.utcnow)
-
-    # The following attributes are settings about the server that we need to
-    # know in order to create new OLDs and manage them.
+    created = Column(DateTime, default=datetime.datetime.utcnow)
 
     # This is the username and password of the MySQL user that will be used to
     # create the OLDs.
@@ -187,7 +163,7 @@ class SenexState(Base):
     default_ssl_pem_path = unicode(os.path.join(default_ssl_path, u''))
     ssl_pem_path = Column(Unicode(255), default=default_ssl_pem_path)
 
-    # These are the attributes of the `SenexState` model that are deemed
+    # These are the attributes of the `SenexSettings` model that are deemed
     # "settings" attributes.
     settings_attrs = [
         'mysql_user',
@@ -206,6 +182,142 @@ class SenexState(Base):
         return dict([(attr, getattr(self, attr)) for attr in self.settings_attrs])
 
 
+class ProbeSnapshot(Base):
+    """The model for holding a snapshot of the server's state, i.e., the result
+    of probing the server and our OLD dependency installation under a given
+    set of settings. These values can be determined on each request but that
+    seems inefficient so we only refresh these values if the user requests a
+    forced refresh or if a threshold time interval has passed.
+
+    Snapshots are never modified. Old ones are deleted by
+    :func:`senex.state.compact_snapshots`.
+
+    """
+
+    __tablename__ = u'probesnapshots'
+    id = Column(Integer, primary_key=True)
+
+    # The settings that the server was probed under.
+    settings_id = Column(Integer, ForeignKey('senexsettings.id'), index=True)
+
+    # The following two columns hold JSON-serialized data structures that
+    # encode our server's state. They have no defaults: probing the server is
+    # slow, so it is only ever done by the refresh machinery in
+    # :mod:`senex.state`, which fills them in, and never as a side effect of
+    # inserting a row.
+
+    server_state = Column(UnicodeText)
+    dependency_state = Column(UnicodeText)
+    last_state_check = Column(DateTime, default=datetime.datetime.utcnow,
+                              index=True)
+
+    # How long (in seconds) it took to probe the server for this state.
+    refresh_duration = Column(Float)
+
+
+# The id of the one and only `SenexState` row.
+CURRENT_STATE_ID = 1
+
+
+class SenexState(Base):
+    """The model for holding Senex's current state. There is only ever one
+    row, with id `CURRENT_STATE_ID`: it points to the current settings and to
+    the most recent probe snapshot, and it holds the flags that guard against
+    concurrent installations and OLD changes. Reading the current state is
+    therefore a primary key lookup, however many settings and snapshots have
+    accumulated.
+
+    """
+
+    __tablename__ = u'senexcurrentstate'
+    id = Column(Integer, primary_key=True)
+
+    # The id of the current settings is also their version: it increases every
+    # time that the settings change. The settings themselves are not loaded
+    # along with this row, as they are usually read from the settings cache;
+    # see :func:`senex.state.get_current_settings`.
+    settings_id = Column(Integer, ForeignKey('senexsettings.id'))
+    settings = relationship(SenexSettings)
+
+    # `None` until the server has been probed under the current settings.
+    snapshot_id = Column(Integer, ForeignKey('probesnapshots.id'))
+    snapshot = relationship(ProbeSnapshot, lazy='joined')
+
+    # Set to `True` when the OLD and/or its dependencies are being installed.
+    # We don't want multiple concurrent install requests to be possible.
+    installation_in_progress = Column(Boolean, default=False)
+
+    # Set to `True` when an OLD is being changed, i.e., created, started,
+    # stopped. We don't want multiple concurrent OLD manipulation requests to be
+    # possible.
+    old_change_in_progress = Column(Boolean, default=False)
+
+    def get_settings(self):
+        return self.settings.get_settings()
+
+
+# The states of a job. A job is queued until a worker claims it, at which
+# point it is running. A running job that fails has failed; one that loses its
+# worker goes back to being queued if it has attempts left.
+JOB_QUEUED = u'queued'
+JOB_RUNNING = u'running'
+JOB_SUCCEEDED = u'succeeded'
+JOB_FAILED = u'failed'
+
+
+class Job(Base):
+    """The model for holding a background job, e.g., an installation of the OLD
+    and its dependencies. Jobs are run by the worker thread in
+    :mod:`senex.worker`. Keeping them in the db means that queued jobs survive
+    restarts and that a job whose worker died can be recovered and retried.
+
+    """
+
+    __tablename__ = u'jobs'
+    id = Column(Integer, primary_key=True)
+
+    # The name of the job's handler in `senex.worker.JOB_HANDLERS`, e.g.,
+    # "install_old", and the JSON-serialized keyword arguments to call it with.
+    kind = Column(Text, index=True)
+    args = Column(UnicodeText, default=u'{}')
+
+    # While the job is queued or running, the key that identifies the
+    # operation that it performs, so that a duplicate submission of the same
+    # operation is coalesced with it; `None` once the job has ended. See
+    # :func:`senex.worker.submit_job`.
+    active_key = Column(Unicode(255), unique=True, index=True)
+
+    state = Column(Text, default=JOB_QUEUED, index=True)
+
+    # How many times the job has been started and how many times it may be.
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+
+    # A queued job is not started before this time. Interrupted attempts push
+    # it back so that retries are spaced out.
+    available_at = Column(DateTime, default=datetime.datetime.utcnow,
+                          index=True)
+
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+    # Updated periodically while the job is running. A running job whose
+    # heartbeat has stopped has lost its worker.
+    heartbeat = Column(DateTime)
+
+    # Which worker (host and process id) is running the job.
+    worker = Column(Text)
+
+    # The step that the job is at, as reported by its handler, e.g., the name
+    # of the installation step that is being run.
+    step = Column(Text)
+
+    # The error that the last failed attempt ended with, if any.
+    error = Column(UnicodeText)
+
+
 class RootFactory(object):
     """This facilitates Pyramid's own authentication/authorization system. I
     don't fully understand it yet.
@@ -217,3 +329,78 @@ class RootFactory(object):
     def __init__(self, request):
         pass
 
+
+def upgrade_schema(engine):
+    """Bring the db schema up to date with the models: create missing tables
+    and add missing columns and indexes to existing ones. Columns are only ever
+    added, and they are added without defaults, so existing rows get NULL.
+
+    """
+
+    Base.metadata.create_all(engine)
+    migrate_legacy_state(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in
+                       inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect)))
+        indexes = set(index['name'] for index in
+                      inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+
+# The table that held Senex's settings and state snapshots, one row per change,
+# before they were split into `senexsettings` and `probesnapshots`.
+LEGACY_STATE_TABLE = u'senexstate'
+
+
+def migrate_legacy_state(engine):
+    """Copy the rows of the legacy `senexstate` table, if there is one, into
+    the `senexsettings` and `probesnapshots` tables and point the
+    `senexcurrentstate` table to the most recent of them. This is only done
+    once, i.e., while there is no current state yet, so the legacy table is
+    kept as it was; the migrated snapshots are pruned by
+    :func:`senex.state.compact_snapshots` like any others.
+
+    """
+
+    if LEGACY_STATE_TABLE not in inspect(engine).get_table_names():
+        return
+    with engine.begin() as conn:
+        if conn.execute(SenexState.__table__.select()).first() is not None:
+            return
+        settings = settings_id = snapshot_id = row = None
+        for row in conn.execute('SELECT * FROM %s ORDER BY id' %
+                                LEGACY_STATE_TABLE):
+            row = dict(row.items())
+            row_settings = dict((attr, row.get(attr))
+                                for attr in SenexSettings.settings_attrs)
+            # Consecutive rows with the same settings share a settings row.
+            if row_settings != settings:
+                settings = row_settings
+                settings_id = conn.execute(
+                    SenexSettings.__table__.insert().values(settings)
+                ).inserted_primary_key[0]
+            # The timestamp is copied verbatim, in whatever form the db
+            # returned it.
+            snapshot_id = conn.execute(text(
+                'INSERT INTO probesnapshots (settings_id, server_state,'
+                ' dependency_state, last_state_check) VALUES (:settings_id,'
+                ' :server_state, :dependency_state, :last_state_check)'),
+                settings_id=settings_id,
+                server_state=row.get('server_state'),
+                dependency_state=row.get('dependency_state'),
+                last_state_check=row.get('last_state_check')
+            ).lastrowid
+        if row is not None:
+            conn.execute(SenexState.__table__.insert().values(
+                id=CURRENT_STATE_ID, settings_id=settings_id,
+                snapshot_id=snapshot_id,
+                installation_in_progress=row.get('installation_in_progress'),
+                old_change_in_progress=row.get('old_change_in_progress')))
@@ -0,0 +1,385 @@
+"""This module contains the probe engine that Senex uses to inspect the state of
+the server.
+
+A probe is a named callable that inspects one aspect of the server (usually by
+running a subprocess) and returns a value. The probes that make up a state
+refresh are independent of one another, so instead of running them one after
+the other we run them concurrently in a bounded pool of threads. Each probe
+gets a timeout so that a single hung subprocess cannot hold up the whole
+refresh.
+
+A probe may also have a fingerprint: a cheap summary (e.g., the inode, size
+and modification time of the executable that it runs) of everything that its
+result depends on. Results of fingerprinted probes are stored in a persistent
+`ProbeCache` and a probe is only re-run when its fingerprint changes. Only
+results of probes that completed are cached: a probe whose command timed out
+(see `mark_incomplete`) or that failed is re-run next time. Example usage::
+
+    from probes import Probe, run_probes
+    results = run_probes([
+        Probe('nginx', get_nginx_version),
+        Probe('ffmpeg', get_ffmpeg_version)
+    ])
+    results['nginx']  # e.g., '1.4.6'
+
+Every probe run is timed and the timings are kept in `probe_stats`, which
+reports rolling latency statistics per probe (see `ProbeStats.report`).
+
+"""
+
+import Queue
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# The maximum number of probes that are run at the same time.
+MAX_WORKERS = 8
+
+# The number of seconds that a single probe may run for before we give up on it
+# and use its default value instead.
+PROBE_TIMEOUT = 10
+
+# How often (in seconds) the caller of `run_probes` checks for timed out probes.
+POLL_INTERVAL = 0.05
+
+# The number of most recent timings per probe that `ProbeStats` keeps.
+STATS_WINDOW = 200
+
+# Probes that take longer than this many seconds are logged as slow.
+SLOW_PROBE = 2
+
+
+class Probe(object):
+    """A probe: a name, a callable with its arguments, and the value to use if
+    calling it fails or times out.
+
+    """
+
+    def __init__(self, name, func, args=(), default=None, fingerprint=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.default = default
+        # A callable that returns the probe's fingerprint, or `None` if the
+        # probe's result should not be cached.
+        self.fingerprint = fingerprint
+
+    def __call__(self):
+        return self.func(*self.args)
+
+    def __repr__(self):
+        return '<Probe %s>' % self.name
+
+
+class ProbeCache(object):
+    """A cache of probe results keyed by probe name and fingerprint. If `path`
+    is given, the cache is loaded from and saved to a JSON file at that path so
+    that it survives restarts.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError), e:
+                log.warn('Unable to load the probe cache at %s: %s', path, e)
+
+    def get(self, name, fingerprint):
+        """Return a 2-tuple: whether there is a cached result for probe `name`
+        with `fingerprint`, and that result.
+
+        """
+
+        # Round trip through JSON so that fingerprints compare equal to the
+        # ones that were loaded from disk.
+        fingerprint = json.loads(json.dumps(fingerprint))
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry and entry['fingerprint'] == fingerprint:
+            return True, entry['value']
+        return False, None
+
+    def set(self, name, fingerprint, value):
+        fingerprint = json.loads(json.dumps(fingerprint))
+        with self.lock:
+            self.entries[name] = {'fingerprint': fingerprint, 'value': value}
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        """Write the cache to disk, if it has a path and has changed. The file is
+        replaced atomically so that a concurrent reader never sees a partially
+        written cache.
+
+        """
+
+        with self.lock:
+            if not (self.path and self.dirty):
+                return
+            tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.entries, f)
+                os.rename(tmp_path, self.path)
+                self.dirty = False
+            except (IOError, OSError), e:
+                log.warn('Unable to save the probe cache to %s: %s',
+                         self.path, e)
+
+
+def percentile(values, fraction):
+    """Return the value at `fraction` (e.g., 0.95) of the sorted list `values`,
+    using the nearest-rank method.
+
+    """
+
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class ProbeStats(object):
+    """Rolling latency statistics of probes and of the subprocesses that they
+    run, kept in memory. Only the last `window` timings of each probe count
+    towards its percentiles; its counters cover the life of the process.
+
+    """
+
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def get(self, name):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = {
+                'timings': collections.deque(maxlen=self.window),
+                'count': 0, 'timeouts': 0, 'cache_hits': 0}
+        return stat
+
+    def record(self, name, seconds):
+        """Record that probe `name` ran for `seconds`.
+
+        """
+
+        with self.lock:
+            stat = self.get(name)
+            stat['timings'].append(seconds)
+            stat['count'] += 1
+        if seconds > SLOW_PROBE:
+            log.warn('Probe %s was slow: it took %.3f seconds.', name, seconds)
+        else:
+            log.debug('Probe %s took %.3f seconds.', name, seconds)
+
+    def record_timeout(self, name):
+        with self.lock:
+            self.get(name)['timeouts'] += 1
+
+    def record_cache_hit(self, name):
+        with self.lock:
+            self.get(name)['cache_hits'] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """Record how long the body of a `with` statement takes as a run of
+        probe `name`.
+
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def report(self):
+        """Return a dict from probe names to dicts of their `count`, `p50`,
+        `p95` and `max` latencies in seconds over the window, `timeouts` and
+        `cache_hits`.
+
+        """
+
+        with self.lock:
+            stats = [(name, sorted(stat['timings']), dict(stat))
+                     for name, stat in self.stats.items()]
+        report = {}
+        for name, timings, stat in stats:
+            report[name] = {
+                'count': stat['count'],
+                'p50': percentile(timings, 0.5),
+                'p95': percentile(timings, 0.95),
+                'max': timings[-1] if timings else None,
+                'timeouts': stat['timeouts'],
+                'cache_hits': stat['cache_hits']}
+        return report
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+
+# The process-wide probe statistics.
+probe_stats = ProbeStats()
+
+
+# Per thread, why the result of the probe that is running in that thread is
+# incomplete, if it is. See `mark_incomplete`.
+probe_context = threading.local()
+
+
+def mark_incomplete(reason):
+    """Mark the result of the probe that is running in this thread as incomplete,
+    e.g., because a command that it ran timed out, so that it is not cached.
+
+    """
+
+    probe_context.incomplete = reason
+
+
+# The process-wide probe cache. It only lives in memory until
+# `configure_probe_cache` gives it a path.
+probe_cache = ProbeCache()
+
+
+def configure_probe_cache(path):
+    """Replace the process-wide probe cache with one persisted at `path`.
+
+    """
+
+    global probe_cache
+    probe_cache = ProbeCache(path)
+    return probe_cache
+
+
+def file_fingerprint(path):
+    """Return a fingerprint of the file at `path`: its resolved path, inode,
+    size and modification time, or `None` if there is no such file.
+
+    """
+
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [path, stat.st_ino, stat.st_size, stat.st_mtime]
+
+
+def run_probes(probes, max_workers=MAX_WORKERS, timeout=PROBE_TIMEOUT,
+               use_cache=True):
+    """Run `probes` concurrently, at most `max_workers` at a time, and return a
+    dict from probe names to the values they returned. A probe that raises an
+    exception or runs for more than `timeout` seconds gets its default value.
+
+    Probes with fingerprints are only run if the probe cache has no result for
+    their current fingerprint. If `use_cache` is `False`, every probe is run
+    and the cache is refreshed with the new results.
+
+    A timed out probe's thread cannot be stopped, so it is abandoned and a
+    replacement thread is started in its place; whatever it eventually returns
+    is ignored and it stops as soon as its probe returns, so that no more than
+    `max_workers` threads take probes from the queue.
+
+    """
+
+    if not probes:
+        return {}
+    cache = probe_cache
+    jobs = Queue.Queue()
+    for probe in probes:
+        jobs.put(probe)
+    finished = Queue.Queue()
+    # Probe names to when they started and the threads that run them.
+    running = {}
+    abandoned = set()
+    lock = threading.Lock()
+
+    def work():
+        worker = threading.current_thread()
+        while True:
+            with lock:
+                if worker in abandoned:
+                    return
+            try:
+                probe = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            with lock:
+                running[probe.name] = (time.time(), worker)
+            try:
+                fingerprint = probe.fingerprint and probe.fingerprint()
+            except Exception, e:
+                log.warn('Unable to fingerprint probe %s: %s', probe.name, e)
+                fingerprint = None
+            try:
+                if fingerprint is not None and use_cache:
+                    hit, value = cache.get(probe.name, fingerprint)
+                    if hit:
+                        probe_stats.record_cache_hit(probe.name)
+                        finished.put((probe.name, value))
+                        continue
+                probe_context.incomplete = None
+                with probe_stats.timer(probe.name):
+                    value = probe()
+                if probe_context.incomplete:
+                    log.warn('Not caching the result of probe %s: %s',
+                             probe.name, probe_context.incomplete)
+                elif fingerprint is not None:
+                    cache.set(probe.name, fingerprint, value)
+            except Exception, e:
+                log.warn('Probe %s failed: %s', probe.name, e)
+                value = probe.default
+            finished.put((probe.name, value))
+
+    def start_worker():
+        worker = threading.Thread(target=work, name='probe-worker')
+        worker.setDaemon(True)
+        worker.start()
+
+    for i in range(min(max_workers, len(probes))):
+        start_worker()
+
+    defaults = dict((probe.name, probe.default) for probe in probes)
+    results = {}
+    while len(results) < len(probes):
+        try:
+            name, value = finished.get(timeout=POLL_INTERVAL)
+        except Queue.Empty:
+            pass
+        else:
+            if name not in results:
+                results[name] = value
+        now = time.time()
+        with lock:
+            overdue = [probe_name for probe_name, (started, worker) in
+                       running.items()
+                       if probe_name not in results and
+                       now - started > timeout]
+            abandoned.update(running[probe_name][1] for probe_name in overdue)
+        for name in overdue:
+            log.warn('Probe %s timed out after %s seconds.', name, timeout)
+            probe_stats.record_timeout(name)
+            results[name] = defaults[name]
+            start_worker()
+    cache.save()
+    return results
@@ -3,8 +3,6 @@ import json
 import sys
 import transaction
 
-from sqlalchemy import engine_from_config
-
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
@@ -14,10 +12,13 @@ from ..models import (
     DBSession,
     OLD,
     User,
+    CURRENT_STATE_ID,
+    SenexSettings,
     SenexState,
-    Base,
+    upgrade_schema,
     )
 
+from ..storage import create_senex_engine
 from ..utils import (
     generate_salt,
     encrypt_password,
@@ -37,13 +38,15 @@ def main(argv=sys.argv):
     config_uri = argv[1]
     setup_logging(config_uri)
     settings = get_appsettings(config_uri)
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = create_senex_engine(settings)
     DBSession.configure(bind=engine)
-    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
 
     with transaction.manager:
-        senex_state = SenexState()
-        DBSession.add(senex_state)
+        if DBSession.query(SenexState).get(CURRENT_STATE_ID) is None:
+            senex_state = SenexState(id=CURRENT_STATE_ID,
+                                     settings=SenexSettings())
+            DBSession.add(senex_state)
         admin = generate_default_administrator()
         DBSession.add(admin)
 
@@ -1,10 +1,239 @@
-USERS = {'editor':'mookafish',
-          'viewer':'mookafish'}
-GROUPS = {'editor':['group:editors']}
+"""This module contains Senex's authentication callbacks.
+
+Every authenticated request needs the principal of its user, i.e., their
+username and groups. Instead of fetching the user model and decoding its JSON
+`groups` on every request, principals are kept in a bounded LRU cache with a
+time to live. The views that change users (`add_user` and `edit_user`)
+invalidate their entries once their changes are committed (see
+`users_changed`); the time to live bounds how long a change made by another
+process that shares the db can go unnoticed.
+
+This module also protects the login view. Password hashing is CPU-heavy, so it
+is done on `hashing_pool`, a small pool of threads with a bounded backlog: a
+burst of login attempts is turned away when the backlog is full instead of
+tying up every request thread. Before anything is hashed, `login_throttle`
+rejects attempts for a username or from an IP address that has made too many
+of them recently.
+
+"""
+
+import Queue
+import collections
+import json
+import threading
+import time
+from collections import namedtuple
+
+import transaction
+from pyramid.security import unauthenticated_userid
+
+from .cache import LRUCache
+from .models import (
+    DBSession,
+    User,
+    )
+
+# The maximum number of cached principals and how long (in seconds) each one is
+# cached for.
+PRINCIPAL_CACHE_SIZE = 256
+PRINCIPAL_CACHE_TTL = 60
+
+# The number of threads that hash passwords, the number of hashing jobs that
+# may wait for them, and how long (in seconds) a request waits for its job.
+HASHING_WORKERS = 2
+HASHING_BACKLOG = 16
+HASHING_TIMEOUT = 10
+
+# The number of login attempts that are allowed per username and per IP address
+# within `LOGIN_THROTTLE_PERIOD` seconds.
+LOGIN_ATTEMPTS_PER_USERNAME = 5
+LOGIN_ATTEMPTS_PER_IP = 20
+LOGIN_THROTTLE_PERIOD = 300
+
+# The principal of an authenticated user: their username and a tuple of their
+# groups, e.g., ('group:editors',).
+Principal = namedtuple('Principal', ['username', 'groups'])
+
+principal_cache = LRUCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+
+def get_principal(username):
+    """Return the principal of the user with `username`, or `None` if there is
+    no such user.
+
+    """
+
+    principal = principal_cache.get(username)
+    if principal is None:
+        row = DBSession.query(User.username, User.groups).\
+            filter_by(username=username).first()
+        if row is None:
+            return None
+        principal = Principal(row.username, tuple(json.loads(row.groups)))
+        principal_cache.set(username, principal)
+    return principal
+
+
+def invalidate_principals(*usernames):
+    """Forget the cached principals of `usernames`. Called whenever users are
+    added or changed.
+
+    """
+
+    principal_cache.invalidate(*usernames)
+
+
+def users_changed(*usernames):
+    """Forget the cached principals of `usernames` as soon as the transaction
+    that changes their users is committed. Invalidating them any earlier would
+    let a concurrent request cache their old principals again before the
+    change is visible.
+
+    """
+
+    def invalidate(committed):
+        if committed:
+            invalidate_principals(*usernames)
+    transaction.get().addAfterCommitHook(invalidate)
+
+
+def get_user(request):
+    """Return the principal of the authenticated user, or `None`. This is
+    `request.user`.
+
+    """
+
+    userid = unauthenticated_userid(request)
+    if userid is None:
+        return None
+    return get_principal(userid)
+
 
 def groupfinder(userid, request):
-    print 'in groupfinder func looking for this id: %s' % userid
-    if userid in USERS:
-        return GROUPS.get(userid, [])
+    user = request.user
+    if user is not None:
+        return list(user.groups)
+    return None
+
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing pool cannot take on (or finish) a job in time.
+
+    """
+
+
+class HashingPool(object):
+    """A pool of `workers` daemon threads that run hashing jobs, with room for
+    at most `backlog` jobs waiting to be run.
+
+    """
+
+    def __init__(self, workers=HASHING_WORKERS, backlog=HASHING_BACKLOG):
+        self.workers = workers
+        self.jobs = Queue.Queue(backlog)
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            for i in range(self.workers):
+                worker = threading.Thread(target=self.work,
+                                          name='hashing-worker')
+                worker.setDaemon(True)
+                worker.start()
+            self.started = True
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job['result'] = job['func'](*job['args'])
+            except Exception, e:
+                job['error'] = e
+            job['done'].set()
+
+    def run(self, func, *args, **kwargs):
+        """Run `func` with `args` on the pool and return its result. Raise
+        `HashingPoolBusy` if the backlog is full or the job takes longer than
+        `timeout` seconds.
+
+        """
+
+        timeout = kwargs.get('timeout', HASHING_TIMEOUT)
+        self.start()
+        job = {'func': func, 'args': args, 'done': threading.Event(),
+               'result': None, 'error': None}
+        try:
+            self.jobs.put_nowait(job)
+        except Queue.Full:
+            raise HashingPoolBusy('Too many passwords are being hashed.')
+        if not job['done'].wait(timeout):
+            raise HashingPoolBusy('Hashing the password took too long.')
+        if job['error']:
+            raise job['error']
+        return job['result']
+
+
+class Throttle(object):
+    """A sliding window limit of `limit` events per key every `period` seconds.
+    Only the most recently used `maxkeys` keys are tracked.
+
+    """
+
+    def __init__(self, limit, period, maxkeys=10000):
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+        self.events = LRUCache(maxkeys, period)
+
+    def hit(self, key):
+        """Record an event for `key` and return `True`, unless `key` is already
+        at its limit, in which case return `False`.
+
+        """
+
+        now = time.time()
+        with self.lock:
+            events = self.events.get(key) or collections.deque()
+            while events and events[0] <= now - self.period:
+                events.popleft()
+            if len(events) >= self.limit:
+                return False
+            events.append(now)
+            self.events.set(key, events)
+            return True
+
+    def reset(self, key):
+        with self.lock:
+            self.events.invalidate(key)
+
+
+class LoginThrottle(object):
+    """Throttles login attempts per username and per IP address.
+
+    """
+
+    def __init__(self):
+        self.usernames = Throttle(LOGIN_ATTEMPTS_PER_USERNAME,
+                                  LOGIN_THROTTLE_PERIOD)
+        self.ips = Throttle(LOGIN_ATTEMPTS_PER_IP, LOGIN_THROTTLE_PERIOD)
+
+    def allow(self, username, ip):
+        """Record a login attempt and return `True` if it may go ahead.
+
+        """
+
+        return self.ips.hit(ip) and self.usernames.hit(username)
+
+    def succeeded(self, username):
+        """Forget the attempts for `username`, who has just logged in.
+
+        """
+
+        self.usernames.reset(username)
 
 
+hashing_pool = HashingPool()
+login_throttle = LoginThrottle()
@@ -0,0 +1,379 @@
+"""This module contains the logic for creating, reading and refreshing Senex's
+state, i.e., the snapshot of the server's stats and of the OLD's dependencies
+(a :class:`senex.models.ProbeSnapshot`) that the one
+:class:`senex.models.SenexState` row points to.
+
+Probing the server is slow, so requests never wait for it. They always get the
+most recent snapshot immediately and, if that snapshot is stale or a refresh
+was explicitly requested, a refresh is scheduled on the state refresher thread.
+The refresher also re-probes the server periodically so that the snapshot
+rarely gets stale in the first place. Example usage::
+
+    from state import get_state
+    server_state, dependency_state, settings, installation_in_progress, \
+        refreshing = get_state()
+
+Each refresh adds a snapshot; old snapshots, and the settings that only they
+refer to, are deleted by `compact_snapshots` according to the retention policy
+set by `configure_snapshot_retention`.
+
+"""
+
+import datetime
+import json
+import logging
+import threading
+import time
+
+import transaction
+
+from .cache import SettingsCache
+from .models import (
+    CURRENT_STATE_ID,
+    DBSession,
+    ProbeSnapshot,
+    SenexSettings,
+    SenexState,
+    )
+from .utils import (
+    CORE_DEPENDENCY_NAMES,
+    SOFT_DEPENDENCY_NAMES,
+    SingleFlight,
+    get_server,
+    get_dependencies,
+    )
+
+log = logging.getLogger(__name__)
+
+# The retention policy for probe snapshots: the most recent `SNAPSHOT_KEEP`
+# snapshots are kept, unless they are older than `SNAPSHOT_MAX_AGE`. The
+# current snapshot is always kept. See `configure_snapshot_retention`.
+SNAPSHOT_KEEP = 100
+SNAPSHOT_MAX_AGE = datetime.timedelta(days=30)
+
+# The process-wide cache of the current settings. See `get_current_settings`.
+settings_cache = SettingsCache()
+
+# Coalesces concurrent state refreshes so that only one runs at a time; callers
+# that arrive while a refresh is running wait for it and share its result
+# instead of probing the server and inserting a state model of their own.
+state_flight = SingleFlight()
+
+
+def create_new_state(senex_state=None, use_cache=True):
+    """Probe the server under the current settings, store the result as a new
+    probe snapshot in our db and return it as a 3-tuple of `server_state`,
+    `dependency_state`, and `state_settings`. Dependency probes whose
+    executables have not changed reuse their cached results unless `use_cache`
+    is `False`. If there is no Senex state model yet (`senex_state` is `None`),
+    one is created with the default settings.
+
+    If another thread is already creating a new state from the same inputs,
+    i.e., under the same settings and with the same `use_cache`, we wait for
+    it and return its result instead of creating one of our own.
+
+    """
+
+    settings_id = senex_state.settings_id if senex_state else None
+    return state_flight.do(('state', settings_id, use_cache),
+                           _create_new_state, senex_state, use_cache)
+
+
+def _create_new_state(senex_state, use_cache):
+
+    start = time.time()
+    if senex_state is None:
+        senex_state = SenexState(id=CURRENT_STATE_ID, settings=SenexSettings())
+        DBSession.add(senex_state)
+        DBSession.flush()
+    settings_id = senex_state.settings_id
+    new_state_settings = get_current_settings(senex_state)
+    server_state = get_server(new_state_settings)
+    dependency_state = get_dependencies(new_state_settings,
+                                        use_cache=use_cache,
+                                        names=CORE_DEPENDENCY_NAMES)
+    snapshot = ProbeSnapshot(
+        settings_id=settings_id,
+        server_state=unicode(json.dumps(server_state)),
+        dependency_state=unicode(json.dumps(dependency_state)),
+        last_state_check=datetime.datetime.utcnow(),
+        refresh_duration=time.time() - start)
+    DBSession.add(snapshot)
+    DBSession.flush()
+    # Only point to the new snapshot if the settings have not been changed
+    # while we were probing; if they have, whoever changed them has stored a
+    # snapshot of their own.
+    DBSession.query(SenexState).\
+        filter_by(id=CURRENT_STATE_ID, settings_id=settings_id).\
+        update({'snapshot_id': snapshot.id}, synchronize_session=False)
+    log.info('Refreshed the Senex state in %.3f seconds.',
+             snapshot.refresh_duration)
+    return server_state, dependency_state, new_state_settings
+
+
+def state_stale_age():
+    return datetime.timedelta(minutes=5)
+
+
+def state_refresh_interval():
+    """Return how often the state refresher re-probes the server. This is less
+    than `state_stale_age` so that requests rarely see a stale snapshot.
+
+    """
+
+    return state_stale_age() / 2
+
+
+def get_senex_state_model():
+    return DBSession.query(SenexState).get(CURRENT_STATE_ID)
+
+
+def load_settings(version):
+    return DBSession.query(SenexSettings).get(version).get_settings()
+
+
+def get_current_settings(senex_state=None):
+    """Return the current settings as a dict. They come from the settings cache
+    unless they have changed since they were cached, which we tell by
+    comparing the version of the cached settings with the current one, i.e.,
+    with the `settings_id` of the current Senex state model. If the model has
+    not been fetched, only its `settings_id` is.
+
+    """
+
+    if senex_state is None:
+        version = DBSession.query(SenexState.settings_id).\
+            filter_by(id=CURRENT_STATE_ID).scalar()
+    else:
+        version = senex_state.settings_id
+    return settings_cache.get(version, load_settings)
+
+
+def settings_changed(new_settings):
+    """Put `new_settings`, a settings model that has just been made current,
+    in the settings cache as soon as the transaction that made it current is
+    committed.
+
+    """
+
+    version = new_settings.id
+    settings = new_settings.get_settings()
+    def cache_settings(committed):
+        if committed:
+            settings_cache.set(version, settings)
+    transaction.get().addAfterCommitHook(cache_settings)
+
+
+def get_state_age(senex_state):
+    return datetime.datetime.utcnow() - senex_state.snapshot.last_state_check
+
+
+def has_snapshot(senex_state):
+    return senex_state is not None and senex_state.snapshot is not None
+
+
+def get_state(force_refresh=False, use_cache=True, senex_state=None,
+              wait=False):
+    """Return the state of the server, i.e., its server stats (like OS and
+    version) as well as the state of our OLD dependency installation, as a
+    5-tuple of `server_state`, `dependency_state`, `settings`,
+    `installation_in_progress` and `refreshing`.
+
+    The most recent snapshot in the db is always returned immediately. If it
+    is stale, or if `force_refresh` is `True`, a refresh is scheduled on the
+    state refresher and `refreshing` is `True`. A refresh only re-runs the
+    dependency probes whose executables have changed on disk, unless
+    `use_cache` is `False`, in which case every probe is re-run. If there is no
+    snapshot yet, if the refresher is not running (e.g., in scripts) or if
+    `wait` is `True` (for callers that must act on current data), the state is
+    refreshed synchronously instead.
+
+    Pass the current Senex state model as `senex_state` if it has already been
+    fetched, to save fetching it again.
+
+    """
+
+    if senex_state is None:
+        senex_state = get_senex_state_model()
+    if (wait or not has_snapshot(senex_state) or
+            not state_refresher.is_alive()):
+        if (not has_snapshot(senex_state) or force_refresh or
+                get_state_age(senex_state) > state_stale_age()):
+            server_state, dependency_state, settings = create_new_state(
+                senex_state, use_cache=use_cache)
+            installation_in_progress = bool(
+                senex_state and senex_state.installation_in_progress)
+            return (server_state, dependency_state, settings,
+                    installation_in_progress, False)
+    elif force_refresh or get_state_age(senex_state) > state_stale_age():
+        state_refresher.schedule(use_cache=use_cache)
+    return (json.loads(senex_state.snapshot.server_state),
+            json.loads(senex_state.snapshot.dependency_state),
+            get_current_settings(senex_state),
+            senex_state.installation_in_progress,
+            state_refresher.refreshing)
+
+
+def get_soft_dependency_state(settings, use_cache=True):
+    """Probe the soft dependencies, i.e., the ones that are not part of the
+    state snapshot, and return them as `get_dependencies` would. Their probe
+    results are cached in the probe cache like those of the core dependencies,
+    so this is cheap unless their executables have changed. Concurrent calls
+    with the same settings and `use_cache` share a single run of the probes.
+
+    """
+
+    key = ('soft-dependencies', json.dumps(settings, sort_keys=True),
+           use_cache)
+    return state_flight.do(key, get_dependencies, settings,
+                           use_cache=use_cache, names=SOFT_DEPENDENCY_NAMES)
+
+
+def refresh_state(use_cache=True):
+    """Probe the server and store the result as a new Senex state model. This
+    runs outside of any request, so it manages its own transaction.
+
+    """
+
+    try:
+        with transaction.manager:
+            create_new_state(get_senex_state_model(), use_cache=use_cache)
+        with transaction.manager:
+            compact_snapshots()
+    finally:
+        DBSession.remove()
+
+
+def configure_snapshot_retention(settings):
+    """Set the retention policy for probe snapshots from the app settings
+    `senex.snapshots.keep` and `senex.snapshots.max_age_days`, if present.
+    Called in :func:`senex.main`.
+
+    """
+
+    global SNAPSHOT_KEEP, SNAPSHOT_MAX_AGE
+    if settings.get('senex.snapshots.keep'):
+        SNAPSHOT_KEEP = max(int(settings['senex.snapshots.keep']), 1)
+    if settings.get('senex.snapshots.max_age_days'):
+        SNAPSHOT_MAX_AGE = datetime.timedelta(
+            days=float(settings['senex.snapshots.max_age_days']))
+
+
+def compact_snapshots(keep=None, max_age=None):
+    """Delete the probe snapshots that fall outside of the retention policy,
+    i.e., all but the most recent `keep` snapshots and those older than
+    `max_age`, and the settings that are no longer referred to. The current
+    snapshot and settings are never deleted. Return the number of deleted
+    snapshots.
+
+    """
+
+    keep = keep or SNAPSHOT_KEEP
+    max_age = max_age or SNAPSHOT_MAX_AGE
+    senex_state = get_senex_state_model()
+    if senex_state is None:
+        return 0
+    # The oldest snapshot that is among the most recent `keep` ones.
+    oldest_kept = DBSession.query(ProbeSnapshot.id).\
+        order_by(ProbeSnapshot.id.desc()).offset(keep - 1).limit(1).scalar()
+    cutoff = datetime.datetime.utcnow() - max_age
+    expired = ProbeSnapshot.last_state_check < cutoff
+    if oldest_kept is not None:
+        expired = expired | (ProbeSnapshot.id < oldest_kept)
+    deleted = DBSession.query(ProbeSnapshot).\
+        filter(expired).\
+        filter(ProbeSnapshot.id != senex_state.snapshot_id).\
+        delete(synchronize_session=False)
+    if deleted:
+        referenced = DBSession.query(ProbeSnapshot.settings_id).\
+            filter(ProbeSnapshot.settings_id != None).distinct()
+        DBSession.query(SenexSettings).\
+            filter(~SenexSettings.id.in_(referenced)).\
+            filter(SenexSettings.id != senex_state.settings_id).\
+            delete(synchronize_session=False)
+        log.info('Deleted %s old probe snapshots.', deleted)
+    return deleted
+
+
+class StateRefresher(threading.Thread):
+    """A daemon thread that keeps the most recent Senex state snapshot warm. It
+    refreshes the state when a refresh is scheduled via `schedule` and
+    whenever the snapshot is older than `state_refresh_interval`.
+
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='state-refresher')
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # `None` if no refresh is scheduled; otherwise whether the scheduled
+        # refresh may use the probe cache.
+        self.pending = None
+        # `True` from the moment a refresh is scheduled or started until no
+        # refresh is scheduled or running.
+        self.refreshing = False
+
+    def schedule(self, use_cache=True):
+        """Schedule a refresh without waiting for it. Scheduling several
+        refreshes before the refresher gets to them results in only one
+        refresh, which bypasses the probe cache if any of them asked it to.
+
+        """
+
+        with self.lock:
+            if self.pending is None:
+                self.pending = use_cache
+            else:
+                self.pending = self.pending and use_cache
+            self.refreshing = True
+        self.wakeup.set()
+
+    def run(self):
+        interval = state_refresh_interval()
+        while True:
+            self.wakeup.wait(interval.total_seconds())
+            self.wakeup.clear()
+            with self.lock:
+                use_cache = self.pending
+                self.pending = None
+            if use_cache is None:
+                if not self.is_due(interval):
+                    continue
+                use_cache = True
+            with self.lock:
+                self.refreshing = True
+            try:
+                refresh_state(use_cache=use_cache)
+            except Exception:
+                log.exception('Unable to refresh the Senex state.')
+            finally:
+                with self.lock:
+                    self.refreshing = self.pending is not None
+
+    def is_due(self, interval):
+        """Return `True` if the most recent snapshot is older than `interval`.
+
+        """
+
+        try:
+            senex_state = get_senex_state_model()
+            return (not has_snapshot(senex_state) or
+                    get_state_age(senex_state) > interval)
+        finally:
+            DBSession.remove()
+
+
+# The process-wide state refresher. It is started by `start_state_refresher`.
+state_refresher = StateRefresher()
+
+
+def start_state_refresher():
+    """Start the state refresher and have it warm the state snapshot right away.
+    Called in :func:`senex.main`.
+
+    """
+
+    if not state_refresher.is_alive():
+        state_refresher.start()
+    state_refresher.schedule()
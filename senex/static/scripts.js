@@ -12,23 +12,85 @@ $(function(){
 
     $('input[type=text]').first().focus();
 
-    // This is the long-polling to /senexstatus to see if an install is in
-    // progress. TODO: refresh/reload page or update page when install attempt
-    // finishes.
-    var longPollTimer;
-    var longPollURL;
-    var longPollInterval = 5000;
-    if ($('.installation-in-progress-indicator').is(':visible')) {
-        longPollURL = $('.installation-in-progress-indicator').data('url');
-        longPoll = function() {
-            $.get(longPollURL, function(response) {
-                if (!response.installation_in_progress) {
-                    clearInterval(longPollTimer);
-                    $('.installation-in-progress-indicator').hide();
-                }
+    // The soft dependencies are not needed to render the main page, so they
+    // are probed after it loads and their rows are filled in here.
+    var $softDependencies = $('tbody.soft-dependencies');
+    if ($softDependencies.length) {
+        $.get($softDependencies.data('url'), function(response) {
+            $softDependencies.empty();
+            $.each(response.dependencies || [], function(i, dep) {
+                var icon = dep.installed ?
+                    '<i class="ok fa fa-check-circle"></i>' :
+                    '<i class="error fa fa-times-circle"></i>';
+                $('<tr>')
+                    .append($('<td>').text(dep.name))
+                    .append($('<td>').text(dep.version))
+                    .append($('<td>').html('<div>' + icon + '</div>'))
+                    .appendTo($softDependencies);
             });
+        }).fail(function() {
+            $softDependencies.find('.soft-dependencies-loading td')
+                .text('Unable to check the soft dependencies.');
+        });
+    }
+
+    // Changes to Senex's state (job state changes, installation steps and
+    // OLDs being started or stopped) are pushed to the page by long-polling
+    // /events with a cursor: each poll returns as soon as there are events
+    // after the cursor, or after a timeout if there are none.
+    var $events = $('.senex-events');
+    var handlers = {
+        job: function(job) {
+            if (job.kind !== 'install_old') {
+                return;
+            }
+            if (job.state === 'queued' || job.state === 'running') {
+                $('.installation-finished-indicator').hide();
+                $('.installation-in-progress-indicator').show();
+                $('.installation-step').text(job.step ?
+                    '(Step: ' + job.step + '.)' : '');
+            } else {
+                $('.installation-in-progress-indicator').hide();
+                $('.installation-result').text(job.state === 'succeeded' ?
+                    'The installation has finished.' :
+                    'The installation failed.');
+                $('.installation-finished-indicator').show();
+            }
+        },
+        old: function(old) {
+            var icon = old.running ?
+                '<i class="ok fa fa-fw fa-check-circle"></i>' :
+                '<i class="error fa fa-fw fa-times-circle"></i>';
+            $('tr[data-old-name]').filter(function() {
+                return $(this).data('old-name') === old.name;
+            }).find('td.old-running a').html(icon);
         }
-        longPollTimer = setInterval(longPoll, longPollInterval);
+    };
+    var poll = function(cursor) {
+        $.get($events.data('url'), {cursor: cursor}, function(response) {
+            if (!response.cursor) {
+                // Not a response from /events, e.g., the login page because
+                // the session has expired.
+                return;
+            }
+            if (response.reset) {
+                // The events since our cursor are gone (e.g., Senex was
+                // restarted), so the page is out of date.
+                window.location.reload();
+                return;
+            }
+            $.each(response.events, function(i, event) {
+                if (handlers[event.type]) {
+                    handlers[event.type](event.data);
+                }
+            });
+            setTimeout(function() { poll(response.cursor); }, response.retry);
+        }).fail(function() {
+            setTimeout(function() { poll(cursor); }, 5000);
+        });
+    };
+    if ($events.length) {
+        poll(String($events.data('cursor')));
     }
 });
 
@@ -0,0 +1,112 @@
+"""This module contains the storage profiles for Senex's own database, i.e.,
+how the SQLAlchemy engine is set up for each kind of database.
+
+Senex's database is written by the request threads as well as by the worker
+and state refresher threads. With SQLite's defaults (rollback journaling and
+no busy timeout), a writer makes every other connection fail immediately with
+"database is locked". So the SQLite profile turns on write-ahead logging
+(WAL), under which readers and the writer do not block one another, and a busy
+timeout, under which a writer waits for another writer instead of failing, and
+it pools connections. The server profile (e.g., for MySQL or PostgreSQL)
+pools connections and checks them before use, since servers drop idle ones.
+
+Any `sqlalchemy.*` setting (e.g., `sqlalchemy.pool_size`) overrides the
+profile's default. Example usage::
+
+    from storage import create_senex_engine
+    engine = create_senex_engine(settings)
+
+"""
+
+import logging
+
+from sqlalchemy import engine_from_config, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)
+
+# How long (in seconds) a SQLite connection waits for another connection's
+# write lock before it gives up with "database is locked". Overridden by the
+# `senex.storage.busy_timeout` setting.
+SQLITE_BUSY_TIMEOUT = 30
+
+# Enough pooled connections for waitress's request threads plus the worker,
+# state refresher and hashing threads.
+POOL_SIZE = 10
+MAX_OVERFLOW = 10
+
+# Server databases close idle connections (MySQL after `wait_timeout`, eight
+# hours by default), so pooled connections are recycled well before that.
+POOL_RECYCLE = 3600
+
+
+def is_sqlite(url):
+    return make_url(url).drivername.split('+')[0] == 'sqlite'
+
+
+def is_sqlite_memory(url):
+    return is_sqlite(url) and make_url(url).database in (None, '', ':memory:')
+
+
+def get_profile(settings, prefix='sqlalchemy.'):
+    """Return the engine keyword arguments of the storage profile for the
+    database at the `url` setting.
+
+    """
+
+    url = settings[prefix + 'url']
+    if is_sqlite(url):
+        if is_sqlite_memory(url):
+            # Every connection to an in-memory db is a different db, so the
+            # default single connection per thread must be kept.
+            return {}
+        busy_timeout = float(settings.get('senex.storage.busy_timeout',
+                                          SQLITE_BUSY_TIMEOUT))
+        return {
+            'poolclass': QueuePool,
+            'pool_size': POOL_SIZE,
+            'max_overflow': MAX_OVERFLOW,
+            'connect_args': {'timeout': busy_timeout,
+                             'check_same_thread': False}
+        }
+    return {
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': True
+    }
+
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Turn on WAL and relax syncing to what WAL needs to stay durable across
+    application crashes. Called for every new SQLite connection.
+
+    """
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+    finally:
+        cursor.close()
+
+
+def create_senex_engine(settings, prefix='sqlalchemy.'):
+    """Return an engine for Senex's database, as configured by the `prefix`ed
+    `settings`, set up according to the storage profile for its kind of
+    database.
+
+    """
+
+    profile = get_profile(settings, prefix)
+    for key in profile.keys():
+        if prefix + key in settings:
+            del profile[key]
+    engine = engine_from_config(settings, prefix, **profile)
+    url = settings[prefix + 'url']
+    if is_sqlite(url) and not is_sqlite_memory(url):
+        event.listen(engine, 'connect', configure_sqlite_connection)
+    log.info('Using the %s storage profile for %s.',
+             'SQLite' if is_sqlite(url) else 'server', engine.url)
+    return engine
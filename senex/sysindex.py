@@ -0,0 +1,312 @@
+"""This module contains indexes of the executables and shared libraries that are
+installed on the server, so that checking whether something is installed is a
+dictionary lookup rather than a scan of the filesystem or a subprocess call.
+
+The executable index maps the name of every executable in the directories on
+the PATH to its path. It is rebuilt only when the PATH changes or when one of
+its directories is modified (i.e., when its mtime changes), which is what
+happens when a program is installed or removed.
+
+The library index maps the name of every shared library known to the dynamic
+linker to its path. It is parsed from /etc/ld.so.cache, the file that
+`ldconfig -p` prints, and is rebuilt only when that file changes.
+
+The package index holds the names of the Debian packages that are installed.
+It is parsed from /var/lib/dpkg/status, the file that `dpkg -s` reads, and is
+rebuilt only when that file changes. Example usage::
+
+    from sysindex import which, library_installed, package_installed
+    which('ffmpeg')  # e.g., '/usr/bin/ffmpeg'
+    library_installed('libmagic')  # True if e.g. libmagic.so.1 is installed
+    package_installed('libmagic-dev')  # True if dpkg has installed it
+
+"""
+
+import os
+import re
+import struct
+import threading
+
+# The path to the dynamic linker's cache of shared libraries.
+LD_SO_CACHE = '/etc/ld.so.cache'
+
+# The path to dpkg's record of the state of every package that it knows of.
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# Magic strings that begin the old (libc5) and new (glibc) ld.so.cache formats.
+LD_SO_CACHE_OLD_MAGIC = 'ld.so-1.7.0'
+LD_SO_CACHE_NEW_MAGIC = 'glibc-ld.so.cache1.1'
+
+
+def is_exe(fpath):
+    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+
+class ExecutableIndex(object):
+    """An index from executable names to the first path on the PATH where an
+    executable with that name is found.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.executables = {}
+
+    def get_signature(self, dirs):
+        """Return the PATH directories paired with their mtimes. The index is
+        stale whenever this changes.
+
+        """
+
+        signature = []
+        for directory in dirs:
+            try:
+                signature.append((directory, os.stat(directory).st_mtime))
+            except OSError:
+                signature.append((directory, None))
+        return tuple(signature)
+
+    def build(self, dirs):
+        executables = {}
+        for directory in dirs:
+            try:
+                fnames = os.listdir(directory)
+            except OSError:
+                continue
+            for fname in fnames:
+                if fname in executables:
+                    continue
+                path = os.path.join(directory, fname)
+                if is_exe(path):
+                    executables[fname] = path
+        return executables
+
+    def get_executables(self):
+        """Return the index as a dict from executable names to paths,
+        rebuilding it first if it is stale.
+
+        """
+
+        dirs = [path.strip('"') for path in
+                os.environ.get('PATH', '').split(os.pathsep) if path]
+        signature = self.get_signature(dirs)
+        with self.lock:
+            if signature != self.signature:
+                self.executables = self.build(dirs)
+                self.signature = signature
+            return self.executables
+
+    def which(self, program):
+        return self.get_executables().get(program)
+
+
+def read_c_string(data, offset):
+    end = data.index('\0', offset)
+    return data[offset:end]
+
+
+def parse_ld_so_cache(data):
+    """Return a dict from library names (e.g., 'libmagic.so.1') to paths, parsed
+    from `data`, the contents of an ld.so.cache file. Both the old format and
+    the new format (which may follow the old one in the same file) are
+    supported.
+
+    """
+
+    libraries = {}
+    offset = 0
+    if data.startswith(LD_SO_CACHE_OLD_MAGIC):
+        # struct cache_file {char magic[11]; unsigned int nlibs;
+        #                    struct file_entry libs[nlibs];}
+        # where struct file_entry {int flags; unsigned int key, value;} and
+        # key and value are offsets into the string table after the entries.
+        nlibs = struct.unpack_from('=I', data, 12)[0]
+        strings = 16 + nlibs * 12
+        # If the new format follows, it starts at the next 8-byte boundary
+        # and it is the one we want, as it is more complete.
+        offset = (strings + 7) & ~7
+        if not data[offset:].startswith(LD_SO_CACHE_NEW_MAGIC):
+            for i in range(nlibs):
+                flags, key, value = struct.unpack_from('=iII', data,
+                                                       16 + i * 12)
+                libraries.setdefault(read_c_string(data, strings + key),
+                                     read_c_string(data, strings + value))
+            return libraries
+    if data[offset:].startswith(LD_SO_CACHE_NEW_MAGIC):
+        # struct cache_file_new {char magic[17]; char version[3];
+        #     uint32_t nlibs, len_strings; uint8_t flags, padding[3];
+        #     uint32_t extension_offset, unused[3];
+        #     struct file_entry_new libs[nlibs];}
+        # where struct file_entry_new {int32_t flags; uint32_t key, value;
+        #     uint32_t osversion; uint64_t hwcap;} and key and value are
+        # offsets from the start of cache_file_new.
+        nlibs = struct.unpack_from('=I', data, offset + 20)[0]
+        for i in range(nlibs):
+            flags, key, value = struct.unpack_from('=iII', data,
+                                                   offset + 48 + i * 24)
+            libraries.setdefault(read_c_string(data, offset + key),
+                                 read_c_string(data, offset + value))
+    else:
+        raise ValueError('Unknown ld.so.cache format.')
+    return libraries
+
+
+class LibraryIndex(object):
+    """An index from shared library names to paths, parsed from ld.so.cache.
+
+    """
+
+    def __init__(self, path=LD_SO_CACHE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.signature = None
+        self.libraries = {}
+        # Every library name plus each of its dot-separated prefixes, e.g.,
+        # 'libmagic', 'libmagic.so' and 'libmagic.so.1' for 'libmagic.so.1'.
+        self.names = set()
+
+    def get_names(self):
+        self.get_libraries()
+        return self.names
+
+    def get_libraries(self):
+        """Return the index as a dict from library names to paths, rebuilding
+        it first if the cache file has changed.
+
+        """
+
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except OSError:
+            signature = None
+        with self.lock:
+            if signature != self.signature:
+                self.libraries = {}
+                if signature:
+                    with open(self.path, 'rb') as f:
+                        data = f.read()
+                    try:
+                        self.libraries = parse_ld_so_cache(data)
+                    except (struct.error, ValueError):
+                        # An unknown format: fall back to picking the library
+                        # names out of the file's strings.
+                        self.libraries = dict(
+                            (name, '') for name in
+                            re.findall(r'lib[\w+.-]*\.so[\w.]*', data))
+                self.names = set()
+                for library in self.libraries:
+                    parts = library.split('.')
+                    for i in range(1, len(parts) + 1):
+                        self.names.add('.'.join(parts[:i]))
+                self.signature = signature
+            return self.libraries
+
+    def installed(self, name):
+        """Return `True` if a library called `name` (e.g., 'libmagic' or
+        'libmagic.so.1') is installed.
+
+        """
+
+        return name in self.get_names()
+
+
+def parse_dpkg_status(data):
+    """Return the set of names of the packages that are installed according to
+    `data`, the contents of a dpkg status file. The file is made of stanzas
+    separated by blank lines; a package is installed if its stanza's Status
+    field is "install ok installed".
+
+    """
+
+    installed = set()
+    for stanza in re.split(r'\n\s*\n', data):
+        fields = {}
+        for line in stanza.splitlines():
+            if not line or line[0].isspace():
+                continue
+            key, sep, value = line.partition(':')
+            fields[key] = value.strip()
+        if (fields.get('Package') and
+                fields.get('Status', '').split()[-1:] == ['installed']):
+            installed.add(fields['Package'])
+    return installed
+
+
+class PackageIndex(object):
+    """An index of the names of the installed Debian packages, parsed from the
+    dpkg status file.
+
+    """
+
+    def __init__(self, path=DPKG_STATUS):
+        self.path = path
+        self.lock = threading.Lock()
+        self.signature = None
+        self.packages = set()
+
+    def get_packages(self):
+        """Return the set of installed package names, rebuilding it first if
+        the status file has changed.
+
+        """
+
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except OSError:
+            signature = None
+        with self.lock:
+            if signature != self.signature:
+                self.packages = set()
+                if signature:
+                    with open(self.path) as f:
+                        self.packages = parse_dpkg_status(f.read())
+                self.signature = signature
+            return self.packages
+
+    def installed(self, name):
+        """Return `True` if the package called `name` is installed. An
+        architecture qualifier (e.g., 'zlib1g-dev:amd64') is ignored.
+
+        """
+
+        return name.split(':')[0] in self.get_packages()
+
+
+# The process-wide indexes.
+executable_index = ExecutableIndex()
+library_index = LibraryIndex()
+package_index = PackageIndex()
+
+
+def which(program):
+    """Return the path to `program` if it is an executable; otherwise return
+    `None`. A `program` without a directory is looked up in the executable
+    index of the PATH.
+
+    """
+
+    fpath, fname = os.path.split(program)
+    if fpath:
+        if is_exe(program):
+            return program
+        return None
+    return executable_index.which(program)
+
+
+def library_installed(name):
+    """Return `True` if the Linux library identifiable by `name` is installed.
+
+    """
+
+    return library_index.installed(name)
+
+
+def package_installed(name):
+    """Return `True` if the Debian package called `name` is installed.
+
+    """
+
+    return package_index.installed(name)
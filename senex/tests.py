@@ -52,4 +52,1684 @@ class TestMyViewFailureCondition(unittest.TestCase):
         from .views import my_view
         request = testing.DummyRequest()
         info = my_view(request)
-        self.assertEqual(info.status_int, 500)
\ No newline at end of file
+        self.assertEqual(info.status_int, 500)
+
+class TestProbeEngine(unittest.TestCase):
+
+    def test_probes_run_concurrently(self):
+        import time
+        from .probes import Probe, run_probes
+        probes = [Probe(str(i), time.sleep, (0.2,), default='default')
+                  for i in range(4)]
+        start = time.time()
+        results = run_probes(probes, max_workers=4)
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(sorted(results), ['0', '1', '2', '3'])
+
+    def test_failed_and_timed_out_probes_get_defaults(self):
+        import time
+        from .probes import Probe, run_probes
+        def fail():
+            raise ValueError('broken')
+        results = run_probes([
+            Probe('ok', lambda: 'value'),
+            Probe('fail', fail, default='failed'),
+            Probe('slow', time.sleep, (5,), default='timed out')
+        ], timeout=0.2)
+        self.assertEqual(results, {'ok': 'value', 'fail': 'failed',
+                                   'slow': 'timed out'})
+
+    def test_abandoned_workers_take_no_more_probes(self):
+        import threading
+        import time
+        from .probes import Probe, run_probes
+        lock = threading.Lock()
+        counts = {'running': 0, 'max': 0}
+        def probe():
+            with lock:
+                counts['running'] += 1
+                counts['max'] = max(counts['max'], counts['running'])
+            time.sleep(0.1)
+            with lock:
+                counts['running'] -= 1
+        probes = [Probe('slow', time.sleep, (0.25,))] + [
+            Probe(str(i), probe) for i in range(6)]
+        run_probes(probes, max_workers=1, timeout=0.1)
+        self.assertEqual(counts['max'], 1)
+
+    def test_get_dependencies_shape(self):
+        from .utils import DEPENDENCY_NAMES, get_dependencies
+        dependencies = get_dependencies({'env_dir': u'no-such-env-dir'})
+        self.assertEqual([d['name'] for d in dependencies], DEPENDENCY_NAMES)
+        for dependency in dependencies:
+            self.assertEqual(sorted(dependency),
+                             ['installed', 'name', 'version'])
+
+    def test_soft_dependencies_are_probed_separately(self):
+        from .utils import (CORE_DEPENDENCY_NAMES, SOFT_DEPENDENCY_NAMES,
+                            get_dependencies, get_dependency_probes)
+        core_probes = get_dependency_probes(CORE_DEPENDENCY_NAMES)
+        self.assertNotIn('foma', [probe.name for probe in core_probes])
+        params = {'env_dir': u'no-such-env-dir'}
+        self.assertEqual(
+            [d['name'] for d in get_dependencies(
+                params, names=SOFT_DEPENDENCY_NAMES)],
+            SOFT_DEPENDENCY_NAMES)
+        self.assertEqual(
+            [d['name'] for d in get_dependencies(
+                params, names=CORE_DEPENDENCY_NAMES)],
+            CORE_DEPENDENCY_NAMES)
+
+
+class TestInspectEnv(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import sys
+        import tempfile
+        self.env_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.env_dir, 'bin'))
+        os.symlink(sys.executable, os.path.join(self.env_dir, 'bin', 'python'))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.env_dir)
+
+    def test_inspect_env_reports_every_module(self):
+        from .installold import ENV_MODULES, inspect_env
+        env_modules = inspect_env({'env_dir': self.env_dir})
+        self.assertEqual(sorted(env_modules),
+                         sorted(name for name, attrs in ENV_MODULES))
+        self.assertTrue(env_modules['importlib']['installed'])
+        self.assertFalse(env_modules['onlinelinguisticdatabase']['installed'])
+
+    def test_env_checks_share_one_inspection(self):
+        from . import installold
+        params = {'env_dir': self.env_dir}
+        calls = []
+        original = installold.inspect_env
+        def inspect_env(params):
+            calls.append(params)
+            return original(params)
+        installold.inspect_env = inspect_env
+        try:
+            installold.forget_env_modules(params)
+            installold.old_installed(params)
+            installold.importlib_installed(params)
+            installold.mysql_python_installed(params)
+            installold.pil_installed(params)
+            self.assertEqual(len(calls), 1)
+            # Installing something into the env invalidates the result.
+            installold.forget_env_modules(params)
+            installold.importlib_installed(params)
+            self.assertEqual(len(calls), 2)
+        finally:
+            installold.inspect_env = original
+            installold.forget_env_modules(params)
+
+    def test_inspect_env_without_env(self):
+        from .installold import inspect_env
+        env_modules = inspect_env({'env_dir': self.env_dir + '-missing'})
+        self.assertFalse(any(m['installed'] for m in env_modules.values()))
+
+
+class TestProbeCache(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        from . import probes
+        self.old_cache = probes.probe_cache
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'probes.json')
+        probes.configure_probe_cache(self.path)
+        self.calls = []
+        self.fingerprint = ['/usr/bin/tool', 1, 2, 3.0]
+
+    def tearDown(self):
+        import shutil
+        from . import probes
+        probes.probe_cache = self.old_cache
+        shutil.rmtree(self.dir)
+
+    def run_tool_probe(self, **kwargs):
+        from .probes import Probe, run_probes
+        def tool():
+            self.calls.append(1)
+            return {'version': '1.0'}
+        return run_probes([Probe('tool', tool,
+                                 fingerprint=lambda: self.fingerprint)],
+                          **kwargs)
+
+    def test_probe_is_rerun_only_when_fingerprint_changes(self):
+        self.assertEqual(self.run_tool_probe(), {'tool': {'version': '1.0'}})
+        self.assertEqual(self.run_tool_probe(), {'tool': {'version': '1.0'}})
+        self.assertEqual(len(self.calls), 1)
+        self.fingerprint = ['/usr/bin/tool', 1, 2, 4.0]
+        self.run_tool_probe()
+        self.assertEqual(len(self.calls), 2)
+        self.run_tool_probe(use_cache=False)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_cache_survives_restart(self):
+        from . import probes
+        self.run_tool_probe()
+        probes.configure_probe_cache(self.path)
+        self.run_tool_probe()
+        self.assertEqual(len(self.calls), 1)
+
+    def test_timed_out_commands_are_not_cached(self):
+        from . import utils
+        from .installold import ShellTimeout, shell
+        from .probes import Probe, run_probes
+        self.assertRaises(ShellTimeout, shell, ['sleep', '5'], timeout=0.1)
+        def tool():
+            self.calls.append(1)
+            return utils.probe_shell(['sleep', '5'])
+        old_timeout = utils.PROBE_TIMEOUT
+        utils.PROBE_TIMEOUT = 0.1
+        try:
+            for i in range(2):
+                run_probes([Probe('tool', tool,
+                                  fingerprint=lambda: self.fingerprint)])
+        finally:
+            utils.PROBE_TIMEOUT = old_timeout
+        self.assertEqual(len(self.calls), 2)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        import threading
+        import time
+        from .utils import SingleFlight
+        flight = SingleFlight()
+        calls = []
+        results = []
+        def refresh():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'snapshot'
+        def do():
+            results.append(flight.do('state', refresh))
+        threads = [threading.Thread(target=do) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['snapshot'] * 5)
+        self.assertFalse(flight.in_flight('state'))
+
+    def test_errors_are_shared_and_not_cached(self):
+        from .utils import SingleFlight
+        flight = SingleFlight()
+        def fail():
+            raise ValueError('broken')
+        self.assertRaises(ValueError, flight.do, 'state', fail)
+        self.assertEqual(flight.do('state', lambda: 'ok'), 'ok')
+
+    def test_state_refreshes_with_other_inputs_are_not_shared(self):
+        import threading
+        from . import state
+        release = threading.Event()
+        calls = []
+        def create(senex_state, use_cache):
+            calls.append((senex_state.settings_id, use_cache))
+            if use_cache:
+                release.wait(5)
+            return use_cache
+        class FakeState(object):
+            settings_id = 1
+        original = state._create_new_state
+        state._create_new_state = create
+        try:
+            leader = threading.Thread(target=state.create_new_state,
+                                      args=(FakeState(),))
+            leader.start()
+            while not calls:
+                pass
+            # A forced refresh does not get the cached probe results.
+            self.assertEqual(
+                state.create_new_state(FakeState(), use_cache=False), False)
+            release.set()
+            leader.join()
+        finally:
+            state._create_new_state = original
+        self.assertEqual(sorted(calls), [(1, False), (1, True)])
+
+
+class TestSystemMetrics(unittest.TestCase):
+
+    def test_human_size_matches_df(self):
+        from .utils import human_size
+        self.assertEqual(human_size(512 * 1024 ** 2), '512M')
+        self.assertEqual(human_size(int(9.71 * 1024 ** 3)), '9.8G')
+        self.assertEqual(human_size(int(44.2 * 1024 ** 3)), '45G')
+
+    def test_read_meminfo(self):
+        import os
+        import tempfile
+        from .utils import read_meminfo
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('MemTotal:        6158152 kB\n'
+                        'HugePages_Total:       0\n')
+            self.assertEqual(read_meminfo(path),
+                             {'MemTotal': 6158152 * 1024,
+                              'HugePages_Total': 0})
+        finally:
+            os.remove(path)
+
+    def test_collect_system_metrics(self):
+        import platform
+        import tempfile
+        from .utils import collect_system_metrics
+        metrics = collect_system_metrics(tempfile.gettempdir())
+        for key in ('os', 'os_version', 'ram', 'disk_space_available'):
+            self.assertTrue(key in metrics)
+        self.assertTrue(metrics['disk_space_available_bytes'] > 0)
+        if platform.system() == 'Linux':
+            self.assertTrue(metrics['ram_bytes'] > 0)
+            self.assertEqual(len(metrics['load_average']), 3)
+            self.assertTrue('idle' in metrics['cpu_times'])
+
+
+class TestSysIndex(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.bin_dir = tempfile.mkdtemp()
+        self.old_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.bin_dir
+
+    def tearDown(self):
+        import os
+        import shutil
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.bin_dir)
+
+    def make_executable(self, name):
+        import os
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(path, 0755)
+        return path
+
+    def test_executable_index_sees_new_executables(self):
+        import os
+        import time
+        from .sysindex import ExecutableIndex
+        index = ExecutableIndex()
+        self.assertEqual(index.which('foma'), None)
+        mtime = os.stat(self.bin_dir).st_mtime
+        path = self.make_executable('foma')
+        # Make sure the directory's mtime changes even on coarse filesystems.
+        os.utime(self.bin_dir, (time.time(), mtime + 1))
+        self.assertEqual(index.which('foma'), path)
+
+    def test_parse_new_format_ld_so_cache(self):
+        import struct
+        from .sysindex import LD_SO_CACHE_NEW_MAGIC, parse_ld_so_cache
+        strings = 'libmagic.so.1\0/usr/lib/libmagic.so.1\0'
+        strings_offset = 48 + 24
+        header = LD_SO_CACHE_NEW_MAGIC + struct.pack(
+            '=IIB3xIIII', 1, len(strings), 0, 0, 0, 0, 0)
+        entry = struct.pack('=iIIIQ', 0, strings_offset,
+                            strings_offset + len('libmagic.so.1\0'), 0, 0)
+        self.assertEqual(parse_ld_so_cache(header + entry + strings),
+                         {'libmagic.so.1': '/usr/lib/libmagic.so.1'})
+
+    def test_library_index_matches_ldconfig(self):
+        import os
+        from subprocess import Popen, PIPE
+        from .sysindex import LD_SO_CACHE, LibraryIndex
+        if not (os.path.isfile(LD_SO_CACHE) and
+                os.path.isfile('/sbin/ldconfig')):
+            return
+        stdout = Popen(['/sbin/ldconfig', '-p'], stdout=PIPE).communicate()[0]
+        expected = set(line.split()[0] for line in stdout.splitlines()
+                       if line.startswith('\t'))
+        index = LibraryIndex()
+        self.assertEqual(set(index.get_libraries()), expected)
+        libc = [name for name in expected if name.startswith('libc.so')]
+        if libc:
+            self.assertTrue(index.installed('libc'))
+        self.assertFalse(index.installed('libnosuchlibrary'))
+
+    def test_package_index_reads_dpkg_status(self):
+        import os
+        import time
+        from .sysindex import PackageIndex
+        path = os.path.join(self.bin_dir, 'status')
+        with open(path, 'w') as f:
+            f.write('Package: flex\nStatus: install ok installed\n'
+                    'Description: fast lexical analyzer\n more text\n\n'
+                    'Package: subversion\n'
+                    'Status: deinstall ok config-files\n')
+        index = PackageIndex(path)
+        self.assertTrue(index.installed('flex'))
+        self.assertTrue(index.installed('flex:amd64'))
+        self.assertFalse(index.installed('subversion'))
+        with open(path, 'a') as f:
+            f.write('\nPackage: libmagic-dev\nStatus: install ok installed\n')
+        os.utime(path, (time.time(), time.time() + 1))
+        self.assertTrue(index.installed('libmagic-dev'))
+
+
+class TestSettingsInvalidation(unittest.TestCase):
+
+    def test_only_env_probe_depends_on_env_dir(self):
+        from .utils import get_affected_probes
+        self.assertEqual([probe.name for probe in
+                          get_affected_probes(['env_dir'])], ['env'])
+        self.assertEqual(get_affected_probes(['apps_path', 'mysql_user']), [])
+
+    def test_unrelated_settings_reuse_previous_state(self):
+        from .utils import DEPENDENCY_NAMES, update_dependencies, update_server
+        previous_dependencies = [
+            {'name': name, 'installed': True, 'version': '1'}
+            for name in DEPENDENCY_NAMES]
+        previous_server = {'os': 'Linux', 'disk_space_available': '1GB'}
+        settings = {'env_dir': 'env', 'apps_path': '/tmp'}
+        self.assertEqual(update_dependencies(settings, previous_dependencies,
+                                             ['mysql_user']),
+                         previous_dependencies)
+        self.assertEqual(update_server(settings, previous_server,
+                                       ['mysql_user']), previous_server)
+
+    def test_apps_path_only_recomputes_disk_space(self):
+        from .utils import update_server
+        previous_server = {'os': 'Previous', 'disk_space_available': '0B'}
+        server = update_server({'apps_path': '/tmp'}, previous_server,
+                               ['apps_path'])
+        self.assertEqual(server['os'], 'Previous')
+        self.assertNotEqual(server['disk_space_available'], '0B')
+        self.assertTrue(server['disk_space_total_bytes'] > 0)
+
+
+class TestProbeStats(unittest.TestCase):
+
+    def test_report(self):
+        from .probes import ProbeStats
+        stats = ProbeStats(window=100)
+        for i in range(1, 101):
+            stats.record('tool', i / 100.0)
+        stats.record_timeout('tool')
+        stats.record_cache_hit('tool')
+        report = stats.report()['tool']
+        self.assertEqual(report['count'], 100)
+        self.assertEqual(report['p50'], 0.5)
+        self.assertEqual(report['p95'], 0.95)
+        self.assertEqual(report['max'], 1.0)
+        self.assertEqual(report['timeouts'], 1)
+        self.assertEqual(report['cache_hits'], 1)
+
+    def test_run_probes_records_timings_and_timeouts(self):
+        import time
+        from .probes import Probe, probe_stats, run_probes
+        probe_stats.clear()
+        run_probes([Probe('fast', lambda: None),
+                    Probe('hung', time.sleep, (1,))], timeout=0.1)
+        report = probe_stats.report()
+        self.assertEqual(report['fast']['count'], 1)
+        self.assertEqual(report['hung']['timeouts'], 1)
+
+
+class TestUpgradeSchema(unittest.TestCase):
+
+    def test_missing_columns_are_added(self):
+        from sqlalchemy import create_engine, inspect
+        from .models import upgrade_schema
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE probesnapshots (id INTEGER PRIMARY KEY)')
+        upgrade_schema(engine)
+        columns = [c['name'] for c in
+                   inspect(engine).get_columns('probesnapshots')]
+        self.assertIn('refresh_duration', columns)
+        self.assertIn('users', inspect(engine).get_table_names())
+
+    def test_legacy_state_is_migrated(self):
+        import datetime
+        from sqlalchemy import create_engine, inspect
+        from .models import (ProbeSnapshot, SenexSettings, SenexState,
+                             upgrade_schema)
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE senexstate (id INTEGER PRIMARY KEY,'
+                       ' installation_in_progress BOOLEAN,'
+                       ' old_change_in_progress BOOLEAN, server_state TEXT,'
+                       ' dependency_state TEXT, last_state_check DATETIME,'
+                       ' mysql_user VARCHAR(255), env_dir VARCHAR(255))')
+        for i, env_dir in enumerate(['env-a', 'env-b']):
+            engine.execute(
+                "INSERT INTO senexstate VALUES (?, 0, 0, '{}', '[]', ?,"
+                " 'old', ?)", (i + 1, datetime.datetime.utcnow(), env_dir))
+        upgrade_schema(engine)
+        # Upgrading again, e.g., on the next start, migrates nothing.
+        upgrade_schema(engine)
+        self.assertIn('senexstate', inspect(engine).get_table_names())
+        DBSession.configure(bind=engine)
+        try:
+            senex_state = DBSession.query(SenexState).one()
+            self.assertEqual(senex_state.settings.env_dir, 'env-b')
+            self.assertEqual(senex_state.snapshot.dependency_state, '[]')
+            self.assertTrue(senex_state.snapshot.last_state_check)
+            # The whole history is migrated.
+            self.assertEqual(
+                DBSession.query(SenexSettings.env_dir).\
+                    join(ProbeSnapshot,
+                         ProbeSnapshot.settings_id == SenexSettings.id).\
+                    order_by(ProbeSnapshot.id).all(),
+                [('env-a',), ('env-b',)])
+        finally:
+            DBSession.remove()
+
+
+class TestStateRefresher(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        from sqlalchemy import create_engine
+        from . import state
+        from .models import (Base, CURRENT_STATE_ID, ProbeSnapshot,
+                             SenexSettings, SenexState)
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(SenexState(
+                id=CURRENT_STATE_ID, settings=SenexSettings(),
+                snapshot=ProbeSnapshot(
+                    server_state=u'{"os": "stale"}', dependency_state=u'[]',
+                    last_state_check=datetime.datetime.utcnow() -
+                        datetime.timedelta(days=1))))
+        self.scheduled = []
+        self.probed = []
+        test = self
+        class Refresher(object):
+            refreshing = True
+            def is_alive(self):
+                return True
+            def schedule(self, use_cache=True):
+                test.scheduled.append(use_cache)
+        def create(senex_state, use_cache):
+            self.probed.append(use_cache)
+            return {'os': 'fresh'}, [], {}
+        self.originals = state.state_refresher, state._create_new_state
+        state.state_refresher = Refresher()
+        state._create_new_state = create
+
+    def tearDown(self):
+        from . import state
+        state.state_refresher, state._create_new_state = self.originals
+        DBSession.remove()
+
+    def test_stale_state_is_returned_while_a_refresh_is_scheduled(self):
+        from .state import get_state
+        server_state, dependency_state, settings, installation_in_progress, \
+            refreshing = get_state()
+        self.assertEqual(server_state, {'os': 'stale'})
+        self.assertTrue(refreshing)
+        self.assertEqual(self.scheduled, [True])
+        self.assertEqual(self.probed, [])
+
+    def test_waiting_for_the_state_probes_synchronously(self):
+        from .state import get_state
+        server_state = get_state(True, use_cache=False, wait=True)[0]
+        self.assertEqual(server_state, {'os': 'fresh'})
+        self.assertEqual(self.probed, [False])
+        self.assertEqual(self.scheduled, [])
+
+    def test_scheduled_refreshes_are_merged(self):
+        from .state import StateRefresher
+        refresher = StateRefresher()
+        refresher.schedule()
+        refresher.schedule(use_cache=False)
+        refresher.schedule()
+        # One refresh is pending, and it bypasses the probe cache.
+        self.assertIs(refresher.pending, False)
+        self.assertTrue(refresher.refreshing)
+        self.assertTrue(refresher.wakeup.is_set())
+
+
+class TestSnapshotRetention(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        DBSession.remove()
+
+    def test_compaction_keeps_recent_and_current_snapshots(self):
+        import datetime
+        from .models import (CURRENT_STATE_ID, ProbeSnapshot, SenexSettings,
+                             SenexState)
+        from .state import compact_snapshots
+        now = datetime.datetime.utcnow()
+        with transaction.manager:
+            old_settings = SenexSettings(env_dir=u'env-a')
+            settings = SenexSettings(env_dir=u'env-b')
+            DBSession.add_all([old_settings, settings])
+            DBSession.flush()
+            for i in range(10):
+                DBSession.add(ProbeSnapshot(
+                    settings_id=(old_settings if i < 5 else settings).id,
+                    server_state=u'{}', dependency_state=u'[]',
+                    last_state_check=now - datetime.timedelta(days=10 - i)))
+            DBSession.flush()
+            current = DBSession.query(ProbeSnapshot).order_by(
+                ProbeSnapshot.id).first()
+            DBSession.add(SenexState(id=CURRENT_STATE_ID, settings=settings,
+                                     snapshot=current))
+        with transaction.manager:
+            self.assertEqual(compact_snapshots(keep=3), 6)
+        ids = [id for (id,) in
+               DBSession.query(ProbeSnapshot.id).order_by(ProbeSnapshot.id)]
+        self.assertEqual(ids, [1, 8, 9, 10])
+        with transaction.manager:
+            compact_snapshots(keep=3, max_age=datetime.timedelta(days=2))
+        self.assertEqual(DBSession.query(ProbeSnapshot).count(), 2)
+        self.assertEqual(DBSession.query(SenexSettings).count(), 2)
+
+
+class TestStateInsertBenchmark(unittest.TestCase):
+    """Inserting Senex state rows must never probe the server."""
+
+    def setUp(self):
+        import subprocess
+        from sqlalchemy import create_engine
+        from .models import Base
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        self.spawned = []
+        self.execute_child = subprocess.Popen._execute_child
+        def execute_child(popen, args, *rest):
+            self.spawned.append(args)
+            return self.execute_child(popen, args, *rest)
+        subprocess.Popen._execute_child = execute_child
+
+    def tearDown(self):
+        import subprocess
+        subprocess.Popen._execute_child = self.execute_child
+        DBSession.remove()
+
+    def test_insert_spawns_no_subprocess(self):
+        import time
+        from .models import (CURRENT_STATE_ID, ProbeSnapshot, SenexSettings,
+                             SenexState)
+        start = time.time()
+        with transaction.manager:
+            DBSession.add(SenexState(id=CURRENT_STATE_ID,
+                                     settings=SenexSettings()))
+            for i in range(50):
+                DBSession.add(ProbeSnapshot())
+        elapsed = time.time() - start
+        self.assertEqual(self.spawned, [])
+        self.assertTrue(elapsed < 1, 'inserts took %.3f seconds' % elapsed)
+        senex_state = DBSession.query(SenexState).get(CURRENT_STATE_ID)
+        self.assertEqual(senex_state.snapshot, None)
+        self.assertEqual(senex_state.settings.env_dir, u'env-old')
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        from sqlalchemy import create_engine, event
+        from .models import (Base, CURRENT_STATE_ID, OLD, ProbeSnapshot,
+                             SenexSettings, SenexState)
+        self.config = testing.setUp()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(SenexState(
+                id=CURRENT_STATE_ID, settings=SenexSettings(),
+                snapshot=ProbeSnapshot(
+                    server_state=u'{}', dependency_state=u'[]',
+                    last_state_check=datetime.datetime.utcnow())))
+            DBSession.add(OLD(name=u'bla', dir_name=u'blaold', port=u'9000'))
+            DBSession.add(OLD(name=u'cra', dir_name=u'craold', port=u'9001'))
+        DBSession.remove()
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     self.statements.append(statement))
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def get_request(self):
+        from .cache import RequestCache
+        request = testing.DummyRequest()
+        request.cache = RequestCache(request)
+        return request
+
+    def count_selects(self, table):
+        return len([s for s in self.statements
+                    if s.startswith('SELECT') and 'FROM %s' % table in s])
+
+    def test_state_and_olds_are_fetched_once_per_request(self):
+        from .state import get_state
+        from .views import (get_build_params, get_current_state,
+                            get_old_by_name, get_olds)
+        request = self.get_request()
+        old = get_old_by_name(request, u'bla')
+        build_params = get_build_params(request, old)
+        get_state(True, senex_state=get_current_state(request))
+        self.assertEqual(len(get_olds(request)), 2)
+        self.assertEqual(build_params['used_ports'],
+                         {u'blaold': u'9000', u'craold': u'9001'})
+        self.assertEqual(self.count_selects('senexcurrentstate'), 1)
+        self.assertEqual(self.count_selects('olds'), 1)
+
+    def test_invalidate(self):
+        from .models import OLD
+        from .views import get_olds
+        request = self.get_request()
+        self.assertEqual(len(get_olds(request)), 2)
+        DBSession.add(OLD(name=u'dak', dir_name=u'dakold', port=u'9002'))
+        request.cache.invalidate('olds')
+        self.assertEqual(len(get_olds(request)), 3)
+        self.assertEqual(self.count_selects('olds'), 2)
+
+
+class TestSettingsCache(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine, event
+        from .models import Base, CURRENT_STATE_ID, SenexSettings, SenexState
+        from .state import settings_cache
+        settings_cache.invalidate()
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(SenexState(id=CURRENT_STATE_ID,
+                                     settings=SenexSettings(env_dir=u'env-a')))
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     self.statements.append(statement))
+
+    def tearDown(self):
+        from .state import settings_cache
+        settings_cache.invalidate()
+        DBSession.remove()
+
+    def settings_selects(self):
+        return len([s for s in self.statements
+                    if s.startswith('SELECT') and 'FROM senexsettings' in s])
+
+    def test_settings_are_reloaded_only_when_their_version_changes(self):
+        from .state import get_current_settings
+        self.assertEqual(get_current_settings()['env_dir'], u'env-a')
+        self.assertEqual(get_current_settings()['env_dir'], u'env-a')
+        self.assertEqual(self.settings_selects(), 1)
+        # Another process changes the settings.
+        self.engine.execute("INSERT INTO senexsettings (id, env_dir)"
+                            " VALUES (2, 'env-b')")
+        self.engine.execute("UPDATE senexcurrentstate SET settings_id = 2")
+        DBSession.remove()
+        self.assertEqual(get_current_settings()['env_dir'], u'env-b')
+        self.assertEqual(self.settings_selects(), 2)
+
+    def test_committed_settings_changes_update_the_cache(self):
+        from .models import SenexSettings
+        from .state import (get_current_settings, get_senex_state_model,
+                            settings_changed)
+        get_current_settings()
+        with transaction.manager:
+            new_settings = SenexSettings(env_dir=u'env-c')
+            DBSession.add(new_settings)
+            DBSession.flush()
+            get_senex_state_model().settings = new_settings
+            settings_changed(new_settings)
+        selects = self.settings_selects()
+        self.assertEqual(get_current_settings()['env_dir'], u'env-c')
+        self.assertEqual(self.settings_selects(), selects)
+
+
+class TestPrincipalCache(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base, User
+        from .security import principal_cache
+        principal_cache.invalidate()
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            DBSession.add(User(username=u'admin',
+                               groups=u'["group:editors"]'))
+
+    def tearDown(self):
+        from .security import principal_cache
+        principal_cache.invalidate()
+        DBSession.remove()
+
+    def test_principals_are_cached_until_invalidated(self):
+        from .models import User
+        from .security import get_principal, invalidate_principals
+        self.assertEqual(get_principal(u'admin').groups, ('group:editors',))
+        with transaction.manager:
+            DBSession.query(User).filter_by(username=u'admin').update(
+                {'groups': u'[]'})
+        self.assertEqual(get_principal(u'admin').groups, ('group:editors',))
+        invalidate_principals(u'admin')
+        self.assertEqual(get_principal(u'admin').groups, ())
+        self.assertEqual(get_principal(u'nobody'), None)
+
+    def test_principals_are_invalidated_on_commit(self):
+        from .models import User
+        from .security import get_principal, principal_cache, users_changed
+        get_principal(u'admin')
+        with transaction.manager:
+            DBSession.query(User).filter_by(username=u'admin').update(
+                {'groups': u'[]'})
+            users_changed(u'admin')
+            self.assertNotEqual(principal_cache.get(u'admin'), None)
+        self.assertEqual(principal_cache.get(u'admin'), None)
+        self.assertEqual(get_principal(u'admin').groups, ())
+        # Aborted changes leave the cache alone.
+        with transaction.manager:
+            users_changed(u'admin')
+            transaction.abort()
+        self.assertNotEqual(principal_cache.get(u'admin'), None)
+
+    def test_lru_cache_evicts_and_expires(self):
+        import time
+        from .cache import LRUCache
+        cache = LRUCache(maxsize=2, ttl=0.1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.15)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestLogin(unittest.TestCase):
+
+    def test_verify_password(self):
+        from .utils import encrypt_password, generate_salt, verify_password
+        password_hash = encrypt_password(u'adminAA11!!', str(generate_salt()))
+        self.assertTrue(verify_password(u'adminAA11!!', password_hash))
+        self.assertFalse(verify_password(u'wrong', password_hash))
+        self.assertFalse(verify_password(u'adminAA11!!', None))
+
+    def test_throttle(self):
+        from .security import Throttle
+        throttle = Throttle(2, 60)
+        self.assertTrue(throttle.hit('admin'))
+        self.assertTrue(throttle.hit('admin'))
+        self.assertFalse(throttle.hit('admin'))
+        self.assertTrue(throttle.hit('other'))
+        throttle.reset('admin')
+        self.assertTrue(throttle.hit('admin'))
+
+    def test_hashing_pool_rejects_jobs_when_its_backlog_is_full(self):
+        import threading
+        from .security import HashingPool, HashingPoolBusy
+        pool = HashingPool(workers=1, backlog=1)
+        running = threading.Event()
+        release = threading.Event()
+        def job():
+            running.set()
+            release.wait()
+        threads = [threading.Thread(target=pool.run, args=(job,))]
+        threads[0].start()
+        running.wait()
+        threads.append(threading.Thread(target=pool.run, args=(job,)))
+        threads[1].start()
+        while not pool.jobs.full():
+            release.wait(0.01)
+        self.assertRaises(HashingPoolBusy, pool.run, lambda: None)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(pool.run(lambda x: x * 2, 21), 42)
+
+    def test_throttled_login_is_rejected_before_hashing(self):
+        from . import views
+        from .security import LOGIN_ATTEMPTS_PER_USERNAME, LoginThrottle
+        class NoPool(object):
+            def run(self, *args):
+                raise AssertionError('the password was hashed')
+        config = testing.setUp()
+        config.add_route('login', '/login')
+        old_throttle, old_pool = views.login_throttle, views.hashing_pool
+        views.login_throttle = LoginThrottle()
+        views.hashing_pool = NoPool()
+        try:
+            for i in range(LOGIN_ATTEMPTS_PER_USERNAME):
+                views.login_throttle.allow(u'admin', '10.0.0.1')
+            request = testing.DummyRequest(params={
+                'form.submitted': 'Log In', 'login': u'admin',
+                'password': u'x'})
+            request.client_addr = '10.0.0.2'
+            self.assertIn('Too many', views.login(request)['message'])
+        finally:
+            views.login_throttle, views.hashing_pool = old_throttle, old_pool
+            testing.tearDown()
+
+
+class TestStorageConcurrency(unittest.TestCase):
+    """Parallel page loads together with background job state writes must not
+    fail with "database is locked".
+
+    """
+
+    def setUp(self):
+        import tempfile
+        from .models import (Base, CURRENT_STATE_ID, OLD, SenexSettings,
+                             SenexState)
+        from .storage import create_senex_engine
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_senex_engine({
+            'sqlalchemy.url': 'sqlite:///%s/senex.sqlite' % self.dir})
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(SenexState(id=CURRENT_STATE_ID,
+                                     settings=SenexSettings()))
+            for i in range(50):
+                DBSession.add(OLD(name=u'old%s' % i, dir_name=u'old%sold' % i,
+                                  port=unicode(9000 + i)))
+        DBSession.remove()
+
+    def tearDown(self):
+        import shutil
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def test_parallel_reads_and_writes(self):
+        import threading
+        import time
+        from .models import CURRENT_STATE_ID, OLD, SenexState
+        errors = []
+        counts = {'reads': 0, 'writes': 0}
+        deadline = time.time() + 1
+        def load_pages():
+            try:
+                while time.time() < deadline:
+                    with transaction.manager:
+                        DBSession.query(SenexState).get(CURRENT_STATE_ID)
+                        DBSession.query(OLD).all()
+                        # Page loads write too, e.g., when settings are saved.
+                        DBSession.query(OLD).filter_by(name=u'old0').update(
+                            {'running': True}, synchronize_session=False)
+                    counts['reads'] += 1
+            except Exception, e:
+                errors.append(e)
+            finally:
+                DBSession.remove()
+        def write_job_state():
+            try:
+                while time.time() < deadline:
+                    with transaction.manager:
+                        senex_state = DBSession.query(SenexState).get(
+                            CURRENT_STATE_ID)
+                        senex_state.installation_in_progress = \
+                            not senex_state.installation_in_progress
+                    counts['writes'] += 1
+            except Exception, e:
+                errors.append(e)
+            finally:
+                DBSession.remove()
+        threads = [threading.Thread(target=load_pages) for i in range(8)]
+        threads.append(threading.Thread(target=write_job_state))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(counts['reads'] > 0 and counts['writes'] > 0)
+        mode = self.engine.execute('PRAGMA journal_mode').scalar()
+        self.assertEqual(mode, 'wal')
+
+
+class TestListing(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from .models import Base, OLD
+        self.config = testing.setUp()
+        self.config.add_route('view_old', '/olds/{oldname}')
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        with transaction.manager:
+            for i in range(60):
+                DBSession.add(OLD(name=u'old%02d' % i,
+                                  dir_name=u'old%02dold' % i,
+                                  human_name=u'Language %s' % i,
+                                  port=unicode(9000 + i)))
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def get_listing(self, **params):
+        from sqlalchemy import Integer, cast
+        from .models import OLD
+        from .listing import Listing
+        request = testing.DummyRequest(params=params)
+        request.GET = params
+        return Listing(request, 'olds', DBSession.query(OLD),
+                       sort_columns={'name': OLD.name,
+                                     'port': cast(OLD.port, Integer)},
+                       search_columns=[OLD.name, OLD.human_name],
+                       url_prefix=request.route_url('view_old', oldname=''),
+                       url_key='name', default_sort='name', page_size=25)
+
+    def test_pagination_and_sorting(self):
+        listing = self.get_listing(olds_page='3', olds_sort='port',
+                                   olds_order='desc')
+        self.assertEqual((listing.total, listing.pages, listing.page),
+                         (60, 3, 3))
+        self.assertEqual([row['model'].name for row in listing.rows][:2],
+                         [u'old09', u'old08'])
+        self.assertEqual(listing.rows[0]['url'],
+                         'http://example.com/olds/old09')
+        self.assertEqual(listing.next_url, None)
+        self.assertIn('olds_page=2', listing.prev_url)
+        self.assertIn('olds_order=asc', listing.sort_url('port'))
+
+    def test_search(self):
+        listing = self.get_listing(olds_q=u'old1', olds_page='9')
+        self.assertEqual(listing.total, 10)
+        self.assertEqual(listing.page, 1)
+        self.assertEqual(self.get_listing(olds_q=u'Language 5').total, 11)
+        self.assertEqual(self.get_listing(olds_q=u'%').total, 0)
+
+    def test_search_uses_indexes(self):
+        from sqlalchemy import event
+        engine = DBSession.get_bind()
+        statements = []
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            self.get_listing(olds_q=u'old1')
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), 2)
+        for statement, parameters in statements:
+            plan = [row[-1] for row in engine.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters)]
+            self.assertFalse([step for step in plan if 'SCAN' in step], plan)
+            self.assertTrue([step for step in plan if 'USING INDEX' in step])
+
+    def test_ports_are_sorted_numerically(self):
+        from .models import OLD
+        with transaction.manager:
+            DBSession.add(OLD(name=u'big', dir_name=u'bigold', port=u'10000'))
+        listing = self.get_listing(olds_sort='port', olds_order='desc')
+        self.assertEqual(listing.rows[0]['model'].name, u'big')
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from .models import (Base, CURRENT_STATE_ID, JobSession,
+                             SenexSettings, SenexState)
+        from .storage import create_senex_engine
+        from . import worker
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_senex_engine({
+            'sqlalchemy.url': 'sqlite:///%s/senex.sqlite' % self.dir})
+        DBSession.configure(bind=self.engine)
+        JobSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(SenexState(id=CURRENT_STATE_ID,
+                                     settings=SenexSettings()))
+        self.calls = []
+        def handler(**kwargs):
+            self.calls.append(kwargs)
+            if kwargs.get('fail'):
+                raise SystemExit('Unable to install.')
+        worker.JOB_HANDLERS['test'] = handler
+        worker.JOB_FLAGS['test'] = 'old_change_in_progress'
+
+    def tearDown(self):
+        import shutil
+        from . import worker
+        del worker.JOB_HANDLERS['test']
+        del worker.JOB_FLAGS['test']
+        DBSession.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def enqueue(self, args, max_attempts=3):
+        from .worker import JOB_SUBMITTED, submit_job
+        status, job_id = submit_job('test', args, max_attempts=max_attempts)
+        self.assertEqual(status, JOB_SUBMITTED)
+        return job_id
+
+    def get_job_and_flag(self, job_id):
+        from .models import CURRENT_STATE_ID, Job, SenexState
+        from .worker import job_session
+        with job_session() as session:
+            job = session.query(Job).get(job_id)
+            flag = session.query(SenexState).get(
+                CURRENT_STATE_ID).old_change_in_progress
+            return job.state, job.attempts, job.error, flag
+
+    def test_job_succeeds(self):
+        from .worker import WorkerThread
+        job_id = self.enqueue({'name': u'bla'})
+        self.assertTrue(WorkerThread().run_next())
+        self.assertEqual(self.calls, [{'name': u'bla'}])
+        self.assertEqual(self.get_job_and_flag(job_id),
+                         (u'succeeded', 1, None, False))
+        self.assertFalse(WorkerThread().run_next())
+
+    def test_failed_job_is_not_retried(self):
+        from .worker import WorkerThread
+        job_id = self.enqueue({'fail': True}, max_attempts=2)
+        self.assertTrue(WorkerThread().run_next())
+        state, attempts, error, flag = self.get_job_and_flag(job_id)
+        self.assertEqual((state, attempts, flag), (u'failed', 1, False))
+        self.assertIn('Unable to install.', error)
+        self.assertFalse(WorkerThread().run_next())
+        self.assertEqual(len(self.calls), 1)
+
+    def test_orphaned_job_is_retried(self):
+        import datetime
+        from .models import Job
+        from .worker import WorkerThread, claim_job, job_session
+        job_id = self.enqueue({'name': u'bla'}, max_attempts=2)
+        with job_session() as session:
+            claim_job(session)
+            session.query(Job).get(job_id).heartbeat = \
+                datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        # The orphan is requeued, but its retry is delayed.
+        self.assertFalse(WorkerThread().run_next())
+        state, attempts, error, flag = self.get_job_and_flag(job_id)
+        self.assertEqual((state, attempts, flag), (u'queued', 1, True))
+        self.assertIn('stopped responding', error)
+        with job_session() as session:
+            session.query(Job).get(job_id).available_at = \
+                datetime.datetime.utcnow()
+        self.assertTrue(WorkerThread().run_next())
+        self.assertEqual(self.get_job_and_flag(job_id),
+                         (u'succeeded', 2, None, False))
+
+    def test_orphaned_jobs_are_recovered(self):
+        import datetime
+        from .models import Job
+        from .worker import claim_job, job_session, recover_orphaned_jobs
+        job_id = self.enqueue({}, max_attempts=1)
+        with job_session() as session:
+            self.assertEqual(claim_job(session).id, job_id)
+            self.assertEqual(recover_orphaned_jobs(session), 0)
+            # The worker died an hour ago.
+            session.query(Job).get(job_id).heartbeat = \
+                datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        with job_session() as session:
+            self.assertEqual(recover_orphaned_jobs(session), 1)
+        self.assertEqual(self.get_job_and_flag(job_id)[:2], (u'failed', 1))
+        self.assertEqual(self.get_job_and_flag(job_id)[3], False)
+        self.assertEqual(self.calls, [])
+
+    def test_duplicate_submissions_are_coalesced(self):
+        from . import worker
+        job_id = self.enqueue({'name': u'bla'})
+        self.assertEqual(self.get_job_and_flag(job_id)[3], True)
+        self.assertEqual(worker.submit_job('test', {'name': u'bla'}),
+                         (worker.JOB_ALREADY_QUEUED, job_id))
+        self.assertNotEqual(self.enqueue({'name': u'blu'}), job_id)
+        worker.WorkerThread().run_next()
+        # Once the job has ended, the same operation can be submitted again.
+        self.assertNotEqual(self.enqueue({'name': u'bla'}), job_id)
+
+    def test_full_queue_refuses_submissions(self):
+        from . import worker
+        max_queued_jobs = worker.MAX_QUEUED_JOBS
+        worker.MAX_QUEUED_JOBS = 2
+        try:
+            self.enqueue({'name': u'bla'})
+            self.enqueue({'name': u'blu'})
+            self.assertEqual(worker.submit_job('test', {'name': u'ble'}),
+                             (worker.JOB_QUEUE_FULL, None))
+        finally:
+            worker.MAX_QUEUED_JOBS = max_queued_jobs
+
+    def test_job_changes_are_published(self):
+        from . import worker
+        from .events import event_bus
+        worker.JOB_HANDLERS['test'] = lambda: worker.set_job_step('step1')
+        cursor = event_bus.cursor()
+        job_id = self.enqueue({})
+        worker.WorkerThread().run_next()
+        events = event_bus.wait(cursor, timeout=0)['events']
+        self.assertEqual([(event['data']['state'], event['data']['step'])
+                          for event in events
+                          if event['data'].get('id') == job_id],
+                         [(u'queued', None), (u'running', None),
+                          (u'running', u'step1'), (u'succeeded', u'step1')])
+
+
+class TestEventBus(unittest.TestCase):
+
+    def test_wait_returns_events_after_cursor(self):
+        import threading
+        import time
+        from .events import EventBus
+        bus = EventBus()
+        cursor = bus.cursor()
+        bus.publish('old', name=u'bla', running=True)
+        response = bus.wait(cursor)
+        self.assertEqual([event['data'] for event in response['events']],
+                         [{'name': u'bla', 'running': True}])
+        # A poll that is up to date waits for the next event.
+        timer = threading.Timer(0.1, bus.publish, ('job',), {'id': 1})
+        timer.start()
+        start = time.time()
+        response = bus.wait(response['cursor'], timeout=5)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual([event['type'] for event in response['events']],
+                         ['job'])
+        self.assertEqual(bus.wait(response['cursor'], timeout=0)['events'],
+                         [])
+
+    def test_unreplayable_cursors_reset(self):
+        from .events import EventBus
+        bus = EventBus(size=2)
+        cursor = bus.cursor()
+        self.assertTrue(EventBus().wait(cursor, timeout=0)['reset'])
+        self.assertTrue(bus.wait('nonsense', timeout=0)['reset'])
+        for i in range(3):
+            bus.publish('job', id=i)
+        self.assertTrue(bus.wait(cursor, timeout=0)['reset'])
+
+    def test_waiters_are_capped(self):
+        import threading
+        from .events import BACKOFF, EventBus
+        bus = EventBus(max_waiters=1)
+        cursor = bus.cursor()
+        waiter = threading.Thread(target=bus.wait, args=(cursor, 5))
+        waiter.start()
+        while not bus.waiters:
+            pass
+        response = bus.wait(cursor, timeout=5)
+        self.assertEqual((response['events'], response['retry']),
+                         ([], BACKOFF))
+        bus.publish('job', id=1)
+        waiter.join()
+
+    def test_requests_are_served_while_polls_wait(self):
+        import threading
+        import time
+        import urllib2
+        import waitress
+        from .events import EventBus
+        bus = EventBus()
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/events':
+                bus.wait(environ['QUERY_STRING'], timeout=10)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+        # Waitress's default thread pool.
+        server = waitress.create_server(app, host='127.0.0.1', port=0,
+                                        threads=4)
+        url = 'http://127.0.0.1:%s' % server.effective_port
+        thread = threading.Thread(target=server.run)
+        thread.setDaemon(True)
+        thread.start()
+        polls = [threading.Thread(target=urllib2.urlopen,
+                                  args=('%s/events?%s' % (url, bus.cursor()),))
+                 for i in range(4)]
+        try:
+            for poll in polls:
+                poll.start()
+            while bus.waiters < bus.max_waiters:
+                time.sleep(0.01)
+            start = time.time()
+            self.assertEqual(urllib2.urlopen(url + '/', timeout=5).read(),
+                             'ok')
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            bus.publish('job', id=1)
+            for poll in polls:
+                poll.join()
+            server.close()
+
+    def test_waiters_are_sized_from_server_threads(self):
+        import os
+        import tempfile
+        from .events import (DEFAULT_SERVER_THREADS, RESERVED_THREADS,
+                             configure_event_bus, event_bus)
+        default = event_bus.max_waiters
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('[server:main]\nuse = egg:waitress#main\n'
+                        'port = %(http_port)s\nthreads = 8\n')
+            self.assertEqual(configure_event_bus({}, path),
+                             8 - RESERVED_THREADS)
+            self.assertEqual(configure_event_bus({}),
+                             DEFAULT_SERVER_THREADS - RESERVED_THREADS)
+            self.assertEqual(
+                configure_event_bus({'senex.events.max_waiters': '20'}, path),
+                20)
+            self.assertEqual(
+                configure_event_bus({'senex.events.max_waiters': '0'}), 1)
+        finally:
+            os.remove(path)
+            event_bus.max_waiters = default
+
+
+class TestInstallSteps(unittest.TestCase):
+
+    def make_step(self, name, seconds=0, requires=(), compiles=False,
+                  error=None):
+        import threading
+        import time
+        from .installold import InstallStep
+        def func():
+            with self.lock:
+                self.started.append(name)
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(seconds)
+            with self.lock:
+                self.running -= 1
+            if error:
+                raise error
+        func.__name__ = name
+        if not hasattr(self, 'lock'):
+            self.lock = threading.Lock()
+        return InstallStep(func, requires=requires, compiles=compiles)
+
+    def setUp(self):
+        self.started = []
+        self.running = self.max_running = 0
+
+    def test_independent_steps_run_concurrently(self):
+        import time
+        from .installold import run_steps
+        steps = [self.make_step('a', 0.2), self.make_step('b', 0.2),
+                 self.make_step('c', 0.2, requires=('a',))]
+        progress = []
+        start = time.time()
+        timings = run_steps(steps, progress=progress.append)
+        self.assertTrue(time.time() - start < 0.55)
+        self.assertTrue(sum(timings.values()) >= 0.6)
+        self.assertEqual(self.max_running, 2)
+        self.assertTrue(self.started.index('c') > self.started.index('a'))
+        self.assertEqual(sorted(progress), ['a', 'b', 'c'])
+
+    def test_compiling_steps_are_capped(self):
+        from .installold import run_steps
+        steps = [self.make_step(name, 0.05, compiles=True)
+                 for name in ('a', 'b', 'c')]
+        run_steps(steps, compile_concurrency=1)
+        self.assertEqual(self.max_running, 1)
+
+    def test_failure_stops_dependent_steps(self):
+        from .installold import run_steps
+        steps = [self.make_step('a', error=SystemExit('No easy_install.')),
+                 self.make_step('b', requires=('a',)),
+                 self.make_step('c', 0.1)]
+        self.assertRaises(SystemExit, run_steps, steps)
+        self.assertNotIn('b', self.started)
+        self.assertRaises(ValueError, run_steps,
+                          [self.make_step('d', requires=('e',))])
+
+    def test_slow_progress_does_not_block_running_steps(self):
+        import time
+        from .installold import run_steps
+        steps = [self.make_step('a'), self.make_step('b')]
+        def progress(name):
+            if name == 'b':
+                time.sleep(0.3)
+        timings = run_steps(steps, progress=progress)
+        self.assertTrue(timings['a'] < 0.2)
+
+    def test_install_steps_form_a_dag(self):
+        from .installold import get_install_steps, run_steps
+        steps = get_install_steps({'env_dir': u'env-old'})
+        for step in steps:
+            step.func = lambda *args: None
+        timings = run_steps(steps)
+        self.assertEqual(set(timings), set(step.name for step in steps))
+        requires = dict((step.name, step.requires) for step in steps)
+        # Nothing is compiled before the toolchain is installed.
+        self.assertIn('install_apt_packages', requires['install_m4'])
+
+    def test_apt_packages_are_installed_in_one_transaction(self):
+        from . import installold
+        installed = set(['flex'])
+        commands = []
+        def shell(cmd_list, cwd=None, timeout=None, env=None):
+            if cmd_list[:2] == ['apt-cache', 'policy']:
+                # apt knows no subversion and has no candidate for
+                # libmagic-dev.
+                return ''.join(
+                    '%s:\n  Installed: (none)\n  Candidate: %s\n' % (
+                        package,
+                        '(none)' if package == 'libmagic-dev' else '1.0')
+                    for package in cmd_list[2:] if package != 'subversion')
+            commands.append(cmd_list)
+            installed.update(cmd_list[4:])
+            return ''
+        # MITLM is installed already.
+        products = set(['apt-cache', 'estimate-ngram', 'evaluate-ngram'])
+        old = (installold.shell, installold.package_installed, installold.log,
+               installold.which, installold.mysql_python_installed,
+               installold.pil_installed)
+        installold.shell = shell
+        installold.package_installed = lambda name: name in installed
+        installold.log = lambda fname, text: None
+        installold.which = lambda program: program in products and program
+        installold.mysql_python_installed = lambda params: False
+        installold.pil_installed = lambda params: False
+        params = {'env_dir': u'env-old'}
+        try:
+            installold.install_apt_packages(params)
+            self.assertEqual(len(commands), 1)
+            self.assertEqual(commands[0][:4],
+                             ['sudo', 'apt-get', '-y', 'install'])
+            self.assertIn('python-setuptools', commands[0])
+            self.assertNotIn('flex', commands[0])
+            # The packages of installed products and the ones that cannot be
+            # installed are left out.
+            for package in installold.MITLM_DEPENDENCIES + [
+                    'subversion', 'libmagic-dev']:
+                self.assertNotIn(package, commands[0])
+            # The steps' own apt-get calls are now no-ops.
+            self.assertEqual(installold.aptget(installold.FOMA_DEPENDENCIES),
+                             '')
+            installold.install_apt_packages(params)
+            self.assertEqual(len(commands), 1)
+        finally:
+            (installold.shell, installold.package_installed, installold.log,
+             installold.which, installold.mysql_python_installed,
+             installold.pil_installed) = old
+
+    def test_apt_policy_is_parsed(self):
+        from .installold import parse_apt_policy
+        text = (
+            'N: Unable to locate package nonesuch\n'
+            'flex:\n'
+            '  Installed: (none)\n'
+            '  Candidate: 2.6.4-6\n'
+            '  Version table:\n'
+            '     2.6.4-6 500\n'
+            '        500 http://archive.ubuntu.com/ubuntu bionic/main amd64\n'
+            'libreadline6:amd64:\n'
+            '  Installed: (none)\n'
+            '  Candidate: (none)\n'
+            '  Version table:\n')
+        self.assertEqual(parse_apt_policy(text), set(['flex']))
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.mirror_dir = os.path.join(self.tmp_dir, 'mirror')
+        os.mkdir(self.mirror_dir)
+        self.data = self.make_archive()
+        with open(os.path.join(self.mirror_dir, 'm4.tar.gz'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def make_archive(self):
+        """Return a gzipped tarball of m4-1.4.10/README.
+
+        """
+
+        import StringIO
+        import tarfile
+        contents = 'm4 ' * 10000
+        buf = StringIO.StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        info = tarfile.TarInfo('m4-1.4.10/README')
+        info.size = len(contents)
+        tar.addfile(info, StringIO.StringIO(contents))
+        tar.close()
+        return buf.getvalue()
+
+    def serve(self, data, length=None):
+        """Serve `data` over HTTP, honouring Range headers, for one request and
+        return the server, its thread and the list of requested ranges. If
+        `length` is given, it is announced as the length of `data`, e.g., to
+        simulate a connection that is closed early.
+
+        """
+
+        import BaseHTTPServer
+        import threading
+        ranges = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                range_ = self.headers.get('Range')
+                ranges.append(range_)
+                start = int(range_[6:-1]) if range_ else 0
+                self.send_response(206 if range_ else 200)
+                self.send_header('Content-Length',
+                                 str((length or len(data)) - start))
+                self.end_headers()
+                self.wfile.write(data[start:])
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        return server, thread, ranges
+
+    def get_artifact(self, sha256=None):
+        from .artifacts import Artifact
+        return Artifact('m4.tar.gz', 'http://127.0.0.1:1/m4.tar.gz', sha256)
+
+    def test_mirrored_artifacts_are_cached(self):
+        import hashlib
+        import os
+        from .artifacts import ArtifactCache
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        path = cache.fetch(self.get_artifact())
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(path, cache.get_path(digest))
+        self.assertEqual(open(path, 'rb').read(), self.data)
+        # Without the mirror, the cached copy is used.
+        os.remove(os.path.join(self.mirror_dir, 'm4.tar.gz'))
+        cache = ArtifactCache(self.cache_dir, offline=True)
+        self.assertEqual(cache.fetch(self.get_artifact()), path)
+
+    def test_corrupt_and_mismatched_artifacts_are_rejected(self):
+        import os
+        from .artifacts import ArtifactCache, DownloadError
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        path = cache.fetch(self.get_artifact())
+        with open(path, 'wb') as f:
+            f.write('corrupt')
+        # The corrupt copy is replaced by the mirrored one.
+        self.assertEqual(cache.fetch(self.get_artifact()), path)
+        self.assertEqual(open(path, 'rb').read(), self.data)
+        self.assertRaises(DownloadError, cache.fetch,
+                          self.get_artifact(sha256='0' * 64))
+        # An archive that differs from the first one is rejected too.
+        with open(os.path.join(self.mirror_dir, 'm4.tar.gz'), 'wb') as f:
+            f.write('tampered')
+        os.remove(path)
+        self.assertRaises(DownloadError, cache.fetch, self.get_artifact())
+
+    def test_offline_fetch_without_copy_fails(self):
+        from .artifacts import ArtifactCache, DownloadError
+        cache = ArtifactCache(self.cache_dir, offline=True)
+        self.assertRaises(DownloadError, cache.fetch, self.get_artifact())
+
+    def test_interrupted_download_is_resumed(self):
+        import os
+        from .artifacts import Artifact, ArtifactCache
+        data = self.data
+        server, thread, ranges = self.serve(data)
+        try:
+            artifact = Artifact('m4.tar.gz', 'http://127.0.0.1:%s/m4.tar.gz' %
+                                server.server_address[1])
+            cache = ArtifactCache(self.cache_dir)
+            partial = cache.get_partial_path(artifact)
+            os.makedirs(os.path.dirname(partial))
+            with open(partial, 'wb') as f:
+                f.write(data[:50])
+            path = cache.fetch(artifact)
+        finally:
+            thread.join()
+            server.server_close()
+        self.assertEqual(ranges, ['bytes=50-'])
+        self.assertEqual(open(path, 'rb').read(), data)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_archives_are_extracted_while_read(self):
+        import os
+        from .artifacts import ArtifactCache
+        dest_dir = os.path.join(self.tmp_dir, 'tmp')
+        readme = os.path.join(dest_dir, 'm4-1.4.10', 'README')
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        path = cache.extract(self.get_artifact(), dest_dir)
+        self.assertEqual(open(readme).read(), 'm4 ' * 10000)
+        self.assertEqual(open(path, 'rb').read(), self.data)
+        # Without the mirror, the archive is extracted from the cache.
+        os.remove(readme)
+        os.remove(os.path.join(self.mirror_dir, 'm4.tar.gz'))
+        cache = ArtifactCache(self.cache_dir, offline=True)
+        self.assertEqual(cache.extract(self.get_artifact(), dest_dir), path)
+        self.assertTrue(os.path.isfile(readme))
+        self.assertEqual(os.listdir(dest_dir), ['m4-1.4.10'])
+
+    def test_mismatched_archives_are_not_extracted(self):
+        import os
+        from .artifacts import ArtifactCache, DownloadError
+        dest_dir = os.path.join(self.tmp_dir, 'tmp')
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        self.assertRaises(DownloadError, cache.extract,
+                          self.get_artifact(sha256='0' * 64), dest_dir)
+        self.assertEqual(os.listdir(dest_dir), [])
+        self.assertEqual(cache.read_index(), {})
+
+    def test_interrupted_download_is_resumed_while_extracting(self):
+        import os
+        from .artifacts import Artifact, ArtifactCache
+        data = self.data
+        dest_dir = os.path.join(self.tmp_dir, 'tmp')
+        server, thread, ranges = self.serve(data)
+        try:
+            artifact = Artifact('m4.tar.gz', 'http://127.0.0.1:%s/m4.tar.gz' %
+                                server.server_address[1])
+            cache = ArtifactCache(self.cache_dir)
+            partial = cache.get_partial_path(artifact)
+            os.makedirs(os.path.dirname(partial))
+            with open(partial, 'wb') as f:
+                f.write(data[:100])
+            path = cache.extract(artifact, dest_dir)
+        finally:
+            thread.join()
+            server.server_close()
+        self.assertEqual(ranges, ['bytes=100-'])
+        self.assertEqual(open(path, 'rb').read(), data)
+        self.assertTrue(os.path.isfile(
+            os.path.join(dest_dir, 'm4-1.4.10', 'README')))
+
+    def test_truncated_download_is_not_trusted(self):
+        import os
+        from .artifacts import Artifact, ArtifactCache, IncompleteDownload
+        data = self.data
+        server, thread, ranges = self.serve(data[:100], length=len(data))
+        try:
+            artifact = Artifact('m4.tar.gz', 'http://127.0.0.1:%s/m4.tar.gz' %
+                                server.server_address[1])
+            cache = ArtifactCache(self.cache_dir)
+            self.assertRaises(IncompleteDownload, cache.fetch, artifact)
+        finally:
+            thread.join()
+            server.server_close()
+        self.assertEqual(cache.read_index(), {})
+        # What was received is kept, so that the download can resume.
+        self.assertEqual(os.path.getsize(cache.get_partial_path(artifact)),
+                         100)
+
+    def test_downloads_of_unknown_length_are_not_recorded(self):
+        import os
+        from .artifacts import Artifact, ArtifactCache
+        path = os.path.join(self.tmp_dir, 'm4.tar.gz')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        cache = ArtifactCache(self.cache_dir)
+        artifact = Artifact('m4.tar.gz', 'file://' + path)
+        original = cache.open_download
+        def open_download(artifact):
+            partial, response, resumed, length = original(artifact)
+            return partial, response, resumed, None
+        cache.open_download = open_download
+        self.assertEqual(open(cache.fetch(artifact), 'rb').read(), self.data)
+        self.assertEqual(cache.read_index(), {})
+
+    def test_mirror_checksums_pin_archives(self):
+        import hashlib
+        import os
+        from .artifacts import ArtifactCache, DownloadError
+        with open(os.path.join(self.mirror_dir, 'SHA256SUMS'), 'w') as f:
+            f.write('%s  m4.tar.gz\n' % ('0' * 64))
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        self.assertRaises(DownloadError, cache.fetch, self.get_artifact())
+        with open(os.path.join(self.mirror_dir, 'SHA256SUMS'), 'w') as f:
+            f.write('%s *m4.tar.gz\n' % hashlib.sha256(self.data).hexdigest())
+        cache = ArtifactCache(self.cache_dir, self.mirror_dir, offline=True)
+        self.assertEqual(open(cache.fetch(self.get_artifact()), 'rb').read(),
+                         self.data)
+
+    def test_members_outside_of_the_archive_are_not_extracted(self):
+        import StringIO
+        import os
+        import tarfile
+        from .artifacts import ArtifactCache, DownloadError
+        def make_archive(*members):
+            buf = StringIO.StringIO()
+            tar = tarfile.open(fileobj=buf, mode='w:gz')
+            for info in members:
+                tar.addfile(info, StringIO.StringIO('x' * info.size))
+            tar.close()
+            return buf.getvalue()
+        evil = tarfile.TarInfo('../evil')
+        evil.size = 1
+        link = tarfile.TarInfo('m4-1.4.10/link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = self.tmp_dir
+        through_link = tarfile.TarInfo('m4-1.4.10/link/evil')
+        through_link.size = 1
+        dest_dir = os.path.join(self.tmp_dir, 'tmp')
+        for members in ([evil], [link, through_link]):
+            with open(os.path.join(self.mirror_dir, 'm4.tar.gz'), 'wb') as f:
+                f.write(make_archive(*members))
+            cache = ArtifactCache(os.path.join(self.tmp_dir, 'cache%s' %
+                                               len(members)),
+                                  self.mirror_dir, offline=True)
+            self.assertRaises(DownloadError, cache.extract,
+                              self.get_artifact(), dest_dir)
+            self.assertEqual(os.listdir(dest_dir), [])
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_dir,
+                                                         'evil')))
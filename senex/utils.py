@@ -1,17 +1,36 @@
+import functools
+import glob
+import math
 import platform
 import os
 import sys
+import threading
+from collections import namedtuple
 from subprocess import Popen, PIPE, STDOUT
 from uuid import uuid4
 from passlib.hash import pbkdf2_sha512
-from .installold import (
+from .probes import (
+    Probe,
+    PROBE_TIMEOUT,
+    file_fingerprint,
+    mark_incomplete,
+    probe_stats,
+    run_probes
+    )
+from .sysindex import (
     which,
+    library_installed,
+    )
+from .installold import (
+    ShellTimeout,
     shell,
-    mysql_python_installed,
-    old_installed,
-    importlib_installed,
-    pil_installed,
-    get_python_path
+    get_linux_id,
+    get_linux_release,
+    get_python_path,
+    inspect_env,
+    env_pil_installed,
+    env_pil_version,
+    read_meminfo
     )
 
 
@@ -28,9 +47,98 @@ def encrypt_password(password, salt):
     return pbkdf2_sha512.encrypt(password, salt=salt)
 
 
+# A hash to verify passwords against when there is no user to log in as, so
+# that a failed login takes as long whether or not the username exists.
+DUMMY_PASSWORD_HASH = pbkdf2_sha512.encrypt(u'', salt='dummy')
+
+
+def verify_password(password, password_hash):
+    """Return `True` if `password` matches `password_hash`, a hash returned by
+    `encrypt_password`. The salt is read from the hash and the hashes are
+    compared in constant time. If `password_hash` is `None` (e.g., because
+    there is no such user) or malformed, a dummy hash is verified instead, so
+    that we take as long to say no.
+
+    """
+
+    try:
+        return pbkdf2_sha512.verify(password, password_hash)
+    except (TypeError, ValueError):
+        pbkdf2_sha512.verify(password, DUMMY_PASSWORD_HASH)
+        return False
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls that do the same work. While a call for a
+    given key is in flight, further calls with that key do not call their
+    function; they wait for the first call to finish and share its result (or
+    its exception). Example usage::
+
+        flight = SingleFlight()
+        flight.do('state', refresh_state)
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(),
+                                          'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error']:
+                raise call['error'][0], call['error'][1], call['error'][2]
+            return call['result']
+        try:
+            call['result'] = func(*args, **kwargs)
+        except:
+            call['error'] = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['result']
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+
+def probe_shell(cmd_list):
+    """Run `cmd_list` via `shell`, killing it if it runs for longer than a
+    probe is allowed to, and return its output. The run is timed in the probe
+    statistics under the name of the command, e.g., '$ mysql -V'. If the
+    command times out or prints nothing, the result of the probe that ran it
+    is marked as incomplete, so that it is not cached.
+
+    """
+
+    with probe_stats.timer('$ %s' % ' '.join(cmd_list)):
+        try:
+            stdout = shell(cmd_list, timeout=PROBE_TIMEOUT)
+        except ShellTimeout, e:
+            mark_incomplete(str(e))
+            return e.output
+    if not stdout.strip():
+        mark_incomplete('`%s` printed nothing.' % ' '.join(cmd_list))
+    return stdout
+
+
+# Coalesces concurrent MySQL credential checks for the same credentials.
+mysql_credentials_flight = SingleFlight()
+
+
 def validate_mysql_credentials(params):
     """Check if we can actually access MySQL with the provided credentials;
     also check if we have sufficient privileges to do what we need to do.
+    Concurrent checks of the same credentials share a single `mysql` process.
 
     WARNING: requiring that the output to 'SHOW GRANTS;' contain "GRANT ALL
     PRIVILEGES ON *.* TO '<mysql-user>'" might be too stringent.
@@ -40,6 +148,12 @@ def validate_mysql_credentials(params):
     if not params.get('mysql_user') or not params.get('mysql_pwd'):
         return ('A MySQL username and password must be provided in order to'
             ' create and manage OLDs.')
+    return mysql_credentials_flight.do(
+        (params['mysql_user'], params['mysql_pwd']),
+        _validate_mysql_credentials, params)
+
+
+def _validate_mysql_credentials(params):
     mysql_show_grants = Popen(['mysql', '-u', params['mysql_user'],
         '-p%s' % params['mysql_pwd'], '-e', 'show grants;'], stdout=PIPE,
         stderr=STDOUT)
@@ -59,35 +173,36 @@ def get_old_version(params):
 
     """
 
-    stmts = ('import onlinelinguisticdatabase;'
-        'print getattr(onlinelinguisticdatabase, "__version__", "")')
-    python_path = get_python_path(params)
-    if os.path.isfile(python_path):
-        stdout = shell([python_path, '-c', stmts])
-        if stdout.strip():
-            return stdout.strip()
-    return ''
+    return inspect_env(params)['onlinelinguisticdatabase']['version']
 
 
 def get_mysql_installed():
-    stdout = shell(['mysql', '-V'])
+    stdout = probe_shell(['mysql', '-V'])
     if 'Distrib' in stdout.strip():
         return True
     return False
 
 
 def get_mysql_version():
-    stdout = shell(['mysql', '-V'])
+    stdout = probe_shell(['mysql', '-V'])
     if 'Distrib' in stdout.strip():
-        try:
-            return stdout.split()[4].replace(',', '')
-        except:
-            return ''
+        return parse_mysql_version(stdout)
     return ''
 
 
+def parse_mysql_version(stdout):
+    """Return the version number in the output of `mysql -V`.
+
+    """
+
+    try:
+        return stdout.split()[4].replace(',', '')
+    except:
+        return ''
+
+
 def get_easy_install_version(params):
-    stdout = shell(['easy_install', '--version']).decode('utf-8')
+    stdout = probe_shell(['easy_install', '--version']).decode('utf-8')
     if stdout.strip():
         try:
             return stdout.strip().split(' ')[1]
@@ -97,38 +212,18 @@ def get_easy_install_version(params):
 
 
 def get_virtualenv_version(params):
-    stdout = shell(['virtualenv', '--version']).decode('utf-8')
+    stdout = probe_shell(['virtualenv', '--version']).decode('utf-8')
     if stdout.strip():
         return stdout.strip()
     return ''
 
 
 def get_mysql_python_version(params):
-    stmts = 'import MySQLdb; print MySQLdb.__version__'
-    python_path = get_python_path(params)
-    if os.path.isfile(python_path):
-        stdout = shell([python_path, '-c', stmts])
-        if stdout.strip():
-            return stdout.strip()
-    return ''
+    return inspect_env(params)['MySQLdb']['version']
 
 
 def get_pil_version(params):
-    stmts = 'import Image; print Image.VERSION'
-    python_path = get_python_path(params)
-    if os.path.isfile(python_path):
-        stdout = shell([python_path, '-c', stmts])
-        resp = stdout.strip()
-        if resp:
-            if resp.startswith('Traceback'):
-                stmts = 'import PIL; print PIL.VERSION'
-                stdout = shell([python_path, '-c', stmts])
-                resp = stdout.strip()
-                if resp:
-                    return resp
-            else:
-                return resp
-    return ''
+    return env_pil_version(inspect_env(params))
 
 
 def get_os_and_version():
@@ -139,36 +234,103 @@ def get_os_and_version():
         os = 'Mac OS X'
         os_version = platform.mac_ver()[0]
     if _platform == 'Linux':
-        dist = platform.dist()
-        os = '%s Linux' % dist[0]
-        os_version = dist[1]
+        os = '%s Linux' % get_linux_id()
+        os_version = get_linux_release()
     return os, os_version
 
 
-def get_available_memory():
+def read_loadavg(path='/proc/loadavg'):
+    """Return the 1, 5 and 15 minute load averages from /proc/loadavg.
+
+    """
+
+    with open(path) as f:
+        return [float(x) for x in f.read().split()[:3]]
+
+
+# The names of the fields of the `cpu` line in /proc/stat, in order.
+CPU_TIME_FIELDS = ['user', 'nice', 'system', 'idle', 'iowait', 'irq',
+                   'softirq', 'steal', 'guest', 'guest_nice']
+
+
+def read_cpu_times(path='/proc/stat'):
+    """Return the aggregate CPU times (in clock ticks) from /proc/stat as a
+    dict from the names in `CPU_TIME_FIELDS` to integers. The CPU utilization
+    over an interval can be computed from two samples.
+
+    """
+
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts and parts[0] == 'cpu':
+                return dict(zip(CPU_TIME_FIELDS, [int(x) for x in parts[1:]]))
+    return {}
+
+
+def get_disk_usage(path):
+    """Return a dict with the `total`, `free` and `available` (to unprivileged
+    users, as `df` reports it) bytes of the filesystem containing `path`.
+
+    """
+
+    stat = os.statvfs(path)
+    return {
+        'total': stat.f_blocks * stat.f_frsize,
+        'free': stat.f_bfree * stat.f_frsize,
+        'available': stat.f_bavail * stat.f_frsize
+    }
+
+
+def human_size(num_bytes):
+    """Return `num_bytes` in the human-readable form that `df -h` uses, e.g.,
+    '512M', '9.8G' or '45G'. Values are rounded up, like `df` does.
+
+    """
+
+    num = float(num_bytes)
+    for unit in ['', 'K', 'M', 'G', 'T', 'P']:
+        if num < 1024 or unit == 'P':
+            break
+        num /= 1024
+    if not unit:
+        return '%d' % num
+    if num < 10:
+        return '%.1f%s' % (math.ceil(num * 10) / 10, unit)
+    return '%d%s' % (math.ceil(num), unit)
+
+
+def get_total_memory():
+    """Return the total RAM of the server in bytes, or `None` if it cannot be
+    determined.
+
+    """
+
     system = platform.system()
     if system == 'Darwin':
-        stdout = shell(['sysctl', 'hw.memsize'])
-        if stdout.strip():
-            try:
-                resp = stdout.strip()
-                return pretty_print_bytes(int(resp.split()[1]))
-            except:
-                return ''
-        return ''
+        stdout = probe_shell(['sysctl', 'hw.memsize'])
+        try:
+            return int(stdout.strip().split()[1])
+        except (ValueError, IndexError):
+            return None
     elif system == 'Linux':
-        stdout = shell(['free', '-g'])
-        if stdout.strip():
-            try:
-                resp = stdout.strip()
-                for line in resp.split('\n'):
-                    if line.startswith('Mem:'):
-                        return '%sGB' % line.split()[1]
-            except:
-                return ''
-        return ''
-    else:
+        try:
+            return read_meminfo()['MemTotal']
+        except (IOError, KeyError):
+            return None
+    return None
+
+
+def get_available_memory():
+    """Return the total RAM of the server in whole gigabytes, as `free -g`
+    reports it, e.g., '7GB'.
+
+    """
+
+    total = get_total_memory()
+    if total is None:
         return ''
+    return '%sGB' % (total // 1024 ** 3)
 
 
 def get_disk_space(apps_path):
@@ -181,19 +343,57 @@ def get_disk_space(apps_path):
         return ''
     if not os.path.isdir(apps_path):
         return ''
-    system = platform.system()
-    if system == 'Linux':
-        stdout = shell(['df', '-h', apps_path])
-        resp = stdout.strip()
-        if resp:
-            try:
-                return resp.split('\n')[1].split()[3]
-            except:
-                return ''
+    try:
+        return human_size(get_disk_usage(apps_path)['available'])
+    except OSError:
         return ''
-    return ''
 
 
+def collect_system_metrics(apps_path):
+    """Return a dict of metrics describing the server: its OS and OS version,
+    its memory, the disk space in `apps_path`, and, on Linux, its load
+    averages and CPU times. Exact byte counts are given alongside the
+    human-readable strings. Everything is read from /proc, /etc and
+    `os.statvfs` without forking, so this is cheap enough to sample often.
+
+    """
+
+    os_name, os_version = get_os_and_version()
+    metrics = {
+        'os': os_name,
+        'os_version': os_version,
+        'ram': '',
+        'ram_bytes': None,
+        'ram_available_bytes': None,
+        'disk_space_available': '',
+        'disk_space_available_bytes': None,
+        'disk_space_total_bytes': None,
+        'load_average': None,
+        'cpu_times': None
+    }
+    total_memory = get_total_memory()
+    if total_memory is not None:
+        metrics['ram'] = '%sGB' % (total_memory // 1024 ** 3)
+        metrics['ram_bytes'] = total_memory
+    if apps_path and os.path.isdir(apps_path):
+        try:
+            disk_usage = get_disk_usage(apps_path)
+        except OSError:
+            pass
+        else:
+            metrics['disk_space_available'] = human_size(
+                disk_usage['available'])
+            metrics['disk_space_available_bytes'] = disk_usage['available']
+            metrics['disk_space_total_bytes'] = disk_usage['total']
+    if platform.system() == 'Linux':
+        try:
+            metrics['ram_available_bytes'] = read_meminfo().get('MemAvailable')
+            metrics['load_average'] = read_loadavg()
+            metrics['cpu_times'] = read_cpu_times()
+        except (IOError, ValueError):
+            pass
+    return metrics
+
 
 def pretty_print_bytes(num_bytes):
     """Print an integer byte count to human-readable form.
@@ -235,9 +435,9 @@ def apache_installed():
 
 def get_apache_version():
     if platform.system() == 'Darwin':
-        stdout = shell(['apachectl', '-v'])
+        stdout = probe_shell(['apachectl', '-v'])
     else:
-        stdout = shell(['apache2', '-v'])
+        stdout = probe_shell(['apache2', '-v'])
     if stdout.strip():
         try:
             resp = stdout.strip()
@@ -252,7 +452,7 @@ def nginx_installed():
 
 
 def get_nginx_version():
-    stdout = shell(['nginx', '-v'])
+    stdout = probe_shell(['nginx', '-v'])
     if stdout.strip():
         try:
             return stdout.strip().split()[2].split('/')[1]
@@ -262,7 +462,7 @@ def get_nginx_version():
 
 
 def get_foma_version():
-    stdout = shell(['foma', '-v'])
+    stdout = probe_shell(['foma', '-v'])
     if stdout.strip():
         try:
             return stdout.replace('foma', '').strip()
@@ -272,7 +472,7 @@ def get_foma_version():
 
 
 def get_mitlm_version():
-    stdout = shell(['estimate-ngram', '-h'])
+    stdout = probe_shell(['estimate-ngram', '-h'])
     if stdout.strip():
         try:
             for line in stdout.split('\n'):
@@ -285,7 +485,7 @@ def get_mitlm_version():
 
 
 def get_ffmpeg_version():
-    stdout = shell(['ffmpeg', '-version'])
+    stdout = probe_shell(['ffmpeg', '-version'])
     if stdout.strip():
         try:
             return stdout.split('\n')[0].split(' ')[2]
@@ -295,17 +495,18 @@ def get_ffmpeg_version():
 
 
 def libmagic_installed():
-    return bool(shell(['man', 'libmagic']))
+    return library_installed('libmagic')
 
 
 def get_server(settings):
-    os, os_version = get_os_and_version()
-    return {
-        'os': os,
-        'os_version': os_version,
-        'disk_space_available': get_disk_space(settings['apps_path']),
-        'ram': get_available_memory()
-        }
+    """Return a dict describing the server: its OS and OS version, the disk
+    space available in the OLD applications directory and the total RAM, plus
+    the rest of the metrics that `collect_system_metrics` gathers.
+
+    """
+
+    with probe_stats.timer('server'):
+        return collect_system_metrics(settings['apps_path'])
 
 
 def get_python_version():
@@ -316,158 +517,304 @@ def get_python_version():
     return sys.version.split(' ')[0]
 
 
-def get_dependencies(params):
+# The names of the OLD dependencies that `get_dependencies` reports on, in the
+# order in which they are displayed.
+DEPENDENCY_NAMES = [
+    'Python',
+    'OLD',
+    'Apache',
+    'Nginx',
+    'MySQL',
+    'MySQL-python',
+    'easy_install',
+    'virtualenv',
+    'importlib',
+    'foma',
+    'MITLM',
+    'Ffmpeg',
+    'LaTeX',
+    'PIL',
+    'libmagic'
+]
+
+# The dependencies that the OLD can do without. Probing them is not needed to
+# decide whether the OLD can be installed or served, so they are not part of
+# the state snapshot; the main page loads them separately, after it renders.
+SOFT_DEPENDENCY_NAMES = ['foma', 'MITLM', 'Ffmpeg', 'LaTeX', 'PIL', 'libmagic']
+
+# The dependencies that are part of the state snapshot.
+CORE_DEPENDENCY_NAMES = [name for name in DEPENDENCY_NAMES
+                         if name not in SOFT_DEPENDENCY_NAMES]
+
+
+def probe_python(params):
+    return {'Python': {'installed': True, 'version': get_python_version()}}
+
+
+def probe_env(params):
+    """Probe the OLD and the Python packages that it needs in the OLD's virtual
+    environment. All of them are introspected by a single run of the virtual
+    environment's Python.
+
+    """
+
+    env_modules = inspect_env(params)
+    pil_installed = env_pil_installed(env_modules)
+    return {
+        'OLD': env_modules['onlinelinguisticdatabase'],
+        'MySQL-python': env_modules['MySQLdb'],
+        'importlib': {'installed': env_modules['importlib']['installed'],
+                      'version': None},
+        'PIL': {'installed': pil_installed,
+                'version': (pil_installed and env_pil_version(env_modules) or
+                            '')}
+        }
+
+
+def probe_apache(params):
+    installed = apache_installed()
+    return {'Apache': {'installed': installed,
+                       'version': installed and get_apache_version() or ''}}
+
+
+def probe_nginx(params):
+    installed = nginx_installed()
+    return {'Nginx': {'installed': installed,
+                      'version': installed and get_nginx_version() or ''}}
+
+
+def probe_mysql(params):
+    stdout = probe_shell(['mysql', '-V'])
+    installed = 'Distrib' in stdout.strip()
+    version = installed and parse_mysql_version(stdout) or ''
+    return {'MySQL': {'installed': installed, 'version': version}}
+
+
+def probe_easy_install(params):
+    installed = bool(which('easy_install'))
+    return {'easy_install': {
+        'installed': installed,
+        'version': installed and get_easy_install_version(params) or ''}}
+
+
+def probe_virtualenv(params):
+    installed = bool(which('virtualenv'))
+    return {'virtualenv': {
+        'installed': installed,
+        'version': installed and get_virtualenv_version(params) or ''}}
+
+
+def probe_foma(params):
+    installed = bool(which('foma') and which('flookup'))
+    return {'foma': {'installed': installed,
+                     'version': installed and get_foma_version() or ''}}
+
+
+def probe_mitlm(params):
+    installed = bool(which('estimate-ngram') and which('evaluate-ngram'))
+    return {'MITLM': {'installed': installed,
+                      'version': installed and get_mitlm_version() or ''}}
+
+
+def probe_ffmpeg(params):
+    installed = bool(which('ffmpeg'))
+    return {'Ffmpeg': {'installed': installed,
+                       'version': installed and get_ffmpeg_version() or ''}}
+
+
+def probe_latex(params):
+    installed = bool(which('pdflatex') and which('xelatex'))
+    return {'LaTeX': {'installed': installed, 'version': None}}
+
+
+def probe_libmagic(params):
+    return {'libmagic': {'installed': libmagic_installed(), 'version': None}}
+
+
+# A dependency probe: its name, the function that runs it, the names (see
+# `DEPENDENCY_NAMES`) of the dependencies that it reports on, the executables
+# whose files determine its result (`None` if the result should not be cached
+# on that basis) and the settings that its result depends on. A probe function
+# takes the settings and returns a dict from dependency names to dicts with
+# `installed` and `version` keys.
+DependencyProbe = namedtuple('DependencyProbe',
+                             ['name', 'func', 'provides', 'executables',
+                              'settings'])
+
+DEPENDENCY_PROBES = [
+    DependencyProbe('python', probe_python, ['Python'], None, []),
+    DependencyProbe('env', probe_env,
+                    ['OLD', 'MySQL-python', 'importlib', 'PIL'], None,
+                    ['env_dir']),
+    DependencyProbe('apache', probe_apache, ['Apache'],
+                    ['apache2', 'apachectl'], []),
+    DependencyProbe('nginx', probe_nginx, ['Nginx'], ['nginx'], []),
+    DependencyProbe('mysql', probe_mysql, ['MySQL'], ['mysql'], []),
+    DependencyProbe('easy_install', probe_easy_install, ['easy_install'],
+                    ['easy_install'], []),
+    DependencyProbe('virtualenv', probe_virtualenv, ['virtualenv'],
+                    ['virtualenv'], []),
+    DependencyProbe('foma', probe_foma, ['foma'], ['foma', 'flookup'], []),
+    DependencyProbe('mitlm', probe_mitlm, ['MITLM'],
+                    ['estimate-ngram', 'evaluate-ngram'], []),
+    DependencyProbe('ffmpeg', probe_ffmpeg, ['Ffmpeg'], ['ffmpeg'], []),
+    DependencyProbe('latex', probe_latex, ['LaTeX'], ['pdflatex', 'xelatex'],
+                    []),
+    DependencyProbe('libmagic', probe_libmagic, ['libmagic'], None, [])
+]
+
+
+def executables_fingerprint(executables):
+    """Return a fingerprint of the files that the `executables` resolve to on
+    the PATH. An executable that is not installed contributes `None`, so
+    installing it changes the fingerprint.
+
+    """
+
+    return [file_fingerprint(which(executable)) for executable in executables]
+
+
+def env_fingerprint(params):
+    """Return a fingerprint of the OLD's virtual environment: the Python
+    executable plus the modification times of its site-packages directories
+    and of the .pth files that easy_install rewrites when it installs a
+    package.
+
+    """
+
+    env_path = os.path.dirname(os.path.dirname(get_python_path(params)))
+    fingerprint = [file_fingerprint(get_python_path(params))]
+    for site_packages in sorted(glob.glob(
+            os.path.join(env_path, 'lib', 'python*', 'site-packages'))):
+        fingerprint.append([site_packages, os.path.getmtime(site_packages)])
+        for pth in sorted(glob.glob(os.path.join(site_packages, '*.pth'))):
+            fingerprint.append(file_fingerprint(pth))
+    return fingerprint
+
+
+def get_probe_fingerprint(probe, params):
+    """Return the fingerprint of the dependency probe `probe`, or `None` if its
+    result should not be cached.
+
+    """
+
+    if probe.name == 'env':
+        return env_fingerprint(params)
+    if probe.executables:
+        return executables_fingerprint(probe.executables)
+    return None
+
+
+def run_dependency_probes(params, probes, use_cache=True):
+    """Run the dependency `probes` concurrently and return a dict from the
+    names of the dependencies that they report on to dicts with `name`,
+    `installed` and `version` keys. A dependency whose probe fails or times
+    out is reported as not installed.
+
+    """
+
+    results = run_probes([
+        Probe(probe.name, probe.func, (params,), default={},
+              fingerprint=functools.partial(get_probe_fingerprint, probe,
+                                            params))
+        for probe in probes],
+        use_cache=use_cache)
+    dependencies = {}
+    for probe in probes:
+        for name in probe.provides:
+            dependency = {'name': name, 'installed': False, 'version': ''}
+            dependency.update(results[probe.name].get(name, {}))
+            dependencies[name] = dependency
+    return dependencies
+
+
+def get_dependency_probes(names):
+    """Return the dependency probes that report on any of the dependencies in
+    `names`.
+
+    """
+
+    return [probe for probe in DEPENDENCY_PROBES
+            if set(probe.provides) & set(names)]
+
+
+def get_dependencies(params, use_cache=True, names=DEPENDENCY_NAMES):
     """Inspect the server via various subprocess calls and introspection of the
     Python installation in our OLD virtual environment and return an array of
     objects representing our OLD dependencies and whether they are installed,
     including the version numbers, if possible, of installed dependencies.
 
+    The dependencies are probed concurrently by the probe engine; a dependency
+    whose probe fails or times out is reported as not installed. Probe results
+    are cached until the executables or virtual environment that they inspect
+    change on disk; pass `use_cache=False` to re-run every probe regardless.
+
+    Only the dependencies in `names` are probed and returned, e.g., pass
+    `CORE_DEPENDENCY_NAMES` or `SOFT_DEPENDENCY_NAMES`.
+
     """
 
-    mysql_installed = get_mysql_installed()
-    mysql_version = ''
-    if mysql_installed:
-        mysql_version = get_mysql_version()
-
-    old_installed_resp = old_installed(params)
-    old_version = ''
-    if old_installed_resp:
-        old_version = get_old_version(params)
-
-    easy_install_installed = bool(which('easy_install'))
-    easy_install_version = ''
-    if easy_install_installed:
-        easy_install_version = get_easy_install_version(params)
-
-    virtualenv_installed = bool(which('virtualenv'))
-    virtualenv_version = ''
-    if virtualenv_installed:
-        virtualenv_version = get_virtualenv_version(params)
-
-    mysql_python_installed_resp = mysql_python_installed(params)
-    mysql_python_version = ''
-    if mysql_python_installed_resp:
-        mysql_python_version = get_mysql_python_version(params)
-
-    apache_installed_resp = apache_installed()
-    apache_version = ''
-    if apache_installed_resp:
-        apache_version = get_apache_version()
-
-    nginx_installed_resp = nginx_installed()
-    nginx_version = ''
-    if nginx_installed_resp:
-        nginx_version = get_nginx_version()
-
-    foma_installed = bool(which('foma') and which('flookup'))
-    foma_version = ''
-    if foma_installed:
-        foma_version = get_foma_version()
-
-    mitlm_installed = bool(which('estimate-ngram') and which('evaluate-ngram'))
-    mitlm_version = ''
-    if mitlm_installed:
-        mitlm_version = get_mitlm_version()
-
-    ffmpeg_installed = bool(which('ffmpeg'))
-    ffmpeg_version = ''
-    if ffmpeg_installed:
-        ffmpeg_version = get_ffmpeg_version()
-
-    pil_installed_resp = pil_installed(params)
-    pil_version = ''
-    if pil_installed_resp:
-        pil_version = get_pil_version(params)
-
-    return [
-        {
-            'name': 'Python',
-            'installed': True,
-            'version': get_python_version()
-        },
-
-        {
-            'name': 'OLD',
-            'installed': old_installed_resp,
-            'version': old_version
-        },
-
-        {
-            'name': 'Apache',
-            'installed': apache_installed_resp,
-            'version': apache_version
-        },
-
-        {
-            'name': 'Nginx',
-            'installed': nginx_installed_resp,
-            'version': nginx_version
-        },
-
-        {
-            'name': 'MySQL',
-            'installed': mysql_installed,
-            'version': mysql_version
-        },
-
-        {
-            'name': 'MySQL-python',
-            'installed': mysql_python_installed_resp,
-            'version': mysql_python_version
-        },
-
-        {
-            'name': 'easy_install',
-            'installed': easy_install_installed,
-            'version': easy_install_version
-        },
-
-        {
-            'name': 'virtualenv',
-            'installed': virtualenv_installed,
-            'version': virtualenv_version
-        },
-
-        {
-            'name': 'importlib',
-            'installed': importlib_installed(params),
-            'version': None
-        },
-
-        {
-            'name': 'foma',
-            'installed': foma_installed,
-            'version': foma_version
-        },
-
-        {
-            'name': 'MITLM',
-            'installed': mitlm_installed,
-            'version': mitlm_version
-        },
-
-        {
-            'name': 'Ffmpeg',
-            'installed': ffmpeg_installed,
-            'version': ffmpeg_version
-        },
-
-        {
-            'name': 'LaTeX',
-            'installed': bool(which('pdflatex') and which('xelatex')),
-            'version': None
-        },
-
-        {
-            'name': 'PIL',
-            'installed': pil_installed_resp,
-            'version': pil_version
-        },
-
-        {
-            'name': 'libmagic',
-            'installed': libmagic_installed(),
-            'version': None
-        }
-    ]
+    dependencies = run_dependency_probes(
+        params, get_dependency_probes(names), use_cache)
+    return [dependencies[name] for name in DEPENDENCY_NAMES
+            if name in names]
+
+
+def get_affected_probes(changed_settings):
+    """Return the dependency probes whose results depend on any of the
+    settings in `changed_settings`.
+
+    """
+
+    return [probe for probe in DEPENDENCY_PROBES
+            if set(probe.settings) & set(changed_settings)]
+
+
+def update_dependencies(params, previous_dependencies, changed_settings,
+                        names=DEPENDENCY_NAMES):
+    """Return the dependencies as `get_dependencies` would for the settings in
+    `params`, given that they were `previous_dependencies` before the settings
+    in `changed_settings` were changed. Only the probes that depend on the
+    changed settings are re-run; the other dependencies are reused as is.
+
+    """
+
+    dependencies = dict((dependency['name'], dependency)
+                        for dependency in previous_dependencies)
+    dependencies.update(run_dependency_probes(
+        params, [probe for probe in get_affected_probes(changed_settings)
+                 if set(probe.provides) & set(names)]))
+    missing = [name for name in names if name not in dependencies]
+    if missing:
+        dependencies.update(run_dependency_probes(
+            params, get_dependency_probes(missing)))
+    return [dependencies[name] for name in DEPENDENCY_NAMES
+            if name in names]
+
+
+# Maps each setting to the keys of the `get_server` dict that depend on it.
+# Settings that are not listed here do not affect the server state.
+SERVER_SETTINGS = {
+    'apps_path': ['disk_space_available', 'disk_space_available_bytes',
+                  'disk_space_total_bytes']
+}
+
+
+def update_server(settings, previous_server, changed_settings):
+    """Return the server state as `get_server` would for `settings`, given that
+    it was `previous_server` before the settings in `changed_settings` were
+    changed. Only the values that depend on the changed settings are
+    recomputed; the rest are reused as is.
+
+    """
 
+    keys = set()
+    for setting in changed_settings:
+        keys.update(SERVER_SETTINGS.get(setting, []))
+    if not keys:
+        return previous_server
+    server = dict(previous_server)
+    current = get_server(settings)
+    for key in keys:
+        server[key] = current.get(key)
+    return server
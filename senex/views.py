@@ -3,10 +3,10 @@ import logging
 import re
 import pprint
 import json
-import datetime
 import os
 import pprint
 import string
+import time
 
 from .buildold import (
     build,
@@ -17,14 +17,39 @@ from .buildold import (
     get_dir_name_from_old_name,
     )
 
+from .security import (
+    HashingPoolBusy,
+    hashing_pool,
+    users_changed,
+    login_throttle,
+    )
+
+from .state import (
+    get_current_settings,
+    get_senex_state_model,
+    settings_changed,
+    get_soft_dependency_state,
+    get_state,
+    )
+
 from .utils import (
-    get_server,
-    get_dependencies,
+    CORE_DEPENDENCY_NAMES,
+    update_server,
+    update_dependencies,
     validate_mysql_credentials,
     generate_salt,
-    encrypt_password
+    encrypt_password,
+    verify_password
     )
 
+from .events import LONG_POLL_TIMEOUT, event_bus, publish_on_commit
+
+from .listing import Listing
+
+from .probes import probe_stats
+
+from sqlalchemy import Integer, cast
+
 from pyramid.httpexceptions import (
     HTTPFound,
     HTTPNotFound,
@@ -49,10 +74,17 @@ from .models import (
     DBSession,
     OLD,
     User,
-    SenexState,
+    SenexSettings,
+    ProbeSnapshot,
     )
 
-from worker import worker_q
+from worker import (
+    JOB_ALREADY_QUEUED,
+    JOB_QUEUE_FULL,
+    JOB_SUBMITTED,
+    get_job,
+    submit_job,
+    )
 
 
 LOGGER = logging.getLogger(__name__)
@@ -109,89 +141,86 @@ def get_core_dependencies(server_settings):
     return core_dependencies
 
 
-def create_new_state(previous_state=None):
-    """Create a new Senex state model in our db and return it as a 3-tuple of
-    `server_state`, `dependency_state`, and `state_settings`.
+@subscriber(IBeforeRender)
+def globals_factory(event):
+    """This gives the master Chameleon template to all of our other templates
+    so they can just fill in its slots and everything can be DRY.
 
     """
 
-    new_state = SenexState()
-    if previous_state:
-        for attr in new_state.settings_attrs:
-            setattr(new_state, attr, getattr(previous_state, attr))
-    new_state_settings = new_state.get_settings()
-    server_state = get_server(new_state_settings)
-    dependency_state = get_dependencies(new_state_settings)
-    new_state.server_state = unicode(json.dumps(get_server(new_state_settings)))
-    new_state.dependency_state = unicode(json.dumps(dependency_state))
-    new_state.last_state_check = datetime.datetime.utcnow()
-    DBSession.add(new_state)
-    return server_state, dependency_state, new_state_settings
+    master = get_renderer('templates/master.pt').implementation()
+    event['master'] = master
+    event['logged_in'] = False
 
 
-def state_stale_age():
-    return datetime.timedelta(minutes=5)
+def get_current_state(request):
+    """Return the current Senex state model, fetching it at most once per
+    request.
 
+    """
 
-def get_senex_state_model():
-    return DBSession.query(SenexState).order_by(SenexState.id.desc()).first()
+    return request.cache.get('senex_state', get_senex_state_model)
 
 
-def get_state(force_refresh=False):
-    """Return the state of the server, i.e., its server stats (like OS and
-    version) as well as the state of our OLD dependency installation. We return
-    a cached value from the db if we've checked the actual state recently. If
-    our state data are stale, we refresh them.
+def get_olds(request):
+    """Return all of the OLDs, fetching them at most once per request.
 
     """
 
-    senex_state = get_senex_state_model()
-    if senex_state:
-        age = datetime.datetime.utcnow() - senex_state.last_state_check
-        if age > state_stale_age() or force_refresh:
-            server_state, dependency_state, settings = create_new_state(senex_state)
-        else:
-            dependency_state = json.loads(senex_state.dependency_state)
-            server_state = json.loads(senex_state.server_state)
-            settings = senex_state.get_settings()
-    else:
-        server_state, dependency_state, settings = create_new_state()
-    return server_state, dependency_state, settings, senex_state.installation_in_progress 
+    return request.cache.get('olds', lambda: DBSession.query(OLD).all())
 
-@subscriber(IBeforeRender)
-def globals_factory(event):
-    """This gives the master Chameleon template to all of our other templates
-    so they can just fill in its slots and everything can be DRY.
 
-    """
-
-    master = get_renderer('templates/master.pt').implementation()
-    event['master'] = master
-    event['logged_in'] = False
+def get_old_by_name(request, oldname):
+    for old in get_olds(request):
+        if old.name == oldname:
+            return old
+    return None
 
 
 def update_settings(request):
-    senex_state = get_senex_state_model()
-    new_senex_state = SenexState()
-    changed = False
-    for attr in new_senex_state.settings_attrs:
-        if attr == 'mysql_pwd':
-            if request.params[attr]:
-                setattr(new_senex_state, attr, request.params[attr])
+    """Store the settings in `request.params` in a new Senex settings model, if
+    they differ from the current ones, and return the current state model.
+
+    The new settings get a new probe snapshot that reuses the previous one,
+    except for the parts that depend on the changed settings: e.g., changing
+    `env_dir` only re-runs the probes of the virtual environment and changing
+    `apps_path` only recomputes the available disk space.
+
+    """
+
+    start = time.time()
+    senex_state = get_current_state(request)
+    old_settings = get_current_settings(senex_state)
+    new_settings = SenexSettings()
+    changed = []
+    for attr in new_settings.settings_attrs:
+        if attr == 'mysql_pwd' and not request.params[attr]:
+            setattr(new_settings, attr, old_settings['mysql_pwd'])
         else:
-            setattr(new_senex_state, attr, request.params[attr])
-        if getattr(senex_state, attr) != getattr(new_senex_state, attr):
-            changed = True
+            setattr(new_settings, attr, request.params[attr])
+        if old_settings[attr] != getattr(new_settings, attr):
+            changed.append(attr)
     if changed:
-        new_state_settings = new_senex_state.get_settings()
-        dependency_state = get_dependencies(new_state_settings)
-        new_senex_state.server_state = unicode(json.dumps(get_server(new_state_settings)))
-        new_senex_state.dependency_state = unicode(json.dumps(dependency_state))
-        new_senex_state.last_state_check = datetime.datetime.utcnow()
-        DBSession.add(new_senex_state)
-        return new_senex_state
-    else:
-        return senex_state
+        DBSession.add(new_settings)
+        DBSession.flush()
+        senex_state.settings = new_settings
+        settings_changed(new_settings)
+        snapshot = senex_state.snapshot
+        if snapshot is not None:
+            new_state_settings = new_settings.get_settings()
+            server_state = update_server(new_state_settings,
+                                         json.loads(snapshot.server_state),
+                                         changed)
+            dependency_state = update_dependencies(
+                new_state_settings, json.loads(snapshot.dependency_state),
+                changed, names=CORE_DEPENDENCY_NAMES)
+            senex_state.snapshot = ProbeSnapshot(
+                settings_id=new_settings.id,
+                server_state=unicode(json.dumps(server_state)),
+                dependency_state=unicode(json.dumps(dependency_state)),
+                last_state_check=snapshot.last_state_check,
+                refresh_duration=time.time() - start)
+    return senex_state
 
 
 def get_warnings(server_state, dependency_state, settings):
@@ -248,44 +277,120 @@ def validate_settings(settings, warnings):
     return warnings
 
 
-def install_old():
-    """Install the OLD and all of its dependencies, given the settings
-    specified in the most recent senex_state model.
+def install_old(senex_state):
+    """Submit a job that installs the OLD and all of its dependencies, given
+    the settings specified in the current `senex_state` model, and return the
+    submission status and job id that `submit_job` returns. Only one
+    installation can be queued or running at a time, so every submission made
+    while there is one is coalesced with it.
 
     """
 
-    senex_state = get_senex_state_model()
-    if senex_state.installation_in_progress:
-        print 'install already in progress; returning.'
-        return
-    senex_state.installation_in_progress = True
-    DBSession.add(senex_state)
-    settings = senex_state.get_settings()
-    worker_q.put({
-        'id': generate_salt(),
-        'func': 'install_old',
-        'args': settings
-    })
-
-
-@view_config(route_name='return_status', renderer='json',
+    settings = get_current_settings(senex_state)
+    return submit_job('install_old', settings, key=u'install_old')
+
+
+# What the user is told about their request to install the OLD, by submission
+# status.
+job_submission_messages = {
+    JOB_SUBMITTED: 'The installation of the OLD and its dependencies has been'
+        ' queued.',
+    JOB_ALREADY_QUEUED: 'The OLD and its dependencies are already queued to be'
+        ' installed or are being installed.',
+    JOB_QUEUE_FULL: 'Too many jobs are waiting to run; please try installing'
+        ' the OLD again later.'
+    }
+
+
+@view_config(route_name='submit_install', renderer='json',
+    permission='edit', request_method='POST')
+def submit_install(request):
+    """Submit a job that installs the OLD and its dependencies and respond
+    right away with the submission status and the id of the job, which can be
+    followed at the `view_job` route. The response is 202 Accepted unless the
+    queue is full, in which case it is 503 Service Unavailable.
+
+    """
+
+    status, job_id = install_old(get_current_state(request))
+    if status == JOB_QUEUE_FULL:
+        request.response.status_int = 503
+        request.response.headers['Retry-After'] = '60'
+    else:
+        request.response.status_int = 202
+    return {'status': status, 'job_id': job_id,
+            'message': job_submission_messages[status]}
+
+
+@view_config(route_name='view_job', renderer='json', permission='edit')
+def view_job(request):
+    """Return the state of a job as a JSON object.
+
+    """
+
+    try:
+        job = get_job(int(request.matchdict['job_id']))
+    except ValueError:
+        job = None
+    if job is None:
+        raise HTTPNotFound('No such job')
+    return job
+
+
+@view_config(route_name='events', renderer='json', permission='edit')
+def events(request):
+    """Return the events that have happened since the `cursor` parameter as a
+    JSON object, waiting up to `timeout` seconds (at most
+    `LONG_POLL_TIMEOUT`) for one to happen if none has. This is long-polled by
+    static/scripts.js, which updates the page as events arrive. See
+    :meth:`senex.events.EventBus.wait` for the response.
+
+    """
+
+    try:
+        timeout = min(float(request.params.get('timeout', LONG_POLL_TIMEOUT)),
+                      LONG_POLL_TIMEOUT)
+    except ValueError:
+        timeout = LONG_POLL_TIMEOUT
+    return event_bus.wait(request.params.get('cursor'), timeout)
+
+
+@view_config(route_name='soft_dependencies', renderer='json',
     permission='edit')
-def return_status(request):
-    """Return a JSON object indicating the status of Senex, in particular
-    whether an installation is in progress. This is called asynchronously by
-    a JavaScript-based long-polling strategy. See static/scripts.js.
+def soft_dependencies(request):
+    """Return a JSON object listing the soft dependencies and whether they are
+    installed. These are not part of the state snapshot, so the main page
+    renders without them and then requests them from here. See
+    static/scripts.js.
 
     """
 
     logged_in = request.authenticated_userid
     if logged_in:
-        senex_state = get_senex_state_model()
-        return {'installation_in_progress':
-            senex_state.installation_in_progress}
+        settings = get_current_settings(get_current_state(request))
+        use_cache = request.params.get('refresh') != 'true'
+        return {'dependencies':
+            get_soft_dependency_state(settings, use_cache=use_cache)}
     else:
         return {'logged_in': False}
 
 
+@view_config(route_name='probe_stats', renderer='json', permission='edit')
+def probe_stats_report(request):
+    """Return a JSON object with the rolling latency statistics of every probe
+    and probe subprocess (see :class:`senex.probes.ProbeStats`) and how long
+    the refresh of the current state snapshot took.
+
+    """
+
+    senex_state = get_current_state(request)
+    snapshot = senex_state and senex_state.snapshot
+    return {'probes': probe_stats.report(),
+            'refresh_duration': snapshot and snapshot.refresh_duration,
+            'last_state_check': snapshot and
+                snapshot.last_state_check.isoformat()}
+
+
 def get_old_installed(dependency_state):
     try:
         return [d for d in dependency_state if d['name'] == 'OLD'][0]['installed']
@@ -293,19 +398,53 @@ def get_old_installed(dependency_state):
         return False
 
 
+def get_olds_listing(request):
+    return Listing(
+        request, 'olds', DBSession.query(OLD),
+        sort_columns={'name': OLD.name, 'human_name': OLD.human_name,
+                      'port': cast(OLD.port, Integer)},
+        search_columns=[OLD.name, OLD.human_name],
+        url_prefix=request.route_url('view_old', oldname=''),
+        url_key='name', default_sort='name')
+
+
+def get_users_listing(request):
+    return Listing(
+        request, 'users', DBSession.query(User),
+        sort_columns={'username': User.username,
+                      'first_name': User.first_name,
+                      'last_name': User.last_name},
+        search_columns=[User.username, User.first_name, User.last_name],
+        url_prefix=request.route_url('view_user', username=''),
+        url_key='username', default_sort='username')
+
+
 @view_config(route_name='view_main_page', renderer='templates/main.pt',
     permission='view')
 def view_main_page(request):
     logged_in = request.authenticated_userid
     if logged_in:
+        # Taken first, so that the page hears of every change that it does not
+        # reflect.
+        events_cursor = event_bus.cursor()
         if ('form.submitted' in request.params and
             'edit.settings' in request.params):
             update_settings(request)
+        job_submission = None
         if 'install_old_deps' in request.params:
-            install_old()
-        olds = DBSession.query(OLD).all()
-        users = DBSession.query(User).all()
-        server_state, dependency_state, settings, installation_in_progress = get_state()
+            job_submission, job_id = install_old(get_current_state(request))
+        olds = get_olds_listing(request)
+        users = get_users_listing(request)
+        if request.params.get('refresh') == 'true':
+            (server_state, dependency_state, settings,
+             installation_in_progress, refreshing) = get_state(
+                True, use_cache=False, senex_state=get_current_state(request))
+        else:
+            (server_state, dependency_state, settings,
+             installation_in_progress, refreshing) = get_state(
+                senex_state=get_current_state(request))
+        if job_submission in (JOB_SUBMITTED, JOB_ALREADY_QUEUED):
+            installation_in_progress = True
         warnings = get_warnings(server_state, dependency_state, settings)
         if request.params.get('validate_settings') == 'true':
             warnings = validate_settings(settings, warnings)
@@ -313,11 +452,17 @@ def view_main_page(request):
         if settings.get('mysql_pwd'):
             settings['mysql_pwd'] = '********************'
         core_dependencies = get_core_dependencies(settings)
+        soft_dependencies_url = request.route_url('soft_dependencies')
+        if request.params.get('refresh') == 'true':
+            soft_dependencies_url = '%s?refresh=true' % soft_dependencies_url
         return dict(
             add_old_url=request.route_url('add_old'),
             edit_settings_url=request.route_url('view_main_page'),
             validate_settings_url='%s?validate_settings=true' % request.route_url('view_main_page'),
-            return_status_url=request.route_url('return_status'),
+            refresh_state_url='%s?refresh=true' % request.route_url(
+                'view_main_page'),
+            events_url=request.route_url('events'),
+            events_cursor=events_cursor,
             install_old_deps_url='%s?install_old_deps=true' % request.route_url('view_main_page'),
             logged_in=logged_in,
             olds=olds,
@@ -325,12 +470,14 @@ def view_main_page(request):
             server=server_state,
             dependencies=dependency_state,
             core_dependencies=[d for d in dependency_state if d['name'] in core_dependencies],
-            soft_dependencies=[d for d in dependency_state if d['name'] not in core_dependencies],
+            soft_dependencies_url=soft_dependencies_url,
             settings=settings,
             setting_labels_human=setting_labels_human,
             setting_tooltips=setting_tooltips,
             old_installed=old_installed,
             installation_in_progress=installation_in_progress,
+            job_submission_message=job_submission_messages.get(job_submission),
+            refreshing=refreshing,
             warnings=warnings
             )
     else:
@@ -374,24 +521,22 @@ def view_old(request):
         )
 
 
-def validate_old(old):
+def validate_old(old, existing_olds):
     errors = {}
-    name_error = validate_old_name(old)
+    name_error = validate_old_name(old, existing_olds)
     if name_error:
         errors['name'] = name_error
     return errors
 
 
-def validate_old_name(old):
+def validate_old_name(old, existing_olds):
     if not re.search('^\w+$', old.name.strip()):
         return ('The name of an OLD can only contain letters, numbers'
             ' and/or the underscore.')
-    existing_old = DBSession.query(OLD).filter_by(name=old.name).first()
-    if existing_old:
+    if [o for o in existing_olds if o.name == old.name]:
         return ('There is already an OLD with the name %s installed here.'
             ' Please try again with a different name.' % old.name)
-    existing_old = DBSession.query(OLD).filter_by(dir_name=old.dir_name).first()
-    if existing_old:
+    if [o for o in existing_olds if o.dir_name == old.dir_name]:
         return ('Sorry, the name %s cannot be used because it is too similar to'
             ' an OLD that already exists. Please try again with a different'
             ' name.' % old.name)
@@ -409,18 +554,18 @@ def stop_old(request):
     """
 
     oldname = request.matchdict['oldname']
-    old = DBSession.query(OLD).filter_by(name=oldname).first()
+    old = get_old_by_name(request, oldname)
     if not old:
         raise HTTPNotFound('No such OLD: %s' % oldname)
     if not old.built:
         location = '%s?msg=notbuiltnostop' % request.route_url(
             'view_old', oldname=old.name)
         return HTTPFound(location=location)
-    build_params, warnings = get_build_params_and_warnings(old)
+    build_params, warnings = get_build_params_and_warnings(request, old)
     build_params['old_port'] = old.port
     if not warnings:
         try:
-            existing_olds = DBSession.query(OLD).all()
+            existing_olds = get_olds(request)
             for existing_old in existing_olds:
                 if existing_old.name == old.name:
                     existing_old.running = False
@@ -436,6 +581,8 @@ def stop_old(request):
         else:
             old.running = False
     DBSession.add(old)
+    publish_on_commit('old', name=old.name, built=bool(old.built),
+                      running=bool(old.running))
     return HTTPFound(location = request.route_url('view_old', oldname=old.name))
 
 
@@ -447,18 +594,18 @@ def start_old(request):
     """
 
     oldname = request.matchdict['oldname']
-    old = DBSession.query(OLD).filter_by(name=oldname).first()
+    old = get_old_by_name(request, oldname)
     if not old:
         raise HTTPNotFound('No such OLD: %s' % oldname)
     if not old.built:
         location = '%s?msg=notbuiltnostart' % request.route_url(
             'view_old', oldname=old.name)
         return HTTPFound(location=location)
-    build_params, warnings = get_build_params_and_warnings(old)
+    build_params, warnings = get_build_params_and_warnings(request, old)
     build_params['old_port'] = old.port
     if not warnings:
         try:
-            existing_olds = DBSession.query(OLD).all()
+            existing_olds = get_olds(request)
             for existing_old in existing_olds:
                 if existing_old.name == old.name:
                     existing_old.running = True
@@ -474,13 +621,22 @@ def start_old(request):
         else:
             old.running = True
     DBSession.add(old)
+    publish_on_commit('old', name=old.name, built=bool(old.built),
+                      running=bool(old.running))
     return HTTPFound(location = request.route_url('view_old', oldname=old.name))
 
 
-def get_build_params_and_warnings(old):
-    build_params = get_build_params(old)
-    server_state, dependency_state, settings, installation_in_progress = \
-        get_state(True)
+def get_build_params_and_warnings(request, old):
+    """Return the build params of `old` and the warnings that stand in the way
+    of building or starting it. The warnings must reflect the server as it is
+    now, so the state is refreshed synchronously.
+
+    """
+
+    build_params = get_build_params(request, old)
+    (server_state, dependency_state, settings, installation_in_progress,
+     refreshing) = get_state(True, senex_state=get_current_state(request),
+                             wait=True)
     warnings = get_warnings(server_state, dependency_state, settings)
     warnings = validate_settings(settings, warnings)
     return build_params, warnings
@@ -500,7 +656,7 @@ def add_old(request):
         dir_name = get_dir_name_from_old_name(name)
         human_name = request.params['human_name'].strip()
         old = OLD(name=name, dir_name=dir_name, human_name=human_name)
-        errors = validate_old(old)
+        errors = validate_old(old, get_olds(request))
         if errors:
             LOGGER.info('Errors generated when attempting to validate OLD %s'
                         ' for creation', old.name)
@@ -508,14 +664,14 @@ def add_old(request):
             return dict(old=old, errors=errors,
                 logged_in=request.authenticated_userid,
                 save_url=request.route_url('add_old'))
-        build_params, warnings = get_build_params_and_warnings(old)
+        build_params, warnings = get_build_params_and_warnings(request, old)
         if warnings:
             LOGGER.info('Warnings generated when attempting to build OLD %s',
                         old.name)
             LOGGER.info(pprint.pformat(warnings))
         else:
             try:
-                existing_olds = DBSession.query(OLD).all()
+                existing_olds = list(get_olds(request))
                 old.running = True
                 existing_olds.append(old)
                 build_params['existing_olds'] = existing_olds
@@ -534,38 +690,41 @@ def add_old(request):
                 old.url = url
                 old.port = port
         DBSession.add(old)
+        request.cache.invalidate('olds')
+        publish_on_commit('old', name=old.name, built=bool(old.built),
+                          running=bool(old.running))
         return HTTPFound(location = request.route_url('view_old', oldname=old.name))
     old = OLD(name='')
     return dict(old=old, errors={}, logged_in=request.authenticated_userid,
         save_url=request.route_url('add_old'))
 
 
-def get_build_params(old):
+def get_build_params(request, old):
     """Return the build params, a dict describing the OLD to be built and
     relevant aspects of Senex's state. This dict is needed by buildold.py's
     `build` function.
 
     """
 
-    senex_state = get_senex_state_model()
-    env_dir = senex_state.env_dir
+    senex_settings = get_current_settings(get_current_state(request))
+    env_dir = senex_settings['env_dir']
     paster_path = os.path.join(os.path.expanduser('~'), env_dir, 'bin',
             'paster')
-    olds = DBSession.query(OLD).all()
+    olds = get_olds(request)
     used_ports = dict([(o.dir_name, o.port) for o in olds])
     return {
         'old_name': old.name,
         'old_dir_name': old.dir_name,
-        'mysql_user': senex_state.mysql_user,
-        'mysql_pwd': senex_state.mysql_pwd,
+        'mysql_user': senex_settings['mysql_user'],
+        'mysql_pwd': senex_settings['mysql_pwd'],
         'paster_path': paster_path,
-        'apps_path': senex_state.apps_path,
-        'server': senex_state.server,
-        'vh_path': senex_state.vh_path,
-        'ssl_crt_path': senex_state.ssl_crt_path,
-        'ssl_key_path': senex_state.ssl_key_path,
-        'ssl_pem_path': senex_state.ssl_pem_path,
-        'host': senex_state.host,
+        'apps_path': senex_settings['apps_path'],
+        'server': senex_settings['server'],
+        'vh_path': senex_settings['vh_path'],
+        'ssl_crt_path': senex_settings['ssl_crt_path'],
+        'ssl_key_path': senex_settings['ssl_key_path'],
+        'ssl_pem_path': senex_settings['ssl_pem_path'],
+        'host': senex_settings['host'],
         'used_ports': used_ports,
         'actions': [] # remembers what we've done, in case abort needed.
     }
@@ -610,16 +769,22 @@ def login(request):
     if 'form.submitted' in request.params:
         login = request.params['login']
         password = request.params['password']
-        user = DBSession.query(User).filter_by(username=login).first()
-        if user:
-            salt = user.salt
-            encrypted_password = unicode(encrypt_password(password, str(salt)))
-            user2 = DBSession.query(User).filter_by(username=login)\
-                    .filter_by(password=encrypted_password).first()
-            if user2:
-                headers = remember(request, login)
-                return HTTPFound(location = came_from, headers = headers)
         message = 'Failed login'
+        if not login_throttle.allow(login, request.client_addr):
+            message = 'Too many login attempts. Please try again later.'
+        else:
+            password_hash = DBSession.query(User.password).\
+                filter_by(username=login).scalar()
+            try:
+                verified = hashing_pool.run(verify_password, password,
+                                            password_hash)
+            except HashingPoolBusy:
+                message = 'Senex is busy. Please try again shortly.'
+            else:
+                if verified:
+                    login_throttle.succeeded(login)
+                    headers = remember(request, login)
+                    return HTTPFound(location = came_from, headers = headers)
     return dict(
         message = message,
         url = request.application_url + '/login',
@@ -666,6 +831,7 @@ def edit_user(request):
             user.password = unicode(encrypt_password(user.password,
                 str(user.salt)))
         DBSession.add(user)
+        users_changed(username, user.username)
         return HTTPFound(location = request.route_url('view_user',
             username=user.username))
     return dict(
@@ -706,6 +872,7 @@ def add_user(request):
                 )
         user.password = unicode(encrypt_password(user.password, str(user.salt)))
         DBSession.add(user)
+        users_changed(user.username)
         return HTTPFound(location = request.route_url('view_user',
             username=user.username))
     return dict(
@@ -1,79 +1,458 @@
-"""This module contains some multithreading worker and queue logic plus the
-functionality -- related to OLD installation -- that the worther thread
-initiates.
+"""This module contains the worker thread and the durable job queue that feeds
+it, plus the functionality -- related to OLD installation -- that the worker
+thread initiates.
 
 The worker installs the OLD. Having a worker perform these tasks in a separate
 thread from that processing the HTTP request allows us to immediately respond
 to the user.
 
-The worker can only run a callable that is a global in :mod:`senex.worker` and
+Jobs are rows of the `jobs` table (see :class:`senex.models.Job`), so queued
+work survives restarts. The worker claims the oldest queued job, runs it and
+records whether it succeeded or failed. While a job runs, the worker updates
+its heartbeat; a running job whose heartbeat has stopped (because the process
+died) is an orphan and is retried, after a delay, until it runs out of
+attempts. A job whose handler raises an error has failed and is not retried:
+running an installation that failed once again would fail again, and its
+error is what the user needs to see.
+
+The worker can only run a callable that is registered in `JOB_HANDLERS` and
 which takes keyword arguments. Example usage::
 
-    from worker import worker_q
-    worker_q.put({
-        'id': generate_salt(),
-        'func': 'install_old',
-        'args': {'env_dir': u'env-old'}
-    })
+    from worker import submit_job
+    status, job_id = submit_job('install_old', {'env_dir': u'env-old'})
 
 Cf. http://www.chrismoos.com/2009/03/04/pylons-worker-threads.
 
 """
 
-import Queue
-import threading
+import datetime
+import hashlib
+import json
 import logging
+import os
+import socket
+import threading
 import time
-from uuid import uuid4
-import transaction
+import traceback
+from contextlib import contextmanager
+
+from sqlalchemy.exc import IntegrityError
 from .models import (
-    DBSession,
+    CURRENT_STATE_ID,
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    Job,
+    JobSession,
     SenexState,
     )
+from .events import publish
 from installold import install
 
 log = logging.getLogger(__name__)
 
+# How often (in seconds) an idle worker checks for new jobs. Jobs enqueued by
+# this process wake the worker up right away.
+POLL_INTERVAL = 2
+
+# How often (in seconds) a running job's heartbeat is updated and how long it
+# may go without one before the job is considered orphaned.
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+
+# How many times a job is attempted, by default, and how long (in seconds) to
+# wait before retrying it after each attempt that lost its worker.
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30
+
+# How many jobs may be waiting to run. Submissions beyond this are refused
+# rather than queued.
+MAX_QUEUED_JOBS = 10
+
+# The statuses of a job submission; see `submit_job`.
+JOB_SUBMITTED = u'submitted'
+JOB_ALREADY_QUEUED = u'already_queued'
+JOB_QUEUE_FULL = u'queue_full'
+
+# The identity of this process's worker, as recorded on the jobs it runs.
+WORKER_ID = u'%s:%s' % (socket.gethostname(), os.getpid())
+
+
 ################################################################################
-# WORKER THREAD & QUEUE
+# JOB QUEUE
 ################################################################################
 
 
-worker_q = Queue.Queue(1)
+@contextmanager
+def job_session():
+    """Provide a session of its own to a piece of background work: commit it if
+    the work succeeds, roll it back if it fails, and close it either way.
+
+    """
+
+    session = JobSession()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    for job in session.info.pop('changed_jobs', []):
+        publish('job', **job)
+
+
+def job_changed(session, job):
+    """Publish the state of `job` once `session` has been committed.
+
+    """
+
+    session.info.setdefault('changed_jobs', []).append(job_as_dict(job))
+
+
+def job_as_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'state': job.state,
+        'step': job.step,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'created': job.created and job.created.isoformat(),
+        'started': job.started and job.started.isoformat(),
+        'finished': job.finished and job.finished.isoformat(),
+        'error': job.error
+    }
+
+
+def get_job_key(kind, args):
+    """Return the key of the operation that a job of `kind` with `args`
+    performs: its kind and a digest of its arguments.
+
+    """
+
+    digest = hashlib.sha1(json.dumps(args, sort_keys=True)).hexdigest()
+    return u'%s:%s' % (kind, digest)
+
+
+def submit_job(kind, args=None, key=None, max_attempts=MAX_ATTEMPTS):
+    """Queue a job that calls the `kind` handler with the keyword arguments
+    `args`, without waiting for anything but the insert, and return a 2-tuple
+    of a submission status and the id of the job that will perform it:
+
+    - `JOB_SUBMITTED` and the id of the new job;
+    - `JOB_ALREADY_QUEUED` and the id of a queued or running job with the same
+      `key`, i.e., that performs the same operation, which the submission is
+      coalesced with;
+    - `JOB_QUEUE_FULL` and `None` if `MAX_QUEUED_JOBS` jobs are waiting.
+
+    The key defaults to the job's kind and arguments (see `get_job_key`). The
+    job is committed in a session of its own, so it is queued whether or not
+    the calling request's transaction is committed.
+
+    """
+
+    if kind not in JOB_HANDLERS:
+        raise ValueError('There is no job handler called %s.' % kind)
+    args = args or {}
+    key = key or get_job_key(kind, args)
+    with job_session() as session:
+        existing = session.query(Job.id).filter_by(active_key=key).scalar()
+        if existing is not None:
+            return JOB_ALREADY_QUEUED, existing
+        queued = session.query(Job).filter_by(state=JOB_QUEUED).count()
+        if queued >= MAX_QUEUED_JOBS:
+            log.warn('Job %s was not submitted: %s jobs are queued.', key,
+                     queued)
+            return JOB_QUEUE_FULL, None
+        job = Job(kind=kind, args=unicode(json.dumps(args)), active_key=key,
+                  state=JOB_QUEUED, attempts=0, max_attempts=max_attempts,
+                  available_at=datetime.datetime.utcnow())
+        session.add(job)
+        try:
+            session.flush()
+        except IntegrityError:
+            # The same operation was submitted concurrently.
+            session.rollback()
+            existing = session.query(Job.id).filter_by(active_key=key).\
+                scalar()
+            return JOB_ALREADY_QUEUED, existing
+        sync_state_flags(session)
+        job_changed(session, job)
+        job_id = job.id
+    worker.wakeup.set()
+    return JOB_SUBMITTED, job_id
+
+
+def get_job(job_id):
+    """Return job `job_id` as a dict, or `None` if there is no such job.
+
+    """
+
+    with job_session() as session:
+        job = session.query(Job).get(job_id)
+        if job is None:
+            return None
+        return job_as_dict(job)
+
+
+def claim_job(session):
+    """Claim the oldest queued job that is available to run, i.e., mark it as
+    running on this worker, and return it, or return `None` if there is no such
+    job. The claim is a conditional update, so two workers cannot claim the
+    same job.
+
+    """
+
+    now = datetime.datetime.utcnow()
+    candidates = session.query(Job.id).\
+        filter(Job.state == JOB_QUEUED).\
+        filter(Job.available_at <= now).\
+        order_by(Job.available_at, Job.id).limit(5).all()
+    for job_id, in candidates:
+        claimed = session.query(Job).\
+            filter_by(id=job_id, state=JOB_QUEUED).\
+            update({'state': JOB_RUNNING, 'attempts': Job.attempts + 1,
+                    'started': now, 'heartbeat': now, 'finished': None,
+                    'worker': WORKER_ID}, synchronize_session=False)
+        if claimed:
+            job = session.query(Job).get(job_id)
+            job_changed(session, job)
+            return job
+    return None
+
+
+def finish_job(session, job_id, error=None, retry=False):
+    """Record the end of an attempt at running job `job_id`. If `error` is
+    `None`, the job has succeeded; otherwise it has failed, unless `retry` is
+    true (the attempt was cut short, not failed) and it has attempts left, in
+    which case it is requeued.
+
+    """
+
+    job = session.query(Job).get(job_id)
+    now = datetime.datetime.utcnow()
+    job.heartbeat = now
+    if error is None:
+        job.state = JOB_SUCCEEDED
+        job.finished = now
+        job.error = None
+        job.active_key = None
+    else:
+        job.error = unicode(error)
+        if retry and job.attempts < job.max_attempts:
+            job.state = JOB_QUEUED
+            job.available_at = now + datetime.timedelta(
+                seconds=RETRY_DELAY * job.attempts)
+            log.warn('Job %s (%s) was interrupted; retrying it (attempt %s of'
+                     ' %s).', job.id, job.kind, job.attempts + 1,
+                     job.max_attempts)
+        else:
+            job.state = JOB_FAILED
+            job.finished = now
+            job.active_key = None
+            log.warn('Job %s (%s) failed after %s attempts.', job.id,
+                     job.kind, job.attempts)
+    job_changed(session, job)
+    return job
+
+
+def recover_orphaned_jobs(session, timeout=HEARTBEAT_TIMEOUT):
+    """Retry (or fail, if they have no attempts left) the running jobs whose
+    heartbeat is more than `timeout` seconds old, i.e., whose worker has died.
+    Return the number of recovered jobs.
+
+    """
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+    orphans = session.query(Job).\
+        filter(Job.state == JOB_RUNNING).\
+        filter(Job.heartbeat < cutoff).all()
+    for job in orphans:
+        log.warn('Job %s (%s) was orphaned by worker %s.', job.id, job.kind,
+                 job.worker)
+        finish_job(session, job.id,
+                   'The worker running this job stopped responding.',
+                   retry=True)
+    if orphans:
+        sync_state_flags(session)
+    return len(orphans)
+
+
+def sync_state_flags(session):
+    """Set each Senex state flag in `JOB_FLAGS` according to whether a job of
+    its kind is queued or running, so that a flag cannot stay set after its
+    job is gone, e.g., because the process died in the middle of it.
+
+    """
+
+    for kind, flag in JOB_FLAGS.items():
+        active = session.query(Job.id).\
+            filter(Job.kind == kind).\
+            filter(Job.state.in_([JOB_QUEUED, JOB_RUNNING])).\
+            first() is not None
+        session.query(SenexState).\
+            filter_by(id=CURRENT_STATE_ID).\
+            update({flag: active}, synchronize_session=False)
+
+
+# The id of the job that is running in the current thread, if any.
+current_job = threading.local()
+
+
+def set_job_step(step):
+    """Record and publish that the job running in the current thread is at
+    `step`. Handlers call this to report their progress; outside of a job, it
+    does nothing.
+
+    """
+
+    job_id = getattr(current_job, 'id', None)
+    if job_id is None:
+        return
+    with job_session() as session:
+        job = session.query(Job).get(job_id)
+        job.step = unicode(step)
+        job_changed(session, job)
+
+
+class Heartbeat(threading.Thread):
+    """A daemon thread that updates the heartbeat of running job `job_id` every
+    `HEARTBEAT_INTERVAL` seconds until it is stopped.
+
+    """
+
+    def __init__(self, job_id, interval=HEARTBEAT_INTERVAL):
+        threading.Thread.__init__(self, name='job-heartbeat-%s' % job_id)
+        self.setDaemon(True)
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with job_session() as session:
+                    session.query(Job).\
+                        filter_by(id=self.job_id, state=JOB_RUNNING).\
+                        update({'heartbeat': datetime.datetime.utcnow()},
+                               synchronize_session=False)
+            except Exception:
+                log.exception('Unable to update the heartbeat of job %s.',
+                              self.job_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+################################################################################
+# WORKER THREAD
+################################################################################
+
 
 class WorkerThread(threading.Thread):
     """Define the worker.
 
     """
 
+    def __init__(self):
+        threading.Thread.__init__(self, name='job-worker')
+        self.setDaemon(True)
+        self.wakeup = threading.Event()
+
     def run(self):
         while True:
-            msg = worker_q.get()
             try:
-                globals()[msg.get('func')](**msg.get('args'))
-            except Exception, e:
-                log.warn('Unable to process in worker thread: %s' % e)
-            worker_q.task_done()
+                ran = self.run_next()
+            except Exception:
+                log.exception('Unable to process in worker thread.')
+                ran = False
+            if not ran:
+                self.wakeup.wait(POLL_INTERVAL)
+                self.wakeup.clear()
+
+    def run_next(self):
+        """Recover any orphaned jobs, then claim and run the next job. Return
+        `False` if there was no job to run.
+
+        """
+
+        with job_session() as session:
+            recover_orphaned_jobs(session)
+            job = claim_job(session)
+            if job is None:
+                return False
+            job_id, kind, args = job.id, job.kind, json.loads(job.args)
+        run_job(job_id, kind, args)
+        return True
+
+
+def run_job(job_id, kind, args):
+    """Run claimed job `job_id` by calling its handler with `args`, keeping its
+    heartbeat going meanwhile, and record how it ended.
+
+    """
+
+    log.info('Running job %s (%s).', job_id, kind)
+    start = time.time()
+    heartbeat = Heartbeat(job_id)
+    heartbeat.start()
+    current_job.id = job_id
+    error = None
+    try:
+        JOB_HANDLERS[kind](**args)
+    except (Exception, SystemExit), e:
+        log.warn('Job %s (%s) raised an error: %s', job_id, kind, e)
+        error = traceback.format_exc()
+    finally:
+        current_job.id = None
+        heartbeat.stop()
+    with job_session() as session:
+        finish_job(session, job_id, error)
+        sync_state_flags(session)
+    log.info('Job %s (%s) ended after %.3f seconds.', job_id, kind,
+             time.time() - start)
+
+
+# The process-wide worker. It is started by `start_worker`.
+worker = WorkerThread()
 
 
 def start_worker():
-    """TODO: Called in :mod:`onlinelinguisticdatabase.config.environment.py`.
+    """Recover the jobs that were orphaned when the process last stopped and
+    start the worker. Called in :func:`senex.main`.
+
     """
 
-    worker = WorkerThread()
-    worker.setDaemon(True)
-    worker.start()
+    with job_session() as session:
+        recover_orphaned_jobs(session)
+        sync_state_flags(session)
+    if not worker.is_alive():
+        worker.start()
 
 
-def mock_install(params):
+################################################################################
+# JOB HANDLERS
+################################################################################
+
+
+def mock_install(params, progress=None):
     print 'In mock install with these params ...'
     print params
 
+    progress = progress or (lambda step: None)
+    progress('mock_install')
+
     time.sleep(10)
     print 'mock install slept for 10 seconds'
+    progress('mock_install_10')
 
     time.sleep(10)
     print 'mock install slept for 20 seconds'
+    progress('mock_install_20')
 
     time.sleep(10)
     print 'mock install slept for 30 seconds'
@@ -91,32 +470,27 @@ def mock_install(params):
 
 
 def install_old(**kwargs):
-    """Install the OLD and its dependencies.
+    """Install the OLD and its dependencies. Errors (including the `SystemExit`
+    that `install` raises when it gives up) propagate to the worker, which
+    records them on the job. Each installation step is recorded as the job's
+    step as it starts.
 
     """
 
     print 'install old in worker!'
     print kwargs
 
-    try:
-        #install(kwargs)
-        mock_install(kwargs)
-    except SystemExit as e:
-        print 'CAUGHT SYSTEM EXIT in worker!!!! with this error:'
-        print e
-    except:
-        print 'Caught OTHER ERROR'
-    finally:
-        installation_not_in_progress()
+    #install(kwargs, progress=set_job_step)
+    mock_install(kwargs, progress=set_job_step)
 
 
-def installation_not_in_progress():
-    senex_state = DBSession.query(SenexState).order_by(
-        SenexState.id.desc()).first()
-    senex_state.installation_in_progress = False
-    DBSession.add(senex_state)
-    # Since, by default, Pyramid handles when db commands are committed (at the
-    # end of a request), we have to manually commit here since we're not in a
-    # request.
-    transaction.commit()
+# The callables that the worker can run, by job kind.
+JOB_HANDLERS = {
+    'install_old': install_old
+}
 
+# The Senex state flags that say whether a job of a given kind is queued or
+# running. They are kept in sync by `sync_state_flags`.
+JOB_FLAGS = {
+    'install_old': 'installation_in_progress'
+}